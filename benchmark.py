@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+قياس أداء توليد ملفات PDF في نظام مكتب المحامي هشام يوسف الخياط
+
+الاستخدام:
+    python benchmark.py shaping [--iterations N]
+    python benchmark.py pdf [--kinds invoice voucher manual] [--count N] [--output results.json]
+"""
+
+import argparse
+import json
+import multiprocessing
+import platform
+import random
+import re
+import resource
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+
+import arabic_reshaper
+from bidi.algorithm import get_display
+from fpdf import FPDF_VERSION
+
+import server
+
+SHAPING_SAMPLES = [
+    "مجموعة المحامي هشام يوسف الخياط",
+    "تاريخ الإصدار: 2024-05-01",
+    "رقم الفاتورة: INV-2024-0001",
+    "اسم العميل: شركة الأفق للتجارة Al-Ufuq Trading Co.",
+    "المبلغ الإجمالي: 15,750.00 ريال",
+    "الحالة: مدفوعة",
+    "أتعاب الترافع في القضية رقم 4521 أمام المحكمة العامة بجدة، وتشمل إعداد المذكرات "
+    "وحضور الجلسات ومتابعة التنفيذ حتى صدور الحكم النهائي.",
+]
+
+def bench_shaping(iterations: int) -> dict:
+    """مقارنة التشكيل المباشر (المكتبة كما هي) مع المُشكِّل المثبّت ومع الذاكرة المؤقتة"""
+    def run(shape):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for text in SHAPING_SAMPLES:
+                shape(text)
+        return time.perf_counter() - start
+
+    calls = iterations * len(SHAPING_SAMPLES)
+    baseline = run(lambda text: get_display(arabic_reshaper.reshape(text)))
+    uncached = run(lambda text: get_display(server.arabic_text_reshaper.reshape(text)))
+    server.shape_arabic.cache_clear()
+    cached = run(server.shape_arabic)
+    return {
+        "calls": calls,
+        "library_calls_per_sec": round(calls / baseline, 1),
+        "uncached_calls_per_sec": round(calls / uncached, 1),
+        "cached_calls_per_sec": round(calls / cached, 1),
+        "speedup": round(baseline / cached, 1),
+        "cache": server.shape_arabic.cache_info()._asdict(),
+    }
+
+SHORT_DESCRIPTIONS = [
+    "استشارة قانونية",
+    "أتعاب صياغة عقد",
+    "Legal consultation - استشارة",
+]
+
+LONG_DESCRIPTION = (
+    "أتعاب الترافع في القضية رقم 4521 أمام المحكمة العامة بجدة، وتشمل إعداد المذكرات وحضور الجلسات "
+    "ومتابعة التنفيذ حتى صدور الحكم النهائي. Case ref: JED-2024-4521 (Commercial Court). "
+)
+
+CLIENT_NAMES = ["شركة الأفق للتجارة", "Al-Ufuq Trading Co.", "محمد عبدالله العتيبي", "مؤسسة النخبة Elite Est."]
+
+PAGE_PATTERN = re.compile(rb"/Type\s*/Page(?!s)")
+
+def synthetic_invoice(i: int, rng: random.Random) -> dict:
+    long_text = rng.random() < 0.5
+    return {
+        "id": f"bench-invoice-{i}",
+        "invoice_number": f"INV-2024-{i:05d}",
+        "client_name": rng.choice(CLIENT_NAMES),
+        "description": LONG_DESCRIPTION * rng.randint(2, 8) if long_text else rng.choice(SHORT_DESCRIPTIONS),
+        "amount": round(rng.uniform(500, 250000), 2),
+        "status": rng.choice(["paid", "pending"]),
+        "created_at": f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T10:00:00",
+        "due_date": f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+    }
+
+def synthetic_voucher(i: int, rng: random.Random) -> dict:
+    long_text = rng.random() < 0.5
+    return {
+        "id": f"bench-voucher-{i}",
+        "voucher_number": f"V-2024-{i:05d}",
+        "voucher_type": rng.choice(["قبض", "صرف"]),
+        "client_name": rng.choice(CLIENT_NAMES + [""]),
+        "description": LONG_DESCRIPTION * rng.randint(2, 8) if long_text else rng.choice(SHORT_DESCRIPTIONS),
+        "amount": round(rng.uniform(100, 50000), 2),
+        "payment_method": rng.choice(["نقدي", "تحويل بنكي", "Cheque شيك"]),
+        "created_by_name": "المحاسب Accountant",
+        "created_at": f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T10:00:00",
+    }
+
+SYNTHETIC_DATA = {
+    "invoice": synthetic_invoice,
+    "voucher": synthetic_voucher,
+    "manual": lambda i, rng: {},
+}
+
+def percentile(values, pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def peak_rss_mb() -> float:
+    # ru_maxrss بالكيلوبايت على لينكس وبالبايت على ماك
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def bench_pdf_kind(kind: str, count: int, warmup: int, seed: int) -> dict:
+    """توليد count ملفاً من نوع واحد وقياس الزمن والذاكرة (يُشغّل في عملية مستقلة)"""
+    import logging
+    logging.disable(logging.WARNING)
+    rng = random.Random(seed)
+    renderer = server.PDF_RENDERERS[kind]
+    make_data = SYNTHETIC_DATA[kind]
+
+    server.preload_pdf_resources()
+    for i in range(warmup):
+        renderer(make_data(i, rng))
+    rss_before = peak_rss_mb()
+
+    latencies = []
+    pages = 0
+    size = 0
+    start = time.perf_counter()
+    for i in range(count):
+        data = make_data(i, rng)
+        t0 = time.perf_counter()
+        content = renderer(data).getvalue()
+        latencies.append(time.perf_counter() - t0)
+        pages += len(PAGE_PATTERN.findall(content))
+        size += len(content)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "kind": kind,
+        "documents": count,
+        "pages": pages,
+        "seconds": round(elapsed, 3),
+        "docs_per_sec": round(count / elapsed, 2),
+        "pages_per_sec": round(pages / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 2),
+        "avg_bytes": size // count,
+        "peak_rss_mb_after_warmup": rss_before,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def bench_pdf(kinds, count: int, warmup: int, seed: int) -> dict:
+    """كل نوع في عملية جديدة حتى تكون ذروة الذاكرة خاصة به"""
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for kind in kinds:
+        with ctx.Pool(1) as pool:
+            n = max(1, count // 10) if kind == "manual" else count
+            results.append(pool.apply(bench_pdf_kind, (kind, n, warmup, seed)))
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "fpdf": FPDF_VERSION,
+        "seed": seed,
+        "results": results,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="قياس أداء توليد PDF")
+    sub = parser.add_subparsers(dest="command", required=True)
+    shaping = sub.add_parser("shaping", help="سرعة تشكيل النص العربي")
+    shaping.add_argument("--iterations", type=int, default=500)
+    pdf = sub.add_parser("pdf", help="سرعة توليد الفواتير والسندات والكتيب وذاكرتها")
+    pdf.add_argument("--kinds", nargs="+", choices=list(SYNTHETIC_DATA), default=list(SYNTHETIC_DATA))
+    pdf.add_argument("--count", type=int, default=100, help="عدد الملفات لكل نوع (الكتيب عُشرها)")
+    pdf.add_argument("--warmup", type=int, default=3)
+    pdf.add_argument("--seed", type=int, default=1)
+    pdf.add_argument("--output", help="حفظ النتائج بصيغة JSON للمقارنة بين التشغيلات")
+    pdf.add_argument("--baseline", help="ملف JSON من تشغيل سابق لعرض الفرق")
+    args = parser.parse_args(argv)
+
+    if args.command == "shaping":
+        result = bench_shaping(args.iterations)
+        for key, value in result.items():
+            print(f"{key}: {value}")
+    elif args.command == "pdf":
+        report = bench_pdf(args.kinds, args.count, args.warmup, args.seed)
+        baseline = {}
+        if args.baseline:
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = {row["kind"]: row for row in json.load(f)["results"]}
+        for row in report["results"]:
+            line = (
+                f"{row['kind']:<8} {row['docs_per_sec']:>8} docs/s {row['pages_per_sec']:>8} pages/s  "
+                f"p50 {row['p50_ms']} ms  p99 {row['p99_ms']} ms  peak RSS {row['peak_rss_mb']} MB"
+            )
+            previous = baseline.get(row["kind"])
+            if previous:
+                change = (row["pages_per_sec"] / previous["pages_per_sec"] - 1) * 100
+                line += f"  ({change:+.1f}% pages/s, p50 was {previous['p50_ms']} ms)"
+            print(line)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"results written to {args.output}")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,20 +4,28 @@
 كتيب إرشادات نظام مكتب المحامي هشام يوسف الخياط
 """
 
-from fpdf import FPDF
+from fpdf import FPDF, FPDF_VERSION
 from fpdf.enums import XPos, YPos
+from pathlib import Path
+import argparse
+import hashlib
 import os
 
+ROOT_DIR = Path(__file__).parent
+DEFAULT_FONTS_DIR = Path(os.environ.get('MANUAL_FONTS_DIR', ROOT_DIR / 'fonts'))
+DEFAULT_OUTPUT_PATH = Path(os.environ.get('MANUAL_OUTPUT_PATH', ROOT_DIR / 'user_manual.pdf'))
+MANUAL_FONTS = ["NotoSansArabic-Regular.ttf", "NotoSansArabic-Bold.ttf"]
+
 class ArabicPDF(FPDF):
-    def __init__(self):
+    def __init__(self, fonts_dir=DEFAULT_FONTS_DIR):
         super().__init__()
         # تحميل الخط العربي Noto Sans Arabic
-        regular_font = "/app/backend/fonts/NotoSansArabic-Regular.ttf"
-        bold_font = "/app/backend/fonts/NotoSansArabic-Bold.ttf"
+        regular_font = Path(fonts_dir) / MANUAL_FONTS[0]
+        bold_font = Path(fonts_dir) / MANUAL_FONTS[1]
         
-        if os.path.exists(regular_font):
+        if regular_font.exists():
             self.add_font("Arabic", "", regular_font)
-        if os.path.exists(bold_font):
+        if bold_font.exists():
             self.add_font("Arabic", "B", bold_font)
         
         # Enable text shaping immediately
@@ -80,8 +88,21 @@ class ArabicPDF(FPDF):
         self.multi_cell(180, 5, content, align='C')
         self.ln(15)
 
-def create_manual():
-    pdf = ArabicPDF()
+def manual_content_hash(fonts_dir=DEFAULT_FONTS_DIR) -> str:
+    """بصمة محتوى الكتيب: نص هذا الملف والخطوط وإصدار fpdf؛ تتغير فقط عند تغير أحدها"""
+    digest = hashlib.sha256()
+    digest.update(FPDF_VERSION.encode())
+    digest.update(Path(__file__).read_bytes())
+    for name in MANUAL_FONTS:
+        font_path = Path(fonts_dir) / name
+        if font_path.exists():
+            digest.update(name.encode())
+            digest.update(font_path.read_bytes())
+    return digest.hexdigest()
+
+def build_manual(fonts_dir=DEFAULT_FONTS_DIR) -> bytes:
+    """توليد الكتيب وإرجاعه كبايتات"""
+    pdf = ArabicPDF(fonts_dir)
     pdf.set_auto_page_break(auto=True, margin=15)
     pdf.set_left_margin(10)
     pdf.set_right_margin(10)
@@ -463,11 +484,30 @@ def create_manual():
     pdf.ln(10)
     pdf.info_box('شكراً لاستخدامك النظام', 'نسعى دائماً لتطوير النظام وتحسين تجربة المستخدم. لا تتردد في إرسال ملاحظاتك واقتراحاتك.')
     
-    # === حفظ الملف ===
-    output_path = '/app/frontend/public/user_manual.pdf'
-    pdf.output(output_path)
+    return bytes(pdf.output())
+
+def create_manual(output_path=DEFAULT_OUTPUT_PATH, fonts_dir=DEFAULT_FONTS_DIR, force=False):
+    """حفظ الكتيب في output_path؛ لا يُعاد التوليد إذا لم تتغير البصمة منذ آخر مرة"""
+    output_path = Path(output_path)
+    hash_path = output_path.with_name(output_path.name + '.sha256')
+    content_hash = manual_content_hash(fonts_dir)
+    
+    if not force and output_path.exists() and hash_path.exists() and hash_path.read_text().strip() == content_hash:
+        print(f'الكتيب محدث: {output_path}')
+        return output_path
+    
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = output_path.with_name(output_path.name + '.tmp')
+    tmp_path.write_bytes(build_manual(fonts_dir))
+    os.replace(tmp_path, output_path)
+    hash_path.write_text(content_hash)
     print(f'✅ تم إنشاء الكتيب: {output_path}')
     return output_path
 
 if __name__ == '__main__':
-    create_manual()
+    parser = argparse.ArgumentParser(description='توليد كتيب المستخدم')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT_PATH, help='مسار ملف PDF الناتج')
+    parser.add_argument('--fonts-dir', default=DEFAULT_FONTS_DIR, help='مجلد الخطوط العربية')
+    parser.add_argument('--force', action='store_true', help='إعادة التوليد حتى لو لم يتغير المحتوى')
+    args = parser.parse_args()
+    create_manual(args.output, args.fonts_dir, args.force)
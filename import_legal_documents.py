@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+استيراد المستندات القانونية بالجملة من ملف NDJSON/JSONL إلى قاعدة البيانات مباشرة
+
+كل سطر مستند JSON بحقول LegalDocumentCreate (title, category, content, ...).
+الخوادم العاملة تلتقط المستندات الجديدة في فهرس البحث خلال LEGAL_INDEX_REFRESH_INTERVAL.
+
+الاستخدام:
+    python import_legal_documents.py corpus.jsonl [--user-id ID] [--user-name NAME]
+    cat corpus.jsonl | python import_legal_documents.py -
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+import server
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+async def read_chunks(stream):
+    while True:
+        chunk = await asyncio.to_thread(stream.read, READ_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+async def run(path: str, user_id: str, user_name: str) -> dict:
+    stream = sys.stdin.buffer if path == "-" else open(path, "rb")
+    try:
+        result = await server.import_legal_documents(
+            server.iter_ndjson_lines(read_chunks(stream)), user_id, user_name
+        )
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+    if result["imported"]:
+        await server.log_action("create", "legal_document", "bulk_import", user_id, user_name,
+                                f"استيراد {result['imported']} مستند قانوني من {path}")
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="استيراد المستندات القانونية من NDJSON")
+    parser.add_argument("path", help="مسار الملف أو - للإدخال القياسي")
+    parser.add_argument("--user-id", default="system", help="معرف المستخدم المسجل كرافع للمستندات")
+    parser.add_argument("--user-name", default="استيراد النظام", help="اسم المستخدم المسجل كرافع للمستندات")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    result = asyncio.run(run(args.path, args.user_id, args.user_name))
+    elapsed = time.perf_counter() - start
+
+    for error in result["errors"]:
+        print(f"line {error['line']}: {error['error']}", file=sys.stderr)
+    print(json.dumps({**result, "errors": len(result["errors"]), "seconds": round(elapsed, 2)}, ensure_ascii=False))
+    return 1 if result["error_count"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,19 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Request
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from gridfs.errors import NoFile
 import os
 import logging
 import base64
 import certifi
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict, EmailStr
+from urllib.parse import quote
+from pydantic import BaseModel, Field, ConfigDict, EmailStr, ValidationError
 from typing import List, Optional, Union
 import uuid
 from datetime import datetime, timezone, timedelta
@@ -17,8 +21,22 @@ from passlib.context import CryptContext
 from jose import JWTError, jwt
 from io import BytesIO
 from fpdf import FPDF
+from fpdf.fonts import SubsetMap, TTFFont
+from fpdf.image_parsing import get_img_info
+from fontTools.ttLib import TTFont
 import arabic_reshaper
 from bidi.algorithm import get_display
+from create_manual import build_manual, manual_content_hash
+try:
+    from emergentintegrations.llm.chat import LlmChat, UserMessage
+except ImportError:
+    # اختيارية: بدونها يعمل المساعد الذكي بالنموذج المحلي فقط (LLM_BACKEND=stub)
+    LlmChat = UserMessage = None
+try:
+    import google.generativeai as genai
+except ImportError:
+    # اختيارية: بدونها يُرسل رد المساعد الذكي كاملاً بدلاً من بثه
+    genai = None
 import imaplib
 import smtplib
 import email as email_lib
@@ -28,6 +46,25 @@ from email.mime.base import MIMEBase
 from email import encoders
 from email.header import decode_header
 import asyncio
+import socket
+import hashlib
+import json
+import copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import re
+import queue
+import threading
+import time
+import math
+import heapq
+from array import array
+import functools
+from collections import Counter, defaultdict, deque
+import zipfile
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -80,6 +117,74 @@ SMTP_SERVER = os.environ.get('SMTP_SERVER', 'mail.hklaw.sa')
 SMTP_PORT = int(os.environ.get('SMTP_PORT', 465))
 EMAIL_ADDRESS = os.environ.get('EMAIL_ADDRESS', '')
 EMAIL_PASSWORD = os.environ.get('EMAIL_PASSWORD', '')
+# فترة مزامنة البريد الوارد بالثواني والحد الأقصى للتراجع عند الأخطاء
+EMAIL_SYNC_ENABLED = os.environ.get('EMAIL_SYNC_ENABLED', 'true').lower() == 'true'
+EMAIL_SYNC_INTERVAL = int(os.environ.get('EMAIL_SYNC_INTERVAL', 120))
+EMAIL_SYNC_MAX_BACKOFF = int(os.environ.get('EMAIL_SYNC_MAX_BACKOFF', 1800))
+EXTERNAL_EMAIL_SYNC_LOCK = "external_email_sync"
+# الحد الأقصى للرسائل المجلوبة في كل دورة (الباقي في الدورة التالية)
+EMAIL_SYNC_BATCH_SIZE = int(os.environ.get('EMAIL_SYNC_BATCH_SIZE', 50))
+# اتصالات SMTP المجمعة وقائمة الإرسال الصادر
+SMTP_POOL_SIZE = int(os.environ.get('SMTP_POOL_SIZE', 2))
+SMTP_IDLE_TIMEOUT = int(os.environ.get('SMTP_IDLE_TIMEOUT', 240))
+OUTBOUND_EMAIL_BATCH_SIZE = int(os.environ.get('OUTBOUND_EMAIL_BATCH_SIZE', 20))
+OUTBOUND_EMAIL_POLL_INTERVAL = int(os.environ.get('OUTBOUND_EMAIL_POLL_INTERVAL', 15))
+OUTBOUND_EMAIL_MAX_ATTEMPTS = int(os.environ.get('OUTBOUND_EMAIL_MAX_ATTEMPTS', 6))
+OUTBOUND_EMAIL_RETRY_BASE = 60
+OUTBOUND_EMAIL_MAX_BACKOFF = 3600
+# مدة الحجز تُجدد أثناء إرسال الدفعة، فهي تحدد فقط متى تُستعاد رسائل عامل متوقف
+OUTBOUND_EMAIL_LOCK_SECONDS = 300
+
+# ==================== إعدادات مخزن الملفات ====================
+# gridfs (افتراضي) أو local لتخزين الملفات على القرص
+BLOB_STORE_BACKEND = os.environ.get('BLOB_STORE_BACKEND', 'gridfs')
+BLOB_STORE_PATH = Path(os.environ.get('BLOB_STORE_PATH', str(ROOT_DIR / 'blobs')))
+BLOB_CHUNK_SIZE = 255 * 1024
+# توليد PDF: عدد عمليات العمال (0 = خيوط داخل العملية)، حد الطابور، ومهلة كل ملف
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', 2))
+PDF_QUEUE_LIMIT = int(os.environ.get('PDF_QUEUE_LIMIT', 16))
+PDF_RENDER_TIMEOUT = int(os.environ.get('PDF_RENDER_TIMEOUT', 30))
+PDF_EXPORT_MAX_DOCUMENTS = int(os.environ.get('PDF_EXPORT_MAX_DOCUMENTS', 1000))
+ARABIC_SHAPING_CACHE_SIZE = int(os.environ.get('ARABIC_SHAPING_CACHE_SIZE', 4096))
+# إعادة بناء فهرس المكتبة القانونية عند تعديلها من عملية أخرى (بالثواني)
+LEGAL_INDEX_REFRESH_INTERVAL = int(os.environ.get('LEGAL_INDEX_REFRESH_INTERVAL', 60))
+# سياق المساعد القانوني: أقصى طول للمادة الواحدة، عدد المواد، وميزانية الرموز
+LEGAL_PASSAGE_MAX_CHARS = int(os.environ.get('LEGAL_PASSAGE_MAX_CHARS', 1500))
+LEGAL_AI_TOP_PASSAGES = int(os.environ.get('LEGAL_AI_TOP_PASSAGES', 8))
+LEGAL_AI_CONTEXT_TOKENS = int(os.environ.get('LEGAL_AI_CONTEXT_TOKENS', 2500))
+# المستندات ذات الصلة: عدد المصطلحات المحفوظة لكل متجه، وعدد المصطلحات المستخدمة لإيجاد المرشحين
+LEGAL_RELATED_MAX_TERMS = int(os.environ.get('LEGAL_RELATED_MAX_TERMS', 200))
+LEGAL_RELATED_PROBE_TERMS = int(os.environ.get('LEGAL_RELATED_PROBE_TERMS', 24))
+# الاستيراد بالجملة: حجم دفعة الإدراج والحد الأقصى لأخطاء الأسطر في الرد
+LEGAL_IMPORT_BATCH_SIZE = int(os.environ.get('LEGAL_IMPORT_BATCH_SIZE', 500))
+LEGAL_IMPORT_MAX_ERRORS = int(os.environ.get('LEGAL_IMPORT_MAX_ERRORS', 200))
+# أقصى حجم لسطر (مستند) واحد؛ الأطول يُسجل كخطأ في السطر
+LEGAL_IMPORT_MAX_LINE_SIZE = int(os.environ.get('LEGAL_IMPORT_MAX_LINE_SIZE', 8 * 1024 * 1024))
+LEGAL_AI_PROVIDER = os.environ.get('LEGAL_AI_PROVIDER', 'gemini')
+LEGAL_AI_MODEL = os.environ.get('LEGAL_AI_MODEL', 'gemini-3-flash-preview')
+# مفتاح Gemini المباشر (اختياري) لبث الردود؛ بدونه يُرسل الرد كاملاً عبر LlmChat
+GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY', '')
+if genai is not None and GEMINI_API_KEY:
+    genai.configure(api_key=GEMINI_API_KEY)
+# عميل النموذج المشترك: emergent أو stub (محلي لاختبار الحمل)، الحد الأقصى للطلبات المتزامنة،
+# مهلة الاستدعاء ومهلة انتظار الدور بالثواني، وقاطع الدائرة (عدد الأخطاء المتتالية ومدة الإيقاف)
+LLM_BACKEND = os.environ.get('LLM_BACKEND', 'emergent')
+LLM_MAX_IN_FLIGHT = int(os.environ.get('LLM_MAX_IN_FLIGHT', 8))
+LLM_TIMEOUT = float(os.environ.get('LLM_TIMEOUT', 60))
+LLM_QUEUE_TIMEOUT = float(os.environ.get('LLM_QUEUE_TIMEOUT', 10))
+LLM_CIRCUIT_FAILURES = int(os.environ.get('LLM_CIRCUIT_FAILURES', 5))
+LLM_CIRCUIT_RESET = float(os.environ.get('LLM_CIRCUIT_RESET', 30))
+LLM_STUB_LATENCY = float(os.environ.get('LLM_STUB_LATENCY', 0.5))
+# ذاكرة ردود المساعد القانوني: مدة الصلاحية بالثواني والحد الأقصى لعدد الردود
+LEGAL_AI_CACHE_TTL = int(os.environ.get('LEGAL_AI_CACHE_TTL', 7 * 24 * 3600))
+LEGAL_AI_CACHE_MAX_ENTRIES = int(os.environ.get('LEGAL_AI_CACHE_MAX_ENTRIES', 5000))
+
+# حدود رفع الملفات في طلبات الزوار (بدون تسجيل دخول)
+GUEST_UPLOAD_MAX_FILE_SIZE = int(os.environ.get('GUEST_UPLOAD_MAX_FILE_SIZE', 10 * 1024 * 1024))
+GUEST_UPLOAD_MAX_REQUEST_SIZE = int(os.environ.get('GUEST_UPLOAD_MAX_REQUEST_SIZE', 25 * 1024 * 1024))
+# الحقول النصية: حد لكل حقل، وهامش إضافي لمجموعها مع ترويسات multipart فوق حد الملفات
+GUEST_FORM_FIELD_MAX_SIZE = 64 * 1024
+GUEST_FORM_MAX_FIELDS_SIZE = 512 * 1024
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -147,6 +252,390 @@ async def log_action(action_type: str, entity_type: str, entity_id: str, user_id
     doc['created_at'] = doc['created_at'].isoformat()
     await db.audit_logs.insert_one(doc)
 
+# ==================== مخزن الملفات (GridFS / القرص المحلي) ====================
+
+class GridFSBlobStore:
+    """تخزين الملفات في GridFS على شكل أجزاء"""
+    
+    def __init__(self, database):
+        self.bucket = AsyncIOMotorGridFSBucket(database, bucket_name="blobs", chunk_size_bytes=BLOB_CHUNK_SIZE)
+    
+    async def put(self, data: bytes, filename: str, content_type: str) -> str:
+        blob_id = str(uuid.uuid4())
+        await self.bucket.upload_from_stream_with_id(
+            blob_id, filename, data, metadata={"content_type": content_type}
+        )
+        return blob_id
+    
+    async def put_stream(self, chunks, filename: str, content_type: str) -> str:
+        """رفع ملف من مولد أجزاء غير متزامن دون تجميعه في الذاكرة"""
+        blob_id = str(uuid.uuid4())
+        grid_in = self.bucket.open_upload_stream_with_id(
+            blob_id, filename, metadata={"content_type": content_type}
+        )
+        try:
+            async for chunk in chunks:
+                await grid_in.write(chunk)
+        except BaseException:
+            await grid_in.abort()
+            raise
+        await grid_in.close()
+        return blob_id
+    
+    async def stream(self, blob_id: str, start: int = 0, length: Optional[int] = None):
+        try:
+            grid_out = await self.bucket.open_download_stream(blob_id)
+        except NoFile:
+            raise FileNotFoundError(blob_id)
+        if start:
+            grid_out.seek(start)
+        remaining = length
+        while remaining is None or remaining > 0:
+            chunk = await grid_out.readchunk()
+            if not chunk:
+                break
+            if remaining is not None:
+                chunk = chunk[:remaining]
+                remaining -= len(chunk)
+            yield chunk
+    
+    async def delete(self, blob_id: str):
+        try:
+            await self.bucket.delete(blob_id)
+        except NoFile:
+            pass
+
+class LocalBlobStore:
+    """تخزين الملفات على القرص المحلي (للتطوير أو الخوادم ذات القرص الدائم)"""
+    
+    def __init__(self, root: Path):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+    
+    def _path(self, blob_id: str) -> Path:
+        if not re.fullmatch(r"[0-9a-fA-F-]{8,64}", blob_id):
+            raise FileNotFoundError(blob_id)
+        return self.root / blob_id[:2] / blob_id
+    
+    def _write(self, path: Path, data: bytes):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+    
+    async def put(self, data: bytes, filename: str, content_type: str) -> str:
+        blob_id = str(uuid.uuid4())
+        await asyncio.get_running_loop().run_in_executor(None, self._write, self._path(blob_id), data)
+        return blob_id
+    
+    async def put_stream(self, chunks, filename: str, content_type: str) -> str:
+        """رفع ملف من مولد أجزاء غير متزامن دون تجميعه في الذاكرة"""
+        blob_id = str(uuid.uuid4())
+        path = self._path(blob_id)
+        tmp_path = path.with_suffix(".tmp")
+        loop = asyncio.get_running_loop()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        f = await loop.run_in_executor(None, open, tmp_path, "wb")
+        try:
+            async for chunk in chunks:
+                await loop.run_in_executor(None, f.write, chunk)
+        except BaseException:
+            f.close()
+            tmp_path.unlink(missing_ok=True)
+            raise
+        f.close()
+        os.replace(tmp_path, path)
+        return blob_id
+    
+    async def stream(self, blob_id: str, start: int = 0, length: Optional[int] = None):
+        path = self._path(blob_id)
+        loop = asyncio.get_running_loop()
+        f = await loop.run_in_executor(None, open, path, "rb")
+        try:
+            if start:
+                f.seek(start)
+            remaining = length
+            while remaining is None or remaining > 0:
+                size = BLOB_CHUNK_SIZE if remaining is None else min(BLOB_CHUNK_SIZE, remaining)
+                chunk = await loop.run_in_executor(None, f.read, size)
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+        finally:
+            f.close()
+    
+    async def delete(self, blob_id: str):
+        try:
+            self._path(blob_id).unlink()
+        except FileNotFoundError:
+            pass
+
+blob_store = LocalBlobStore(BLOB_STORE_PATH) if BLOB_STORE_BACKEND == "local" else GridFSBlobStore(db)
+
+async def read_blob(blob_id: str) -> bytes:
+    """قراءة ملف كامل من المخزن (للمرفقات الصغيرة مثل مرفقات SMTP)"""
+    return b"".join([chunk async for chunk in blob_store.stream(blob_id)])
+
+# المحتوى يُخزن مرة واحدة لكل بصمة SHA-256 في attachment_blobs مع عداد مراجع،
+# والكيانات (الطلبات، المهام، التحديثات، البريد) تحفظ المراجع فقط
+
+async def register_blob(sha256: str, blob_id: str, size: int, content_type: str) -> str:
+    """ربط ملف مرفوع ببصمته؛ إذا كان المحتوى موجوداً يُحذف الملف الجديد ويُعاد الموجود"""
+    existing = await db.attachment_blobs.find_one_and_update(
+        {"_id": sha256}, {"$inc": {"ref_count": 1}}, projection={"blob_id": 1}
+    )
+    if existing:
+        await blob_store.delete(blob_id)
+        return existing["blob_id"]
+    try:
+        await db.attachment_blobs.insert_one({
+            "_id": sha256,
+            "blob_id": blob_id,
+            "size": size,
+            "content_type": content_type,
+            "ref_count": 1,
+            "created_at": datetime.now(timezone.utc).isoformat()
+        })
+        return blob_id
+    except DuplicateKeyError:
+        # رفع نفس المحتوى بالتزامن من طلب آخر
+        return await register_blob(sha256, blob_id, size, content_type)
+
+async def retain_attachments(attachments: list):
+    """زيادة عداد المراجع عند نسخ مرفقات إلى كيان آخر (بدون نسخ أي بايت)"""
+    operations = [
+        UpdateOne({"_id": att["sha256"]}, {"$inc": {"ref_count": 1}})
+        for att in attachments or [] if att.get("sha256")
+    ]
+    if operations:
+        await db.attachment_blobs.bulk_write(operations, ordered=False)
+
+async def release_attachments(attachments: list):
+    """إنقاص عداد المراجع وحذف المحتوى عند عدم وجود أي مرجع له"""
+    for att in attachments or []:
+        if not att.get("sha256"):
+            continue
+        blob = await db.attachment_blobs.find_one_and_update(
+            {"_id": att["sha256"]},
+            {"$inc": {"ref_count": -1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if blob and blob["ref_count"] <= 0:
+            result = await db.attachment_blobs.delete_one({"_id": att["sha256"], "ref_count": {"$lte": 0}})
+            if result.deleted_count:
+                await blob_store.delete(blob["blob_id"])
+
+async def store_attachment(content: bytes, name: str, content_type: str) -> dict:
+    """حفظ محتوى مرفق في المخزن (أو إعادة استخدام المحتوى المطابق) وإرجاع المرجع فقط"""
+    sha256 = hashlib.sha256(content).hexdigest()
+    existing = await db.attachment_blobs.find_one_and_update(
+        {"_id": sha256}, {"$inc": {"ref_count": 1}}, projection={"blob_id": 1}
+    )
+    if existing:
+        blob_id = existing["blob_id"]
+    else:
+        blob_id = await blob_store.put(content, name, content_type)
+        blob_id = await register_blob(sha256, blob_id, len(content), content_type)
+    return {
+        "id": str(uuid.uuid4()),
+        "blob_id": blob_id,
+        "sha256": sha256,
+        "name": name,
+        "type": content_type,
+        "size": len(content)
+    }
+
+class StreamingMultipartReader:
+    """قراءة multipart/form-data مباشرة من request.stream() بدلاً من تخزين الطلب كاملاً على القرص أولاً
+    
+    حد الحجم الكلي وعدد الأجزاء يُفرضان أثناء وصول البايتات، حتى مع Transfer-Encoding: chunked
+    """
+    
+    def __init__(self, request: Request, max_size: int, max_parts: int):
+        content_type, params = parse_options_header(request.headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or not params.get(b"boundary"):
+            raise HTTPException(status_code=415, detail="يجب إرسال الطلب بصيغة multipart/form-data")
+        self._body = request.stream().__aiter__()
+        self._max_size = max_size
+        self._max_parts = max_parts
+        self._received = 0
+        self._part_count = 0
+        self._finished = False
+        self._events = deque()
+        self._headers = {}
+        self._header_name = b""
+        self._header_value = b""
+        self._parser = MultipartParser(params[b"boundary"], callbacks={
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": lambda: self._events.append(("part", self._headers)),
+            "on_part_data": lambda data, start, end: self._events.append(("data", data[start:end])),
+            "on_part_end": lambda: self._events.append(("part_end", None)),
+        })
+    
+    def _on_part_begin(self):
+        self._headers = {}
+    
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_name += data[start:end]
+    
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+    
+    def _on_header_end(self):
+        self._headers[self._header_name.lower()] = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+    
+    async def _next_event(self):
+        while not self._events:
+            if self._finished:
+                return None
+            try:
+                chunk = await self._body.__anext__()
+            except StopAsyncIteration:
+                self._finished = True
+                self._parser.finalize()
+                continue
+            self._received += len(chunk)
+            if self._received > self._max_size:
+                raise HTTPException(status_code=413, detail="إجمالي حجم الملفات يتجاوز الحد المسموح")
+            try:
+                self._parser.write(chunk)
+            except MultipartParseError:
+                raise HTTPException(status_code=400, detail="صيغة الطلب غير صالحة")
+        return self._events.popleft()
+    
+    async def parts(self):
+        """(اسم الحقل، اسم الملف أو None، نوع المحتوى) لكل جزء؛ بيانات الجزء غير المقروءة تُتجاهل"""
+        while (event := await self._next_event()) is not None:
+            if event[0] != "part":
+                continue
+            self._part_count += 1
+            if self._part_count > self._max_parts:
+                raise HTTPException(status_code=413, detail="عدد الحقول يتجاوز الحد المسموح")
+            _, options = parse_options_header(event[1].get(b"content-disposition", b""))
+            filename = options.get(b"filename")
+            yield (
+                options.get(b"name", b"").decode("utf-8", errors="replace"),
+                filename.decode("utf-8", errors="replace") if filename is not None else None,
+                event[1].get(b"content-type", b"").decode("latin-1") or None
+            )
+    
+    async def data(self):
+        """بيانات الجزء الحالي كما تصل"""
+        while True:
+            event = await self._next_event()
+            if event is None:
+                raise HTTPException(status_code=400, detail="الطلب غير مكتمل")
+            if event[0] == "part_end":
+                return
+            yield event[1]
+    
+    async def read_field(self, max_size: int) -> str:
+        value = bytearray()
+        async for chunk in self.data():
+            value += chunk
+            if len(value) > max_size:
+                raise HTTPException(status_code=413, detail="حجم الحقل يتجاوز الحد المسموح")
+        return value.decode("utf-8", errors="replace")
+
+async def store_upload(chunks, filename: str, content_type: str, max_size: int, remaining: int) -> dict:
+    """رفع ملف من مولد أجزاء إلى المخزن مع فرض حدود الحجم أثناء القراءة"""
+    size = 0
+    digest = hashlib.sha256()
+    
+    async def checked_chunks():
+        nonlocal size
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > max_size:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"حجم الملف {filename} يتجاوز الحد المسموح ({max_size // (1024 * 1024)} ميجابايت)"
+                )
+            if size > remaining:
+                raise HTTPException(status_code=413, detail="إجمالي حجم الملفات يتجاوز الحد المسموح")
+            digest.update(chunk)
+            yield chunk
+    
+    blob_id = await blob_store.put_stream(checked_chunks(), filename, content_type)
+    sha256 = digest.hexdigest()
+    blob_id = await register_blob(sha256, blob_id, size, content_type)
+    return {
+        "id": str(uuid.uuid4()),
+        "blob_id": blob_id,
+        "sha256": sha256,
+        "filename": filename,
+        "content_type": content_type,
+        "size": size
+    }
+
+async def resolve_attachment_ref(att: dict, retain: bool = True) -> dict:
+    """بناء مرجع مرفق مخزن من attachment_blobs بدلاً من الثقة بالحقول الواردة"""
+    sha256 = att.get("sha256")
+    if not isinstance(sha256, str):
+        raise HTTPException(status_code=400, detail="مرجع مرفق غير صالح")
+    if retain:
+        blob = await db.attachment_blobs.find_one_and_update(
+            {"_id": sha256, "ref_count": {"$gt": 0}}, {"$inc": {"ref_count": 1}}
+        )
+    else:
+        blob = await db.attachment_blobs.find_one({"_id": sha256})
+    if not blob:
+        raise HTTPException(status_code=400, detail="المرفق غير موجود")
+    return {
+        "id": att.get("id") or str(uuid.uuid4()),
+        "blob_id": blob["blob_id"],
+        "sha256": sha256,
+        "name": str(att.get("name") or "attachment"),
+        "type": blob["content_type"],
+        "size": blob["size"]
+    }
+
+async def store_inline_attachments(
+    attachments: list,
+    retain_existing: bool = True,
+    accept_refs: bool = False,
+    allowed_refs: Optional[set] = None
+) -> list:
+    """تحويل المرفقات المضمنة بصيغة base64 إلى مراجع
+    
+    المراجع لمرفقات مخزنة مسبقاً تُقبل من مسارات النسخ داخل الخادم (accept_refs)، أو من المستخدم
+    إذا كانت بصمتها ضمن allowed_refs (مرفقات مصدر يملك صلاحية قراءته)، وتُعاد بناؤها من attachment_blobs
+    """
+    stored = []
+    retained = []
+    try:
+        for att in attachments or []:
+            if att.get("data") and not att.get("blob_id"):
+                content = base64.b64decode(att["data"])
+                ref = await store_attachment(
+                    content,
+                    att.get("name", "attachment"),
+                    att.get("type") or "application/octet-stream"
+                )
+                retained.append(ref)
+            elif not accept_refs and att.get("sha256") not in (allowed_refs or ()):
+                raise HTTPException(status_code=400, detail="يجب إرسال محتوى المرفق")
+            elif not att.get("sha256"):
+                # مراجع قديمة بدون بصمة (قبل إزالة التكرار) تُنسخ كما هي دون عداد
+                ref = {key: value for key, value in att.items() if key != "data"}
+            else:
+                ref = await resolve_attachment_ref(att, retain=retain_existing)
+                if retain_existing:
+                    retained.append(ref)
+            stored.append(ref)
+    except Exception:
+        # لا نترك عدادات مراجع محجوزة لطلب فشل
+        await release_attachments(retained)
+        raise
+    return stored
+
 class UserRole:
     ADMIN = "admin"
     LAWYER = "lawyer"
@@ -1013,7 +1502,7 @@ class InternalEmail(BaseModel):
     body_html: Optional[str] = None
     
     # المرفقات
-    attachments: List[dict] = []  # [{name, type, size, data}]
+    attachments: List[dict] = []  # [{id, blob_id, name, type, size}]
     
     # ربط بالمهام
     related_task_id: Optional[str] = None
@@ -1068,6 +1557,8 @@ class EmailCompose(BaseModel):
     is_reply: bool = False
     is_forwarded: bool = False
     save_as_draft: bool = False
+    # بريد يمكن إعادة استخدام مرفقاته كمراجع (sha256) بدون رفع محتواها مرة أخرى
+    source_email_id: Optional[str] = None
 
 class EmailUpdate(BaseModel):
     """تحديث بريد"""
@@ -1764,47 +2255,75 @@ async def create_guest_consultation(consultation_input: GuestConsultationCreate)
     await db.guest_consultations.insert_one(doc)
     return cons_obj
 
+# API لطلبات خدمات الموثق من الزوار (بدون تسجيل دخول)
+# حقول طلب الموثق النصية (None = إلزامي) وحقول الملفات المقبولة
+GUEST_NOTARY_FIELDS = {
+    "client_name": None,
+    "phone": None,
+    "subject": None,
+    "description": None,
+    "client_requests": "",
+    "request_type": "notary",
+    "service_type": "خدمات الموثق",
+}
+GUEST_NOTARY_FILE_FIELDS = ("file_0", "file_1", "file_2", "file_3", "file_4")
+
 # API لطلبات خدمات الموثق من الزوار (بدون تسجيل دخول)
 @api_router.post("/guest-notary-request")
-async def create_guest_notary_request(
-    client_name: str = Form(...),
-    phone: str = Form(...),
-    subject: str = Form(...),
-    description: str = Form(...),
-    client_requests: str = Form(""),
-    request_type: str = Form("notary"),
-    service_type: str = Form("خدمات الموثق"),
-    file_0: Optional[UploadFile] = File(None),
-    file_1: Optional[UploadFile] = File(None),
-    file_2: Optional[UploadFile] = File(None),
-    file_3: Optional[UploadFile] = File(None),
-    file_4: Optional[UploadFile] = File(None),
-):
-    # جمع الملفات المرفقة
+async def create_guest_notary_request(request: Request):
+    # رفض الطلبات الكبيرة مبكراً من Content-Length قبل قراءة أي ملف
+    max_request_size = GUEST_UPLOAD_MAX_REQUEST_SIZE + GUEST_FORM_MAX_FIELDS_SIZE
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_request_size:
+        raise HTTPException(status_code=413, detail="إجمالي حجم الملفات يتجاوز الحد المسموح")
+    
+    # الطلب يُقرأ كتدفق (وليس عبر Form/File) حتى تُطبق الحدود أثناء وصول البايتات،
+    # والملفات تُرفع إلى مخزن الملفات مباشرة والطلب يحفظ المراجع فقط
+    reader = StreamingMultipartReader(
+        request, max_request_size, len(GUEST_NOTARY_FIELDS) + len(GUEST_NOTARY_FILE_FIELDS)
+    )
+    fields = {}
     files_data = []
-    for file in [file_0, file_1, file_2, file_3, file_4]:
-        if file and file.filename:
-            content = await file.read()
-            # تحويل الملف لـ base64 للتخزين
-            file_data = {
-                "filename": file.filename,
-                "content_type": file.content_type,
-                "size": len(content),
-                "data": base64.b64encode(content).decode('utf-8')
-            }
-            files_data.append(file_data)
+    seen_files = set()
+    total_size = 0
+    try:
+        async for name, filename, content_type in reader.parts():
+            if filename is None:
+                if name in GUEST_NOTARY_FIELDS:
+                    fields[name] = await reader.read_field(GUEST_FORM_FIELD_MAX_SIZE)
+            elif filename and name in GUEST_NOTARY_FILE_FIELDS and name not in seen_files:
+                seen_files.add(name)
+                file_data = await store_upload(
+                    reader.data(),
+                    filename,
+                    content_type or "application/octet-stream",
+                    GUEST_UPLOAD_MAX_FILE_SIZE,
+                    GUEST_UPLOAD_MAX_REQUEST_SIZE - total_size
+                )
+                total_size += file_data["size"]
+                files_data.append(file_data)
+        
+        missing = [name for name, default in GUEST_NOTARY_FIELDS.items() if default is None and name not in fields]
+        if missing:
+            raise HTTPException(status_code=422, detail=f"حقول مطلوبة: {', '.join(missing)}")
+    except Exception:
+        # حذف ما تم رفعه من ملفات هذا الطلب
+        await release_attachments(files_data)
+        raise
+    for name, default in GUEST_NOTARY_FIELDS.items():
+        fields.setdefault(name, default)
     
     # إنشاء الطلب
     request_id = str(uuid.uuid4())
     notary_request = {
         "id": request_id,
-        "client_name": client_name,
-        "phone": phone,
-        "subject": subject,
-        "description": description,
-        "client_requests": client_requests,
-        "request_type": request_type,
-        "service_type": service_type,
+        "client_name": fields["client_name"],
+        "phone": fields["phone"],
+        "subject": fields["subject"],
+        "description": fields["description"],
+        "client_requests": fields["client_requests"],
+        "request_type": fields["request_type"],
+        "service_type": fields["service_type"],
         "files": files_data,
         "status": "pending",
         "created_at": datetime.now(timezone.utc).isoformat(),
@@ -2331,21 +2850,120 @@ async def get_vouchers(current_user: User = Depends(get_current_user)):
 
 # ==================== PDF Generation ====================
 
+# ==================== موارد PDF المشتركة على مستوى العملية ====================
+
+PDF_FONTS_DIR = ROOT_DIR / "fonts"
+PDF_LOGO_PATH = PDF_FONTS_DIR / "logo.jpg"
+PDF_FONTS = [
+    ("NotoArabic", "", PDF_FONTS_DIR / "NotoSansArabic-Regular.ttf"),
+    ("NotoArabic", "B", PDF_FONTS_DIR / "NotoSansArabic-Bold.ttf"),
+]
+
+# الخطوط والصور تُحلل مرة واحدة لكل عملية وتُشارك بين كل ملفات PDF
+_pdf_font_cache = {}
+_pdf_image_cache = {}
+_pdf_resource_lock = threading.Lock()
+
+def load_pdf_font(family: str, style: str, path: Path):
+    """تحليل ملف الخط مرة واحدة وإرجاع (نموذج TTFFont، بايتات الملف)"""
+    key = (family, style, str(path))
+    cached = _pdf_font_cache.get(key)
+    if cached is None:
+        with _pdf_resource_lock:
+            cached = _pdf_font_cache.get(key)
+            if cached is None:
+                font_bytes = path.read_bytes()
+                prototype = TTFFont(FPDF(), path, f"{family.lower()}{style}", style)
+                cached = _pdf_font_cache[key] = (prototype, font_bytes)
+    return cached
+
+def load_pdf_image(path: Path) -> dict:
+    """قراءة بيانات الصورة (الشعار) مرة واحدة لكل عملية"""
+    key = str(path)
+    info = _pdf_image_cache.get(key)
+    if info is None:
+        with _pdf_resource_lock:
+            info = _pdf_image_cache.get(key)
+            if info is None:
+                info = _pdf_image_cache[key] = get_img_info(key)
+    return info
+
+def preload_pdf_resources():
+    """تحميل موارد PDF مسبقاً (عند بدء التشغيل أو في عمال المعالجة)"""
+    for family, style, path in PDF_FONTS:
+        load_pdf_font(family, style, path)
+    if PDF_LOGO_PATH.exists():
+        load_pdf_image(PDF_LOGO_PATH)
+
+arabic_text_reshaper = arabic_reshaper.ArabicReshaper()
+# المكتبة تتحقق من '__ligatures_re' بدون تشويه الاسم فتعيد بناء تعبير الربط (وقراءة الإعدادات) في كل استدعاء؛
+# تثبيت الخاصية يجعلها تُبنى مرة واحدة
+setattr(arabic_text_reshaper, '__ligatures_re', arabic_text_reshaper._ligatures_re)
+
+@functools.lru_cache(maxsize=ARABIC_SHAPING_CACHE_SIZE)
+def shape_arabic(text: str) -> str:
+    """تشكيل النص العربي وترتيبه للعرض مع ذاكرة محدودة للنصوص المتكررة"""
+    return get_display(arabic_text_reshaper.reshape(text))
+
+# نصوص ثابتة في كل ملف تُشكّل مرة واحدة عند التحميل
+PDF_FIRM_NAME = shape_arabic("مجموعة المحامي هشام يوسف الخياط")
+PDF_FIRM_TAGLINE = shape_arabic("للمحاماة والاستشارات القانونية")
+PDF_FIRM_ADDRESS = shape_arabic("جدة - حي الحمراء - شارع الشانزلزيه")
+PDF_FIRM_PHONE = shape_arabic("جوال: 0597771616")
+PDF_FOOTER_TEXT = shape_arabic("مجموعة المحامي هشام يوسف الخياط للمحاماة والاستشارات القانونية")
+
 class ArabicPDF(FPDF):
     """كلاس PDF مخصص لدعم اللغة العربية"""
     
     def __init__(self):
         super().__init__()
-        # تحميل الخطوط العربية
-        fonts_dir = ROOT_DIR / "fonts"
-        self.add_font("NotoArabic", "", str(fonts_dir / "NotoSansArabic-Regular.ttf"))
-        self.add_font("NotoArabic", "B", str(fonts_dir / "NotoSansArabic-Bold.ttf"))
+        # تحميل الخطوط العربية من الذاكرة المشتركة
+        for family, style, path in PDF_FONTS:
+            self.add_cached_font(family, style, path)
+    
+    def add_cached_font(self, family: str, style: str, path: Path):
+        """إضافة خط محلل مسبقاً؛ الحالة الخاصة بالمستند (الترقيم والتجزئة) تُنشأ من جديد"""
+        prototype, font_bytes = load_pdf_font(family, style, path)
+        font = copy.copy(prototype)
+        font.i = len(self.fonts) + 1
+        # الإخراج يجزئ ttfont في مكانه، لذا لكل مستند نسخة كسولة من البايتات المخزنة
+        font.ttfont = TTFont(BytesIO(font_bytes), recalcTimestamp=False, fontNumber=0, lazy=True)
+        font.subset = SubsetMap(font)
+        font.missing_glyphs = []
+        font.biggest_size_pt = 0
+        self.fonts[font.fontkey] = font
+    
+    def cached_image(self, path: Path, **kwargs):
+        """إدراج صورة من الذاكرة المشتركة بدلاً من قراءتها وتحليلها في كل مستند"""
+        name = str(path)
+        if name not in self.image_cache.images:
+            info = copy.copy(load_pdf_image(path))
+            info["i"] = len(self.image_cache.images) + 1
+            info["usages"] = 0
+            info["iccp_i"] = None
+            iccp = info.get("iccp")
+            if iccp:
+                icc_profiles = self.image_cache.icc_profiles
+                info["iccp_i"] = icc_profiles.setdefault(iccp, len(icc_profiles))
+            info["iccp"] = None
+            self.image_cache.images[name] = info
+        return self.image(name, **kwargs)
         
     def arabic_text(self, text):
         """تحويل النص العربي للعرض الصحيح"""
-        reshaped_text = arabic_reshaper.reshape(text)
-        bidi_text = get_display(reshaped_text)
-        return bidi_text
+        return shape_arabic(text)
+    
+    def firm_header(self):
+        """اسم المكتب وعنوانه (نصوص مشكّلة مسبقاً)"""
+        self.set_font("NotoArabic", "B", 16)
+        self.cell(0, 10, PDF_FIRM_NAME, align="C", new_x="LMARGIN", new_y="NEXT")
+        self.set_font("NotoArabic", "", 12)
+        self.cell(0, 8, PDF_FIRM_TAGLINE, align="C", new_x="LMARGIN", new_y="NEXT")
+        
+        # العنوان
+        self.set_font("NotoArabic", "", 10)
+        self.cell(0, 8, PDF_FIRM_ADDRESS, align="C", new_x="LMARGIN", new_y="NEXT")
+        self.cell(0, 8, PDF_FIRM_PHONE, align="C", new_x="LMARGIN", new_y="NEXT")
     
     def header(self):
         pass
@@ -2353,7 +2971,7 @@ class ArabicPDF(FPDF):
     def footer(self):
         self.set_y(-15)
         self.set_font("NotoArabic", "", 8)
-        self.cell(0, 10, self.arabic_text("مجموعة المحامي هشام يوسف الخياط للمحاماة والاستشارات القانونية"), align="C")
+        self.cell(0, 10, PDF_FOOTER_TEXT, align="C")
 
 def create_invoice_pdf(invoice: dict) -> BytesIO:
     """إنشاء ملف PDF للفاتورة"""
@@ -2361,22 +2979,13 @@ def create_invoice_pdf(invoice: dict) -> BytesIO:
     pdf.add_page()
     
     # الشعار والترويسة
-    logo_path = ROOT_DIR / "fonts" / "logo.jpg"
-    if logo_path.exists():
-        pdf.image(str(logo_path), x=80, y=10, w=50)
+    if PDF_LOGO_PATH.exists():
+        pdf.cached_image(PDF_LOGO_PATH, x=80, y=10, w=50)
     
     pdf.set_y(70)
     
-    # اسم الشركة
-    pdf.set_font("NotoArabic", "B", 16)
-    pdf.cell(0, 10, pdf.arabic_text("مجموعة المحامي هشام يوسف الخياط"), align="C", new_x="LMARGIN", new_y="NEXT")
-    pdf.set_font("NotoArabic", "", 12)
-    pdf.cell(0, 8, pdf.arabic_text("للمحاماة والاستشارات القانونية"), align="C", new_x="LMARGIN", new_y="NEXT")
-    
-    # العنوان
-    pdf.set_font("NotoArabic", "", 10)
-    pdf.cell(0, 8, pdf.arabic_text("جدة - حي الحمراء - شارع الشانزلزيه"), align="C", new_x="LMARGIN", new_y="NEXT")
-    pdf.cell(0, 8, pdf.arabic_text("جوال: 0597771616"), align="C", new_x="LMARGIN", new_y="NEXT")
+    # اسم الشركة والعنوان
+    pdf.firm_header()
     
     # خط فاصل
     pdf.ln(5)
@@ -2397,7 +3006,13 @@ def create_invoice_pdf(invoice: dict) -> BytesIO:
     
     # رقم الفاتورة والتاريخ
     pdf.set_fill_color(249, 249, 247)
-    pdf.cell(95, 10, pdf.arabic_text(f"تاريخ الإصدار: {datetime.now().strftime('%Y-%m-%d')}"), fill=True, align="R")
+    # تاريخ الإصدار هو تاريخ إنشاء الفاتورة حتى يبقى الملف ثابتاً بين التنزيلات
+    issued_at = invoice.get('created_at') or datetime.now()
+    if isinstance(issued_at, datetime):
+        issued_at = issued_at.strftime('%Y-%m-%d')
+    elif isinstance(issued_at, str) and 'T' in issued_at:
+        issued_at = issued_at.split('T')[0]
+    pdf.cell(95, 10, pdf.arabic_text(f"تاريخ الإصدار: {issued_at}"), fill=True, align="R")
     pdf.cell(95, 10, pdf.arabic_text(f"رقم الفاتورة: {invoice.get('invoice_number', '')}"), fill=True, align="R", new_x="LMARGIN", new_y="NEXT")
     pdf.ln(5)
     
@@ -2452,22 +3067,13 @@ def create_voucher_pdf(voucher: dict) -> BytesIO:
     pdf.add_page()
     
     # الشعار والترويسة
-    logo_path = ROOT_DIR / "fonts" / "logo.jpg"
-    if logo_path.exists():
-        pdf.image(str(logo_path), x=80, y=10, w=50)
+    if PDF_LOGO_PATH.exists():
+        pdf.cached_image(PDF_LOGO_PATH, x=80, y=10, w=50)
     
     pdf.set_y(70)
     
-    # اسم الشركة
-    pdf.set_font("NotoArabic", "B", 16)
-    pdf.cell(0, 10, pdf.arabic_text("مجموعة المحامي هشام يوسف الخياط"), align="C", new_x="LMARGIN", new_y="NEXT")
-    pdf.set_font("NotoArabic", "", 12)
-    pdf.cell(0, 8, pdf.arabic_text("للمحاماة والاستشارات القانونية"), align="C", new_x="LMARGIN", new_y="NEXT")
-    
-    # العنوان
-    pdf.set_font("NotoArabic", "", 10)
-    pdf.cell(0, 8, pdf.arabic_text("جدة - حي الحمراء - شارع الشانزلزيه"), align="C", new_x="LMARGIN", new_y="NEXT")
-    pdf.cell(0, 8, pdf.arabic_text("جوال: 0597771616"), align="C", new_x="LMARGIN", new_y="NEXT")
+    # اسم الشركة والعنوان
+    pdf.firm_header()
     
     # خط فاصل
     pdf.ln(5)
@@ -2559,8 +3165,191 @@ def create_voucher_pdf(voucher: dict) -> BytesIO:
     output.seek(0)
     return output
 
+# ==================== توليد PDF في مجمع عمليات ====================
+
+def create_manual_pdf(data: dict) -> BytesIO:
+    """كتيب المستخدم (يُولّد في عامل PDF لأنه أثقل من الفواتير)"""
+    return BytesIO(build_manual(PDF_FONTS_DIR))
+
+PDF_RENDERERS = {
+    "invoice": create_invoice_pdf,
+    "voucher": create_voucher_pdf,
+    "manual": create_manual_pdf,
+}
+
+_pdf_executor: Optional[ProcessPoolExecutor] = None
+# حد أقصى للمهام الجارية والمنتظرة حتى لا تتراكم الطلبات عند الضغط
+pdf_render_slots = asyncio.Semaphore(PDF_QUEUE_LIMIT)
+
+def render_pdf_job(kind: str, data: dict) -> bytes:
+    """تُنفذ داخل عملية العامل وتعيد بايتات الملف"""
+    return PDF_RENDERERS[kind](data).getvalue()
+
+def get_pdf_executor() -> Optional[ProcessPoolExecutor]:
+    global _pdf_executor
+    if _pdf_executor is None and PDF_WORKERS > 0:
+        # spawn بدلاً من fork لأن العملية الرئيسية تحمل خيوط Motor وحلقة asyncio
+        _pdf_executor = ProcessPoolExecutor(
+            max_workers=PDF_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=preload_pdf_resources
+        )
+    return _pdf_executor
+
+def shutdown_pdf_executor():
+    global _pdf_executor
+    if _pdf_executor is not None:
+        _pdf_executor.shutdown(wait=False, cancel_futures=True)
+        _pdf_executor = None
+
+async def warm_pdf_executor():
+    """تشغيل العمال مسبقاً وتحميل الخطوط فيها قبل أول طلب"""
+    executor = get_pdf_executor()
+    if executor is None:
+        return
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(
+        *[loop.run_in_executor(executor, preload_pdf_resources) for _ in range(PDF_WORKERS)],
+        return_exceptions=True
+    )
+
+async def render_pdf(kind: str, data: dict, wait: bool = False) -> bytes:
+    """توليد PDF خارج حلقة الأحداث مع حد للطابور ومهلة لكل مهمة (wait للتصدير الجماعي بدلاً من الرفض)"""
+    if not wait and pdf_render_slots.locked():
+        raise HTTPException(status_code=503, detail="خدمة توليد الملفات مشغولة، حاول مرة أخرى")
+    
+    await pdf_render_slots.acquire()
+    loop = asyncio.get_running_loop()
+    try:
+        future = loop.run_in_executor(get_pdf_executor(), render_pdf_job, kind, data)
+    except BaseException:
+        pdf_render_slots.release()
+        raise
+    # المهمة تستمر في العامل بعد انتهاء المهلة، لذا لا يُحرر المكان إلا عند انتهائها فعلاً
+    future.add_done_callback(release_pdf_render_slot)
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), timeout=PDF_RENDER_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error(f"PDF render timed out ({kind})")
+        raise HTTPException(status_code=504, detail="انتهت مهلة توليد الملف")
+    except BrokenProcessPool:
+        # عامل توقف بشكل غير متوقع: إعادة إنشاء المجمع للطلبات التالية
+        logger.error("PDF process pool broken, restarting")
+        shutdown_pdf_executor()
+        raise HTTPException(status_code=503, detail="تعذر توليد الملف، حاول مرة أخرى")
+
+def release_pdf_render_slot(future: asyncio.Future):
+    pdf_render_slots.release()
+    if not future.cancelled() and future.exception() is not None:
+        # قراءة الخطأ تمنع تحذير "exception was never retrieved" بعد انتهاء المهلة
+        logger.debug(f"PDF render finished with error: {future.exception()!r}")
+
+# ==================== تخزين ملفات PDF حسب المحتوى ====================
+
+# رفع الإصدار عند أي تعديل على قالب الفاتورة أو السند يبطل كل النسخ المخزنة
+PDF_TEMPLATE_VERSIONS = {"invoice": 1, "voucher": 1}
+
+# الحقول التي يعتمد عليها كل قالب؛ أي تغيير فيها ينتج مفتاحاً جديداً
+PDF_TEMPLATE_FIELDS = {
+    "invoice": ["invoice_number", "client_name", "description", "amount", "status", "due_date", "created_at"],
+    "voucher": ["voucher_number", "voucher_type", "client_name", "payment_method", "description",
+                "amount", "created_by_name", "created_at"],
+}
+
+def pdf_template_fields(kind: str, doc: dict) -> dict:
+    """استخراج حقول القالب فقط مع توحيد صيغة التواريخ"""
+    fields = {}
+    for key in PDF_TEMPLATE_FIELDS[kind]:
+        value = doc.get(key)
+        if isinstance(value, datetime):
+            value = value.strftime('%Y-%m-%d')
+        elif key in ("due_date", "created_at") and isinstance(value, str):
+            value = value.split('T')[0]
+        fields[key] = value
+    return fields
+
+def pdf_cache_key(kind: str, fields: dict) -> str:
+    payload = json.dumps(
+        {"kind": kind, "version": PDF_TEMPLATE_VERSIONS[kind], "fields": fields},
+        sort_keys=True, ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+async def purge_pdf_cache(kind: str, entity_id: str, keep_key: Optional[str] = None):
+    """حذف النسخ المخزنة القديمة لفاتورة أو سند"""
+    query = {"kind": kind, "entity_id": entity_id}
+    if keep_key:
+        query["_id"] = {"$ne": keep_key}
+    stale = await db.pdf_cache.find(query, {"blob_id": 1}).to_list(None)
+    if stale:
+        await db.pdf_cache.delete_many({"_id": {"$in": [entry["_id"] for entry in stale]}})
+        for entry in stale:
+            await blob_store.delete(entry["blob_id"])
+
+async def store_cached_pdf(kind: str, entity_id: str, key: str, pdf_content: bytes):
+    """حفظ ملف PDF المولّد في المخزن وحذف النسخ القديمة لنفس الكيان"""
+    blob_id = await blob_store.put(pdf_content, f"{kind}_{entity_id}.pdf", "application/pdf")
+    try:
+        await db.pdf_cache.insert_one({
+            "_id": key,
+            "kind": kind,
+            "entity_id": entity_id,
+            "blob_id": blob_id,
+            "size": len(pdf_content),
+            "created_at": datetime.now(timezone.utc).isoformat()
+        })
+    except DuplicateKeyError:
+        # طلب متزامن خزّن نفس الملف
+        await blob_store.delete(blob_id)
+    await purge_pdf_cache(kind, entity_id, keep_key=key)
+
+async def get_pdf_bytes(kind: str, entity_id: str, doc: dict) -> bytes:
+    """بايتات PDF من الذاكرة المخزنة أو بتوليدها (للتصدير الجماعي)"""
+    fields = pdf_template_fields(kind, doc)
+    key = pdf_cache_key(kind, fields)
+    cached = await db.pdf_cache.find_one({"_id": key}, {"blob_id": 1})
+    if cached:
+        try:
+            return await read_blob(cached["blob_id"])
+        except FileNotFoundError:
+            pass
+    pdf_content = await render_pdf(kind, fields, wait=True)
+    await store_cached_pdf(kind, entity_id, key, pdf_content)
+    return pdf_content
+
+async def cached_pdf_response(request: Request, kind: str, entity_id: str, doc: dict, filename: str):
+    """إرجاع PDF من الذاكرة المخزنة (مع ETag/304) أو توليده وتخزينه"""
+    fields = pdf_template_fields(kind, doc)
+    key = pdf_cache_key(kind, fields)
+    # الرابط ثابت بينما المحتوى قد يتغير، لذا يجب على المتصفح إعادة التحقق كل مرة
+    cache_control = "private, no-cache"
+    
+    # نسخة المتصفح مطابقة للمحتوى الحالي: لا حاجة لقراءة أو توليد أي شيء
+    if etag_matches(request, f'"{key}"'):
+        return Response(status_code=304, headers={"ETag": f'"{key}"', "Cache-Control": cache_control})
+    
+    cached = await db.pdf_cache.find_one({"_id": key})
+    if cached:
+        return await blob_response(
+            request, cached["blob_id"], cached["size"], "application/pdf",
+            filename=filename, etag=key, cache_control=cache_control
+        )
+    
+    pdf_content = await render_pdf(kind, fields)
+    await store_cached_pdf(kind, entity_id, key, pdf_content)
+    
+    return Response(
+        content=pdf_content,
+        media_type="application/pdf",
+        headers={
+            "Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}",
+            "ETag": f'"{key}"',
+            "Cache-Control": cache_control
+        }
+    )
+
 @api_router.get("/invoices/{invoice_id}/pdf")
-async def download_invoice_pdf(invoice_id: str, current_user: User = Depends(get_current_user)):
+async def download_invoice_pdf(invoice_id: str, request: Request, current_user: User = Depends(get_current_user)):
     """تحميل فاتورة كملف PDF"""
     invoice = await db.invoices.find_one({"id": invoice_id}, {"_id": 0})
     
@@ -2571,24 +3360,13 @@ async def download_invoice_pdf(invoice_id: str, current_user: User = Depends(get
     if current_user.role == UserRole.CLIENT and invoice.get('client_id') != current_user.id:
         raise HTTPException(status_code=403, detail="غير مصرح لك بتحميل هذه الفاتورة")
     
-    # تحويل التاريخ إذا كان نص
-    if isinstance(invoice.get('due_date'), str):
-        invoice['due_date'] = datetime.fromisoformat(invoice['due_date'].replace('Z', '+00:00'))
-    if isinstance(invoice.get('created_at'), str):
-        invoice['created_at'] = datetime.fromisoformat(invoice['created_at'].replace('Z', '+00:00'))
-    
-    pdf_content = create_invoice_pdf(invoice)
-    
-    return StreamingResponse(
-        pdf_content,
-        media_type="application/pdf",
-        headers={
-            "Content-Disposition": f"attachment; filename=invoice_{invoice.get('invoice_number', invoice_id)}.pdf"
-        }
+    return await cached_pdf_response(
+        request, "invoice", invoice_id, invoice,
+        f"invoice_{invoice.get('invoice_number', invoice_id)}.pdf"
     )
 
 @api_router.get("/vouchers/{voucher_id}/pdf")
-async def download_voucher_pdf(voucher_id: str, current_user: User = Depends(get_current_user)):
+async def download_voucher_pdf(voucher_id: str, request: Request, current_user: User = Depends(get_current_user)):
     """تحميل سند كملف PDF"""
     if current_user.role not in [UserRole.ADMIN, UserRole.ACCOUNTANT, UserRole.LAWYER]:
         raise HTTPException(status_code=403, detail="غير مصرح لك بتحميل السندات")
@@ -2598,18 +3376,180 @@ async def download_voucher_pdf(voucher_id: str, current_user: User = Depends(get
     if not voucher:
         raise HTTPException(status_code=404, detail="السند غير موجود")
     
-    # تحويل التاريخ إذا كان نص
-    if isinstance(voucher.get('created_at'), str):
-        voucher['created_at'] = datetime.fromisoformat(voucher['created_at'].replace('Z', '+00:00'))
+    return await cached_pdf_response(
+        request, "voucher", voucher_id, voucher,
+        f"voucher_{voucher.get('voucher_number', voucher_id)}.pdf"
+    )
+
+# ==================== كتيب المستخدم ====================
+
+USER_MANUAL_ENTITY = "user_manual"
+user_manual_lock = asyncio.Lock()
+
+async def ensure_user_manual() -> Optional[dict]:
+    """توليد الكتيب مرة واحدة لكل بصمة محتوى وحفظه في pdf_cache"""
+    content_hash = await asyncio.to_thread(manual_content_hash, PDF_FONTS_DIR)
+    key = f"manual:{content_hash}"
+    cached = await db.pdf_cache.find_one({"_id": key})
+    if cached:
+        return cached
+    async with user_manual_lock:
+        cached = await db.pdf_cache.find_one({"_id": key})
+        if cached:
+            return cached
+        pdf_content = await render_pdf("manual", {}, wait=True)
+        await store_cached_pdf("manual", USER_MANUAL_ENTITY, key, pdf_content)
+        logger.info(f"User manual generated ({content_hash[:12]})")
+        return await db.pdf_cache.find_one({"_id": key})
+
+async def prepare_user_manual():
+    try:
+        await ensure_user_manual()
+    except Exception as e:
+        logger.error(f"Failed to generate user manual: {e}")
+
+@api_router.get("/manual")
+async def download_user_manual(request: Request):
+    """تنزيل كتيب المستخدم مع ETag حتى يتحقق المتصفح بدلاً من إعادة التنزيل"""
+    cached = await ensure_user_manual()
+    return await blob_response(
+        request, cached["blob_id"], cached["size"], "application/pdf",
+        filename="user_manual.pdf", etag=cached["_id"].split(":", 1)[1],
+        disposition="inline", cache_control="public, max-age=3600, must-revalidate"
+    )
+
+# ==================== تصدير ملفات PDF جماعياً كملف ZIP ====================
+
+class ZipStreamBuffer:
+    """وجهة كتابة غير قابلة للتنقل لـ zipfile؛ تُفرغ بعد كل ملف لإرساله مباشرة"""
+    
+    def __init__(self):
+        self._chunks = []
+    
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
     
-    pdf_content = create_voucher_pdf(voucher)
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def pdf_export_query(date_from: Optional[str], date_to: Optional[str], client_id: Optional[str]) -> dict:
+    query = {}
+    if date_from or date_to:
+        query["created_at"] = {}
+        if date_from:
+            query["created_at"]["$gte"] = date_from
+        if date_to:
+            # التواريخ مخزنة كنص ISO لذا نقارن مع بداية اليوم التالي
+            next_day = datetime.fromisoformat(date_to[:10]) + timedelta(days=1)
+            query["created_at"]["$lt"] = next_day.strftime('%Y-%m-%d')
+    if client_id:
+        query["client_id"] = client_id
+    return query
+
+async def iter_pdf_export_docs(kind: str, date_from, date_to, client_id, voucher_type):
+    """مستندات التصدير (kind, id, المستند، اسم الملف) بدون تحميلها كلها في الذاكرة"""
+    query = pdf_export_query(date_from, date_to, client_id)
+    if kind in ("all", "invoice"):
+        async for invoice in db.invoices.find(query, {"_id": 0}).sort("created_at", 1):
+            yield "invoice", invoice["id"], invoice, f"invoices/invoice_{invoice.get('invoice_number') or invoice['id']}.pdf"
+    if kind in ("all", "voucher"):
+        voucher_query = dict(query)
+        if voucher_type:
+            voucher_query["voucher_type"] = voucher_type
+        async for voucher in db.vouchers.find(voucher_query, {"_id": 0}).sort("created_at", 1):
+            yield "voucher", voucher["id"], voucher, f"vouchers/voucher_{voucher.get('voucher_number') or voucher['id']}.pdf"
+
+@api_router.get("/financial-exports/pdf-zip")
+async def export_pdfs_zip(
+    kind: str = "all",
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    client_id: Optional[str] = None,
+    voucher_type: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """تصدير الفواتير والسندات كملف ZIP يُرسل تدريجياً مع اكتمال كل ملف"""
+    if current_user.role not in [UserRole.ADMIN, UserRole.ACCOUNTANT]:
+        raise HTTPException(status_code=403, detail="غير مصرح لك بتصدير الملفات")
+    if kind not in ("all", "invoice", "voucher"):
+        raise HTTPException(status_code=400, detail="نوع التصدير غير صحيح")
+    try:
+        query = pdf_export_query(date_from, date_to, client_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="صيغة التاريخ غير صحيحة")
+    
+    total = 0
+    if kind in ("all", "invoice"):
+        total += await db.invoices.count_documents(query)
+    if kind in ("all", "voucher"):
+        total += await db.vouchers.count_documents({**query, **({"voucher_type": voucher_type} if voucher_type else {})})
+    if total > PDF_EXPORT_MAX_DOCUMENTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"عدد الملفات ({total}) يتجاوز الحد المسموح ({PDF_EXPORT_MAX_DOCUMENTS})، يرجى تضييق الفلتر"
+        )
     
+    async def generate():
+        buffer = ZipStreamBuffer()
+        archive = zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_STORED)
+        used_names = set()
+        errors = []
+        pending = set()
+        # عدد محدود من المهام الجارية حتى لا تُحمَّل كل الملفات في الذاكرة
+        window = max(PDF_WORKERS, 1) * 2
+        
+        async def render(kind_, entity_id, doc, name):
+            try:
+                return name, await get_pdf_bytes(kind_, entity_id, doc), None
+            except Exception as e:
+                return name, None, str(getattr(e, "detail", e))
+        
+        def add_to_archive(name, content):
+            if name in used_names:
+                stem, ext = os.path.splitext(name)
+                name = f"{stem}_{len(used_names)}{ext}"
+            used_names.add(name)
+            archive.writestr(zipfile.ZipInfo(name, date_time=time.localtime()[:6]), content)
+        
+        async def drain_completed(return_when):
+            nonlocal pending
+            done, pending = await asyncio.wait(pending, return_when=return_when)
+            for task in done:
+                name, content, error = task.result()
+                if content is None:
+                    errors.append(f"{name}: {error}")
+                    continue
+                add_to_archive(name, content)
+        
+        try:
+            async for kind_, entity_id, doc, name in iter_pdf_export_docs(kind, date_from, date_to, client_id, voucher_type):
+                pending.add(asyncio.create_task(render(kind_, entity_id, doc, name)))
+                if len(pending) >= window:
+                    await drain_completed(asyncio.FIRST_COMPLETED)
+                    yield buffer.drain()
+            while pending:
+                await drain_completed(asyncio.FIRST_COMPLETED)
+                yield buffer.drain()
+            
+            if errors:
+                add_to_archive("errors.txt", "\n".join(errors).encode("utf-8"))
+            archive.close()
+            yield buffer.drain()
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    filename = f"financial_export_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}.zip"
     return StreamingResponse(
-        pdf_content,
-        media_type="application/pdf",
-        headers={
-            "Content-Disposition": f"attachment; filename=voucher_{voucher.get('voucher_number', voucher_id)}.pdf"
-        }
+        generate(),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
 
 @api_router.get("/financial-reports/{report_type}")
@@ -3250,30 +4190,510 @@ async def get_employee_performance_report(
         "employees": performance_data
     }
 
+# ========== فهرس البحث في المكتبة القانونية ==========
+
+ARABIC_DIACRITICS_RE = re.compile(r"[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]")
+ARABIC_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+ARABIC_CHAR_MAP = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    # الهمزة على الواو أو الياء تُوحد مع الهمزة المفردة حتى تتطابق "مسؤولية" و"مسئولية"
+    "ؤ": "ء", "ئ": "ء",
+    "ى": "ي", "ة": "ه",
+    "٠": "0", "١": "1", "٢": "2", "٣": "3", "٤": "4",
+    "٥": "5", "٦": "6", "٧": "7", "٨": "8", "٩": "9",
+})
+ARABIC_STOPWORDS = {
+    "في", "من", "علي", "الي", "عن", "مع", "او", "ان", "هذا", "هذه", "ذلك", "التي", "الذي",
+    "كل", "ما", "لا", "اذا", "هو", "هي", "قد", "ثم", "بين", "عند", "الا", "غير", "كان",
+}
+ARABIC_PREFIXES = ("وال", "بال", "كال", "فال", "لل", "ال")
+ARABIC_SUFFIXES = ("ها", "ان", "ات", "ون", "ين", "يه", "ه", "ي")
+
+def normalize_arabic(text: str) -> str:
+    """توحيد الهمزات والتاء المربوطة والألف المقصورة وحذف التشكيل والتطويل"""
+    return ARABIC_DIACRITICS_RE.sub("", text or "").translate(ARABIC_CHAR_MAP).lower()
+
+@functools.lru_cache(maxsize=65536)
+def stem_arabic(token: str) -> str:
+    """تجذيع خفيف: حذف أداة التعريف وحروف العطف واللواحق الشائعة مع إبقاء 3 أحرف على الأقل"""
+    for prefix in ARABIC_PREFIXES:
+        if token.startswith(prefix) and len(token) - len(prefix) >= 3:
+            token = token[len(prefix):]
+            break
+    else:
+        if token.startswith("و") and len(token) >= 5:
+            token = token[1:]
+    for suffix in ARABIC_SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            return token[:-len(suffix)]
+    return token
+
+def tokenize_arabic(text: str) -> List[str]:
+    return [
+        stem_arabic(token) for token in ARABIC_TOKEN_RE.findall(normalize_arabic(text))
+        if token not in ARABIC_STOPWORDS and (len(token) > 1 or token.isdigit())
+    ]
+
+def analyze_legal_document(doc: dict) -> Counter:
+    """تكرار المصطلحات في المستند؛ العنوان والكلمات المفتاحية بوزن أعلى من النص"""
+    terms = Counter(tokenize_arabic(doc.get("content", "")))
+    for token in tokenize_arabic(doc.get("title", "")):
+        terms[token] += 3
+    for token in tokenize_arabic(" ".join(doc.get("keywords") or [])):
+        terms[token] += 2
+    return terms
+
+LEGAL_ARTICLE_RE = re.compile(r"^[ \t]*(?:ال)?ماد[ةه][ \t]*[(\[]?[ \t]*\w+[)\]]?", re.MULTILINE)
+
+def chunk_legal_text(content: str, start: int, end: int) -> List[tuple]:
+    """تقسيم نص طويل عند حدود الفقرات إلى أجزاء لا تتجاوز LEGAL_PASSAGE_MAX_CHARS"""
+    chunks = []
+    while end - start > LEGAL_PASSAGE_MAX_CHARS:
+        cut = content.rfind("\n", start + LEGAL_PASSAGE_MAX_CHARS // 2, start + LEGAL_PASSAGE_MAX_CHARS)
+        if cut == -1:
+            cut = content.rfind(" ", start + LEGAL_PASSAGE_MAX_CHARS // 2, start + LEGAL_PASSAGE_MAX_CHARS)
+        if cut == -1:
+            cut = start + LEGAL_PASSAGE_MAX_CHARS
+        chunks.append((start, cut))
+        start = cut
+    if content[start:end].strip():
+        chunks.append((start, end))
+    return chunks
+
+def split_legal_passages(content: str) -> List[dict]:
+    """تقسيم النظام إلى مواد (أو فقرات إن لم توجد مواد) مع مواضعها في النص"""
+    content = content or ""
+    headings = list(LEGAL_ARTICLE_RE.finditer(content))
+    sections = []
+    if not headings or headings[0].start() > 0:
+        sections.append((0, headings[0].start() if headings else len(content), None))
+    for i, match in enumerate(headings):
+        end = headings[i + 1].start() if i + 1 < len(headings) else len(content)
+        # العنوان حتى النقطتين إن وجدتا قريباً (مثل "المادة الحادية عشرة:")، وإلا الجزء المطابق
+        line = content[match.start():content.find("\n", match.start()) % (len(content) + 1)]
+        colon = line.find(":")
+        heading = line[:colon] if 0 < colon <= 40 else match.group(0)
+        sections.append((match.start(), end, heading.strip()))
+    
+    passages = []
+    for start, end, heading in sections:
+        for chunk_start, chunk_end in chunk_legal_text(content, start, end):
+            passages.append({"start": chunk_start, "end": chunk_end, "heading": heading})
+    return passages
+
+def analyze_legal_passages(doc: dict) -> List[tuple]:
+    """(الموضع، المصطلحات) لكل مادة؛ عنوان النظام يُضاف لكل مادة ليطابق أسئلة مثل "نظام العمل" """
+    content = doc.get("content", "")
+    title_terms = tokenize_arabic(doc.get("title", ""))
+    analyzed = []
+    for passage in split_legal_passages(content):
+        text = content[passage["start"]:passage["end"]]
+        passage["tokens"] = estimate_tokens(text)
+        terms = Counter(tokenize_arabic(text))
+        terms.update(title_terms)
+        analyzed.append((passage, terms))
+    return analyzed
+
+def estimate_tokens(text: str) -> int:
+    # تقدير تقريبي: النص العربي حوالي 3 أحرف لكل رمز
+    return len(text) // 3 + 1
+
+class BM25Index:
+    """فهرس معكوس في الذاكرة مع ترتيب BM25؛ التعديل يتم من حلقة الأحداث فقط"""
+    
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(dict)
+        self.doc_terms = {}
+        self.lengths = {}
+        self.meta = {}
+        self.total_length = 0
+    
+    def __len__(self):
+        return len(self.lengths)
+    
+    def add(self, key, terms: Counter, meta: Optional[dict] = None):
+        if key in self.lengths:
+            self.remove(key)
+        for term, tf in terms.items():
+            self.postings[term][key] = tf
+        self.doc_terms[key] = list(terms)
+        length = sum(terms.values())
+        self.lengths[key] = length
+        self.meta[key] = meta or {}
+        self.total_length += length
+    
+    def remove(self, key):
+        if key not in self.lengths:
+            return
+        for term in self.doc_terms.pop(key):
+            posting = self.postings[term]
+            posting.pop(key, None)
+            if not posting:
+                del self.postings[term]
+        self.total_length -= self.lengths.pop(key)
+        self.meta.pop(key, None)
+    
+    def search(self, query_terms: List[str], filters: Optional[dict] = None) -> List[tuple]:
+        """(المفتاح، الدرجة) مرتبة تنازلياً؛ filters تطابق قيم meta"""
+        if not self.lengths or not query_terms:
+            return []
+        n = len(self.lengths)
+        avg_length = self.total_length / n or 1
+        scores = defaultdict(float)
+        for term in set(query_terms):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for key, tf in posting.items():
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[key] / avg_length)
+                scores[key] += idf * tf * (self.k1 + 1) / (tf + norm)
+        if filters:
+            filters = {field: value for field, value in filters.items() if value}
+            scores = {
+                key: score for key, score in scores.items()
+                if all(self.meta[key].get(field) == value for field, value in filters.items())
+            }
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+class TfidfVectors:
+    """متجهات TF-IDF متفرقة ومطبّعة لكل مستند: معرفات المصطلحات uint32 وأوزانها float32"""
+    
+    def __init__(self, index: BM25Index):
+        # قوائم الفهرس المعكوس تُستخدم لحساب df ولإيجاد المرشحين
+        self.index = index
+        self.vocab = {}
+        self.terms = []
+        self.vectors = {}
+    
+    def idf(self, term: str) -> float:
+        return math.log((1 + len(self.index)) / (1 + len(self.index.postings.get(term, ())))) + 1
+    
+    def _term_id(self, term: str) -> int:
+        term_id = self.vocab.get(term)
+        if term_id is None:
+            term_id = self.vocab[term] = len(self.terms)
+            self.terms.append(term)
+        return term_id
+    
+    def _pack(self, weights: dict) -> tuple:
+        """أعلى المصطلحات وزناً فقط ثم التطبيع (طول المتجه = 1)"""
+        top = heapq.nlargest(LEGAL_RELATED_MAX_TERMS, weights.items(), key=lambda item: item[1])
+        norm = math.sqrt(sum(weight * weight for _, weight in top)) or 1.0
+        top.sort()
+        return array("I", [term_id for term_id, _ in top]), array("f", [weight / norm for _, weight in top])
+    
+    def add(self, key, terms: Counter):
+        """تحديث تدريجي: المستند الجديد بقيم idf الحالية"""
+        self.vectors[key] = self._pack({
+            self._term_id(term): (1 + math.log(tf)) * self.idf(term) for term, tf in terms.items()
+        })
+    
+    def remove(self, key):
+        self.vectors.pop(key, None)
+    
+    def rebuild(self):
+        """حساب كل المتجهات من الفهرس المعكوس دفعة واحدة (عند بناء الفهرس)"""
+        weights = defaultdict(dict)
+        for term, posting in self.index.postings.items():
+            term_id = self._term_id(term)
+            idf = self.idf(term)
+            for key, tf in posting.items():
+                weights[key][term_id] = (1 + math.log(tf)) * idf
+        self.vectors = {key: self._pack(doc_weights) for key, doc_weights in weights.items()}
+    
+    def related(self, key, limit: int) -> List[tuple]:
+        """أقرب المستندات بتشابه جيب التمام؛ المرشحون من قوائم أعلى مصطلحات المستند"""
+        vector = self.vectors.get(key)
+        if vector is None:
+            return []
+        term_ids, term_weights = vector
+        query = dict(zip(term_ids, term_weights))
+        probe = heapq.nlargest(LEGAL_RELATED_PROBE_TERMS, query.items(), key=lambda item: item[1])
+        candidates = set()
+        for term_id, _ in probe:
+            candidates.update(self.index.postings.get(self.terms[term_id], ()))
+        candidates.discard(key)
+        
+        scores = []
+        for candidate in candidates:
+            other = self.vectors.get(candidate)
+            if other is None:
+                continue
+            score = sum(query.get(term_id, 0.0) * weight for term_id, weight in zip(*other))
+            if score > 0:
+                scores.append((candidate, score))
+        return heapq.nlargest(limit, scores, key=lambda item: item[1])
+
+class LegalLibraryIndex:
+    """فهرس المكتبة القانونية لكل عملية؛ يُبنى عند التشغيل ويُحدَّث عند الإضافة والحذف"""
+    
+    def __init__(self):
+        self.documents = BM25Index()
+        # المواد القانونية كمقاطع مستقلة لسياق المساعد الذكي
+        self.passages = BM25Index()
+        self.passage_keys = {}
+        # متجهات "المستندات ذات الصلة"
+        self.vectors = TfidfVectors(self.documents)
+        self.ready = False
+        # رقم الإصدار يُزاد في قاعدة البيانات مع كل تعديل حتى تكتشف العمليات الأخرى التغيير
+        self.version = None
+        self._rebuild_lock = asyncio.Lock()
+    
+    def _add(self, doc: dict, terms: Counter, passages: List[tuple]):
+        meta = {"category": doc.get("category"), "subcategory": doc.get("subcategory")}
+        self.documents.add(doc["id"], terms, meta)
+        # أثناء البناء الكامل تُحسب المتجهات مرة واحدة في النهاية
+        if self.ready:
+            self.vectors.add(doc["id"], terms)
+        self._remove_passages(doc["id"])
+        keys = []
+        for n, (passage, passage_terms) in enumerate(passages):
+            key = f"{doc['id']}:{n}"
+            self.passages.add(key, passage_terms, {**meta, **passage, "doc_id": doc["id"]})
+            keys.append(key)
+        self.passage_keys[doc["id"]] = keys
+    
+    def _remove_passages(self, doc_id: str):
+        for key in self.passage_keys.pop(doc_id, []):
+            self.passages.remove(key)
+    
+    async def rebuild(self):
+        async with self._rebuild_lock:
+            state = await db.search_state.find_one({"_id": "legal_documents"})
+            version = (state or {}).get("version", 0)
+            fresh = LegalLibraryIndex()
+            batch = []
+            cursor = db.legal_documents.find(
+                {}, {"_id": 0, "id": 1, "title": 1, "content": 1, "keywords": 1, "category": 1, "subcategory": 1}
+            )
+            async for doc in cursor:
+                batch.append(doc)
+                if len(batch) >= 200:
+                    await fresh._add_batch(batch)
+                    batch = []
+            if batch:
+                await fresh._add_batch(batch)
+            await asyncio.to_thread(fresh.vectors.rebuild)
+            self.documents = fresh.documents
+            self.vectors = fresh.vectors
+            self.passages = fresh.passages
+            self.passage_keys = fresh.passage_keys
+            self.version = version
+            self.ready = True
+            logger.info(f"Legal library index built: {len(self.documents)} documents, {len(self.documents.postings)} terms")
+    
+    async def _add_batch(self, docs: List[dict]):
+        # التحليل خارج حلقة الأحداث، والتعديل داخلها
+        analyzed = await asyncio.to_thread(
+            lambda: [(analyze_legal_document(doc), analyze_legal_passages(doc)) for doc in docs]
+        )
+        for doc, (terms, passages) in zip(docs, analyzed):
+            self._add(doc, terms, passages)
+    
+    async def _bump_version(self):
+        state = await db.search_state.find_one_and_update(
+            {"_id": "legal_documents"},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        # إذا فاتنا تعديل من عملية أخرى يبقى الإصدار القديم فيُعاد البناء في الدورة التالية
+        if self.version is not None and state["version"] == self.version + 1:
+            self.version = state["version"]
+    
+    async def add_document(self, doc: dict):
+        await self.add_documents([doc])
+    
+    async def add_documents(self, docs: List[dict]):
+        """إضافة دفعة مستندات مع زيادة واحدة للإصدار"""
+        # قبل بناء الفهرس (أو خارج الخادم) تكفي زيادة الإصدار فيلتقطها البناء
+        if self.ready:
+            await self._add_batch(docs)
+        await self._bump_version()
+    
+    async def remove_document(self, doc_id: str):
+        self.documents.remove(doc_id)
+        self.vectors.remove(doc_id)
+        self._remove_passages(doc_id)
+        await self._bump_version()
+    
+    async def refresh_if_stale(self):
+        state = await db.search_state.find_one({"_id": "legal_documents"})
+        if not self.ready or (state or {}).get("version", 0) != self.version:
+            await self.rebuild()
+    
+    def search(self, query: str, category: Optional[str] = None, subcategory: Optional[str] = None) -> List[tuple]:
+        return self.documents.search(tokenize_arabic(query), {"category": category, "subcategory": subcategory})
+    
+    def search_passages(self, query: str) -> List[tuple]:
+        """(بيانات المادة، الدرجة) مرتبة حسب الصلة"""
+        return [(self.passages.meta[key], score) for key, score in self.passages.search(tokenize_arabic(query))]
+
+async def select_legal_passages(question: str, token_budget: int, top_k: int) -> List[dict]:
+    """أفضل المواد صلةً بالسؤال ضمن ميزانية الرموز، مع نصوصها من المستندات"""
+    hits = legal_index.search_passages(question)
+    selected = []
+    used_tokens = 0
+    for meta, score in hits[:top_k * 4]:
+        if len(selected) >= top_k:
+            break
+        if used_tokens + meta["tokens"] > token_budget:
+            continue
+        selected.append((meta, score))
+        used_tokens += meta["tokens"]
+    if not selected:
+        return []
+    
+    doc_ids = list({meta["doc_id"] for meta, _ in selected})
+    docs = {
+        doc["id"]: doc async for doc in db.legal_documents.find(
+            {"id": {"$in": doc_ids}},
+            {"_id": 0, "id": 1, "title": 1, "category": 1, "content": 1, "source": 1, "year": 1, "number": 1}
+        )
+    }
+    passages = []
+    for meta, score in selected:
+        doc = docs.get(meta["doc_id"])
+        if not doc:
+            continue
+        passages.append({
+            "doc": doc,
+            "heading": meta["heading"],
+            "text": doc.get("content", "")[meta["start"]:meta["end"]].strip(),
+            "score": score,
+        })
+    return passages
+
+legal_index = LegalLibraryIndex()
+
+async def legal_index_worker():
+    """بناء الفهرس عند التشغيل ثم التحقق دورياً من تعديلات العمليات الأخرى"""
+    while True:
+        try:
+            await legal_index.refresh_if_stale()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Legal library index refresh failed: {e}")
+        await asyncio.sleep(LEGAL_INDEX_REFRESH_INTERVAL)
+
 # ========== المكتبة القانونية ==========
 @api_router.get("/legal-library/documents")
 async def get_legal_documents(
+    response: Response,
     category: Optional[str] = None,
     subcategory: Optional[str] = None,
     search: Optional[str] = None,
+    skip: int = 0,
+    limit: int = 100,
     current_user: User = Depends(get_current_user)
 ):
-    """الحصول على المستندات القانونية"""
+    """الحصول على المستندات القانونية (نتائج البحث مرتبة حسب الصلة)"""
+    skip = max(skip, 0)
+    limit = min(max(limit, 1), 100)
     query = {}
     if category:
         query["category"] = category
     if subcategory:
         query["subcategory"] = subcategory
+    
+    if search and legal_index.ready:
+        hits = legal_index.search(search, category, subcategory)
+        response.headers["X-Total-Count"] = str(len(hits))
+        page = hits[skip:skip + limit]
+        scores = dict(page)
+        documents = await db.legal_documents.find(
+            {"id": {"$in": list(scores)}}, {"_id": 0, "content": 0}
+        ).to_list(len(page))
+        for doc in documents:
+            doc["score"] = round(scores[doc["id"]], 4)
+        documents.sort(key=lambda doc: -doc["score"])
+        return documents
+    
     if search:
+        # الفهرس لم يُبنَ بعد في هذه العملية
         query["$or"] = [
-            {"title": {"$regex": search, "$options": "i"}},
-            {"content": {"$regex": search, "$options": "i"}},
+            {"title": {"$regex": re.escape(search), "$options": "i"}},
+            {"content": {"$regex": re.escape(search), "$options": "i"}},
             {"keywords": {"$in": [search]}}
         ]
     
-    documents = await db.legal_documents.find(query, {"_id": 0, "content": 0}).sort("created_at", -1).to_list(100)
+    documents = await db.legal_documents.find(query, {"_id": 0, "content": 0}).sort("created_at", -1).skip(skip).to_list(limit)
     return documents
 
+def encode_legal_cursor(doc: dict) -> str:
+    raw = json.dumps([doc.get("created_at"), doc.get("id")], ensure_ascii=False)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def decode_legal_cursor(cursor: str) -> tuple:
+    try:
+        created_at, doc_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return created_at, doc_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="مؤشر الصفحة غير صحيح")
+
+@api_router.get("/legal-library/documents/browse")
+async def browse_legal_documents(
+    category: Optional[str] = None,
+    subcategory: Optional[str] = None,
+    year: Optional[int] = None,
+    cursor: Optional[str] = None,
+    limit: int = 50,
+    current_user: User = Depends(get_current_user)
+):
+    """تصفح المستندات بصفحات (مؤشر بدلاً من skip) مع أعداد التصنيفات والسنوات في نفس الاستعلام"""
+    limit = min(max(limit, 1), 100)
+    query = {}
+    if category:
+        query["category"] = category
+    if subcategory:
+        query["subcategory"] = subcategory
+    if year:
+        query["year"] = year
+    
+    page_stages = []
+    if cursor:
+        created_at, doc_id = decode_legal_cursor(cursor)
+        page_stages.append({"$match": {"$or": [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "id": {"$lt": doc_id}}
+        ]}})
+    page_stages.append({"$limit": limit + 1})
+    
+    pipeline = [
+        {"$match": query},
+        # الترتيب قبل $facet يستخدم الفهرس (category, subcategory, created_at)
+        {"$sort": {"created_at": -1, "id": -1}},
+        {"$project": {"_id": 0, "content": 0}},
+        {"$facet": {
+            "documents": page_stages,
+            "total": [{"$count": "count"}],
+            "category": [{"$group": {"_id": "$category", "count": {"$sum": 1}}}, {"$sort": {"count": -1}}],
+            "subcategory": [{"$group": {"_id": "$subcategory", "count": {"$sum": 1}}}, {"$sort": {"count": -1}}],
+            "year": [{"$group": {"_id": "$year", "count": {"$sum": 1}}}, {"$sort": {"_id": -1}}],
+        }}
+    ]
+    result = (await db.legal_documents.aggregate(pipeline, allowDiskUse=True).to_list(1))[0]
+    
+    documents = result["documents"]
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        next_cursor = encode_legal_cursor(documents[-1])
+    
+    return {
+        "documents": documents,
+        "next_cursor": next_cursor,
+        "total": result["total"][0]["count"] if result["total"] else 0,
+        "facets": {
+            dimension: [{"value": row["_id"], "count": row["count"]} for row in result[dimension] if row["_id"] is not None]
+            for dimension in ("category", "subcategory", "year")
+        }
+    }
+
 @api_router.get("/legal-library/documents/{doc_id}")
 async def get_legal_document(doc_id: str, current_user: User = Depends(get_current_user)):
     """الحصول على مستند قانوني محدد"""
@@ -3282,6 +4702,28 @@ async def get_legal_document(doc_id: str, current_user: User = Depends(get_curre
         raise HTTPException(status_code=404, detail="المستند غير موجود")
     return document
 
+@api_router.get("/legal-library/documents/{doc_id}/related")
+async def get_related_legal_documents(doc_id: str, limit: int = 10, current_user: User = Depends(get_current_user)):
+    """الأنظمة والسوابق ذات الصلة بمستند (تشابه TF-IDF محلي)"""
+    if not legal_index.ready:
+        raise HTTPException(status_code=503, detail="فهرس المكتبة قيد البناء، حاول بعد قليل")
+    limit = min(max(limit, 1), 50)
+    
+    related = legal_index.vectors.related(doc_id, limit)
+    if not related and doc_id not in legal_index.vectors.vectors:
+        if not await db.legal_documents.find_one({"id": doc_id}, {"_id": 1}):
+            raise HTTPException(status_code=404, detail="المستند غير موجود")
+        return []
+    
+    scores = dict(related)
+    documents = await db.legal_documents.find(
+        {"id": {"$in": list(scores)}}, {"_id": 0, "content": 0}
+    ).to_list(len(scores))
+    for doc in documents:
+        doc["similarity"] = round(scores[doc["id"]], 4)
+    documents.sort(key=lambda doc: -doc["similarity"])
+    return documents
+
 @api_router.post("/legal-library/documents", response_model=LegalDocument)
 async def create_legal_document(doc_input: LegalDocumentCreate, current_user: User = Depends(get_current_user)):
     """إضافة مستند قانوني جديد"""
@@ -3297,12 +4739,118 @@ async def create_legal_document(doc_input: LegalDocumentCreate, current_user: Us
     doc_to_save['created_at'] = doc_to_save['created_at'].isoformat()
     
     await db.legal_documents.insert_one(doc_to_save)
+    await legal_index.add_document(doc_to_save)
+    invalidate_legal_stats()
     
     await log_action("create", "legal_document", document.id, current_user.id, current_user.full_name,
                     f"إضافة مستند قانوني: {document.title}")
     
     return document
 
+async def iter_ndjson_lines(chunks, max_line_size: int = LEGAL_IMPORT_MAX_LINE_SIZE):
+    """أسطر NDJSON من تدفق بايتات مع رقم السطر، بدون تحميل الملف كاملاً
+    
+    أجزاء السطر تُجمع في قائمة وتُدمج مرة واحدة عند نهايته (لا نعيد نسخ الباقي مع كل جزء)،
+    والسطر الذي يتجاوز max_line_size يُعاد كـ None بدلاً من تخزينه بلا حد
+    """
+    pending = []
+    pending_size = 0
+    line_no = 0
+    async for chunk in chunks:
+        start = 0
+        while True:
+            end = chunk.find(b"\n", start)
+            piece_end = len(chunk) if end == -1 else end
+            if pending_size <= max_line_size:
+                pending_size += piece_end - start
+                if pending_size <= max_line_size:
+                    pending.append(chunk[start:piece_end])
+                else:
+                    pending = []
+            if end == -1:
+                break
+            line_no += 1
+            yield line_no, b"".join(pending) if pending_size <= max_line_size else None
+            pending = []
+            pending_size = 0
+            start = end + 1
+    if pending_size:
+        yield line_no + 1, b"".join(pending) if pending_size <= max_line_size else None
+
+async def import_legal_documents(lines, uploaded_by: str, uploaded_by_name: str) -> dict:
+    """استيراد مستندات من أسطر NDJSON: تحقق بـ LegalDocumentCreate، إدراج دفعات غير مرتبة، وتحديث الفهرس دفعة واحدة"""
+    imported = 0
+    errors = []
+    error_count = 0
+    
+    def add_error(line_no: int, message: str):
+        nonlocal error_count
+        error_count += 1
+        if len(errors) < LEGAL_IMPORT_MAX_ERRORS:
+            errors.append({"line": line_no, "error": message})
+    
+    async def flush(batch: List[tuple]):
+        nonlocal imported
+        docs = [doc for _, doc in batch]
+        inserted = docs
+        try:
+            await db.legal_documents.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            failed = {err["index"] for err in e.details.get("writeErrors", [])}
+            for err in e.details.get("writeErrors", []):
+                add_error(batch[err["index"]][0], err.get("errmsg", "write error"))
+            inserted = [doc for i, doc in enumerate(docs) if i not in failed]
+        imported += len(inserted)
+        if inserted:
+            await legal_index.add_documents(inserted)
+    
+    batch = []
+    async for line_no, line in lines:
+        if line is None:
+            add_error(line_no, f"row: السطر يتجاوز الحد المسموح ({LEGAL_IMPORT_MAX_LINE_SIZE} بايت)")
+            continue
+        if not line.strip():
+            continue
+        try:
+            doc_input = LegalDocumentCreate.model_validate_json(line)
+        except ValidationError as e:
+            add_error(line_no, "; ".join(
+                f"{'.'.join(str(loc) for loc in err['loc']) or 'row'}: {err['msg']}" for err in e.errors()
+            ))
+            continue
+        document = LegalDocument(**doc_input.model_dump(), uploaded_by=uploaded_by, uploaded_by_name=uploaded_by_name)
+        doc = document.model_dump()
+        doc['created_at'] = doc['created_at'].isoformat()
+        batch.append((line_no, doc))
+        if len(batch) >= LEGAL_IMPORT_BATCH_SIZE:
+            await flush(batch)
+            batch = []
+    if batch:
+        await flush(batch)
+    
+    if imported:
+        invalidate_legal_stats()
+    return {"imported": imported, "error_count": error_count, "errors": errors}
+
+@api_router.post("/legal-library/documents/import")
+async def bulk_import_legal_documents(request: Request, current_user: User = Depends(get_current_user)):
+    """استيراد مستندات قانونية بالجملة من ملف NDJSON (مستند JSON في كل سطر) يُرسل كجسم الطلب"""
+    if current_user.role == "client":
+        raise HTTPException(status_code=403, detail="العملاء لا يمكنهم إضافة مستندات")
+    
+    result = await import_legal_documents(
+        iter_ndjson_lines(request.stream()), current_user.id, current_user.full_name
+    )
+    
+    if result["imported"]:
+        await log_action("create", "legal_document", "bulk_import", current_user.id, current_user.full_name,
+                        f"استيراد {result['imported']} مستند قانوني")
+    
+    return {
+        "message": f"تم استيراد {result['imported']} مستند، وفشل {result['error_count']} سطر",
+        **result
+    }
+
 @api_router.delete("/legal-library/documents/{doc_id}")
 async def delete_legal_document(doc_id: str, current_user: User = Depends(get_current_user)):
     """حذف مستند قانوني"""
@@ -3312,79 +4860,83 @@ async def delete_legal_document(doc_id: str, current_user: User = Depends(get_cu
     result = await db.legal_documents.delete_one({"id": doc_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="المستند غير موجود")
+    await legal_index.remove_document(doc_id)
+    await invalidate_legal_ai_cache(doc_id)
+    invalidate_legal_stats()
     
     return {"message": "تم حذف المستند بنجاح"}
 
+LEGAL_CATEGORIES = [
+    {"id": "system", "name": "الأنظمة السعودية", "icon": "📜"},
+    {"id": "regulation", "name": "اللوائح التنفيذية", "icon": "📋"},
+    {"id": "precedent", "name": "السوابق القضائية", "icon": "⚖️"},
+    {"id": "supreme_court", "name": "قرارات المحكمة العليا", "icon": "🏛️"},
+    {"id": "law_book", "name": "كتب القانون", "icon": "📖"},
+    {"id": "fiqh_book", "name": "كتب الفقه", "icon": "📕"},
+    {"id": "decision", "name": "القرارات والتعاميم", "icon": "📄"},
+]
+
+LEGAL_SUBCATEGORIES = [
+    {"id": "criminal", "name": "جنائي"},
+    {"id": "commercial", "name": "تجاري"},
+    {"id": "family", "name": "أحوال شخصية"},
+    {"id": "labor", "name": "عمالي"},
+    {"id": "administrative", "name": "إداري"},
+    {"id": "civil", "name": "مدني"},
+    {"id": "real_estate", "name": "عقاري"},
+]
+
+# إحصائيات المكتبة مخزنة لكل عملية ومرتبطة بإصدار الفهرس (يتغير مع كل إضافة أو حذف)
+legal_stats_cache = {}
+
+def invalidate_legal_stats():
+    legal_stats_cache.clear()
+
+async def get_legal_stats() -> dict:
+    version = legal_index.version
+    cached = legal_stats_cache.get("stats")
+    if cached and version is not None and cached["version"] == version:
+        return cached
+    
+    stats = {cat["id"]: 0 for cat in LEGAL_CATEGORIES}
+    subcategory_stats = {}
+    by_category = {}
+    pipeline = [{"$group": {"_id": {"category": "$category", "subcategory": "$subcategory"}, "count": {"$sum": 1}}}]
+    async for row in db.legal_documents.aggregate(pipeline):
+        category = row["_id"].get("category")
+        subcategory = row["_id"].get("subcategory")
+        if category in stats:
+            stats[category] += row["count"]
+        if subcategory:
+            subcategory_stats[subcategory] = subcategory_stats.get(subcategory, 0) + row["count"]
+            by_category.setdefault(category, {})[subcategory] = row["count"]
+    
+    payload = {"stats": stats, "subcategory_stats": subcategory_stats, "by_category": by_category}
+    cached = {
+        "version": version,
+        "payload": payload,
+        "etag": hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()[:32]
+    }
+    if version is not None:
+        legal_stats_cache["stats"] = cached
+    return cached
+
 @api_router.get("/legal-library/categories")
-async def get_legal_categories(current_user: User = Depends(get_current_user)):
+async def get_legal_categories(request: Request, current_user: User = Depends(get_current_user)):
     """الحصول على فئات المكتبة القانونية"""
-    categories = [
-        {"id": "system", "name": "الأنظمة السعودية", "icon": "📜"},
-        {"id": "regulation", "name": "اللوائح التنفيذية", "icon": "📋"},
-        {"id": "precedent", "name": "السوابق القضائية", "icon": "⚖️"},
-        {"id": "supreme_court", "name": "قرارات المحكمة العليا", "icon": "🏛️"},
-        {"id": "law_book", "name": "كتب القانون", "icon": "📖"},
-        {"id": "fiqh_book", "name": "كتب الفقه", "icon": "📕"},
-        {"id": "decision", "name": "القرارات والتعاميم", "icon": "📄"},
-    ]
-    
-    subcategories = [
-        {"id": "criminal", "name": "جنائي"},
-        {"id": "commercial", "name": "تجاري"},
-        {"id": "family", "name": "أحوال شخصية"},
-        {"id": "labor", "name": "عمالي"},
-        {"id": "administrative", "name": "إداري"},
-        {"id": "civil", "name": "مدني"},
-        {"id": "real_estate", "name": "عقاري"},
-    ]
+    cached = await get_legal_stats()
+    etag = f'"{cached["etag"]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=60, must-revalidate"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
     
     # إحصائيات
-    stats = {}
-    for cat in categories:
-        count = await db.legal_documents.count_documents({"category": cat["id"]})
-        stats[cat["id"]] = count
-    
-    return {"categories": categories, "subcategories": subcategories, "stats": stats}
+    body = {"categories": LEGAL_CATEGORIES, "subcategories": LEGAL_SUBCATEGORIES, **cached["payload"]}
+    return Response(content=json.dumps(body, ensure_ascii=False), media_type="application/json", headers=headers)
 
 # ========== الذكاء الاصطناعي القانوني ==========
-@api_router.post("/legal-library/ai/chat")
-async def legal_ai_chat(request: LegalChatRequest, current_user: User = Depends(get_current_user)):
-    """المحادثة مع المساعد القانوني الذكي"""
-    from emergentintegrations.llm.chat import LlmChat, UserMessage
-    
-    # إنشاء session_id جديد إذا لم يكن موجوداً
-    session_id = request.session_id or str(uuid.uuid4())
-    
-    # البحث في المكتبة القانونية للحصول على سياق
-    search_query = request.message
-    relevant_docs = await db.legal_documents.find(
-        {"$or": [
-            {"title": {"$regex": search_query, "$options": "i"}},
-            {"content": {"$regex": search_query, "$options": "i"}},
-            {"keywords": {"$elemMatch": {"$regex": search_query, "$options": "i"}}}
-        ]},
-        {"_id": 0, "title": 1, "category": 1, "content": 1, "source": 1, "year": 1, "number": 1}
-    ).limit(5).to_list(5)
-    
-    # بناء السياق من المستندات
-    context = ""
-    sources = []
-    if relevant_docs:
-        context = "\n\nالمعلومات المتوفرة في المكتبة القانونية:\n"
-        for doc in relevant_docs:
-            context += f"\n--- {doc.get('title', '')} ---\n"
-            content = doc.get('content', '')[:2000]  # أول 2000 حرف
-            context += content + "\n"
-            sources.append({
-                "title": doc.get('title'),
-                "category": doc.get('category'),
-                "source": doc.get('source'),
-                "year": doc.get('year'),
-                "number": doc.get('number')
-            })
-    
-    # بناء رسالة النظام
-    system_message = """أنت مساعد قانوني متخصص في الأنظمة السعودية والفقه الإسلامي.
+
+LEGAL_AI_SYSTEM_PROMPT = """أنت مساعد قانوني متخصص في الأنظمة السعودية والفقه الإسلامي.
 مهمتك:
 1. الإجابة على الأسئلة القانونية بدقة استناداً للأنظمة السعودية
 2. الاستشهاد بالمواد والأنظمة ذات الصلة
@@ -3393,59 +4945,388 @@ async def legal_ai_chat(request: LegalChatRequest, current_user: User = Depends(
 
 الرجاء الإجابة باللغة العربية بشكل واضح ومنظم.
 إذا لم تكن متأكداً من المعلومة، اذكر ذلك بوضوح.
-""" + context
+"""
+
+def legal_ai_cache_key(question: str, context: str, model: str, backend: str) -> str:
+    """السؤال بعد التوحيد (همزات، تشكيل، ترقيم، مسافات) + بصمة السياق المسترجع + النموذج والواجهة
+    
+    الواجهة جزء من المفتاح حتى لا تُقدم ردود النموذج المحلي (stub) للمستخدمين بعد العودة للنموذج الحقيقي
+    """
+    normalized = " ".join(ARABIC_TOKEN_RE.findall(normalize_arabic(question)))
+    context_hash = hashlib.sha256(context.encode("utf-8")).hexdigest()
+    return hashlib.sha256(f"{backend}\n{model}\n{context_hash}\n{normalized}".encode("utf-8")).hexdigest()
+
+async def get_cached_legal_answer(key: str) -> Optional[str]:
+    entry = await db.legal_ai_cache.find_one_and_update(
+        {"_id": key, "expires_at": {"$gt": datetime.now(timezone.utc)}},
+        {"$inc": {"hits": 1}},
+        projection={"response": 1}
+    )
+    return entry["response"] if entry else None
+
+async def store_legal_answer(key: str, question: str, response: str, sources: List[dict]):
+    """حفظ الرد مع معرفات المستندات المستخدمة حتى يُحذف عند تعديلها"""
+    now = datetime.now(timezone.utc)
+    await db.legal_ai_cache.update_one(
+        {"_id": key},
+        {"$set": {
+            "question": question,
+            "response": response,
+            "doc_ids": [source["id"] for source in sources],
+            "created_at": now,
+            "expires_at": now + timedelta(seconds=LEGAL_AI_CACHE_TTL),
+            "hits": 0
+        }},
+        upsert=True
+    )
+    # حد أقصى لعدد الردود المخزنة: حذف الأقدم
+    excess = await db.legal_ai_cache.estimated_document_count() - LEGAL_AI_CACHE_MAX_ENTRIES
+    if excess > 0:
+        oldest = await db.legal_ai_cache.find({}, {"_id": 1}).sort("created_at", 1).limit(excess).to_list(excess)
+        await db.legal_ai_cache.delete_many({"_id": {"$in": [entry["_id"] for entry in oldest]}})
+
+async def invalidate_legal_ai_cache(doc_id: str):
+    await db.legal_ai_cache.delete_many({"doc_ids": doc_id})
+
+class EmergentLLMBackend:
+    """LlmChat عبر مفتاح Emergent؛ لا يدعم البث، فيُستخدم Gemini مباشرة للبث إذا توفر مفتاحه"""
     
-    try:
-        # إنشاء محادثة مع Gemini
+    name = "emergent"
+    
+    async def complete(self, session_id: str, system_message: str, question: str) -> str:
+        if LlmChat is None:
+            raise HTTPException(status_code=500, detail="مكتبة المساعد الذكي غير مثبتة")
         api_key = os.environ.get('EMERGENT_LLM_KEY')
         if not api_key:
             raise HTTPException(status_code=500, detail="مفتاح API غير متوفر")
-        
         chat = LlmChat(
             api_key=api_key,
             session_id=session_id,
             system_message=system_message
-        ).with_model("gemini", "gemini-3-flash-preview")
-        
-        # إرسال الرسالة
-        user_message = UserMessage(text=request.message)
-        response = await chat.send_message(user_message)
-        
-        # حفظ رسالة المستخدم
-        user_msg = LegalChatMessage(
-            session_id=session_id,
-            user_id=current_user.id,
-            user_name=current_user.full_name,
-            role="user",
-            content=request.message
-        )
-        user_msg_dict = user_msg.model_dump()
-        user_msg_dict['created_at'] = user_msg_dict['created_at'].isoformat()
-        await db.legal_chat_messages.insert_one(user_msg_dict)
+        ).with_model(LEGAL_AI_PROVIDER, LEGAL_AI_MODEL)
+        return await chat.send_message(UserMessage(text=question))
+    
+    async def stream(self, session_id: str, system_message: str, question: str):
+        if genai is not None and GEMINI_API_KEY and LEGAL_AI_PROVIDER == "gemini":
+            model = genai.GenerativeModel(LEGAL_AI_MODEL, system_instruction=system_message)
+            stream = await model.generate_content_async(question, stream=True)
+            async for chunk in stream:
+                if chunk.parts:
+                    yield chunk.text
+            return
+        yield await self.complete(session_id, system_message, question)
+
+class StubLLMBackend:
+    """نموذج محلي بدون اتصال خارجي لاختبار الحمل: تأخير ثابت ورد مبني على السؤال والسياق"""
+    
+    name = "stub"
+    
+    def __init__(self, latency: float, chunks: int = 8):
+        self.latency = latency
+        self.chunks = chunks
+    
+    def _answer(self, system_message: str, question: str) -> str:
+        context_size = len(system_message) - len(LEGAL_AI_SYSTEM_PROMPT)
+        return f"رد تجريبي على: {question}\n(طول السياق {max(context_size, 0)} حرفاً)"
+    
+    async def complete(self, session_id: str, system_message: str, question: str) -> str:
+        await asyncio.sleep(self.latency)
+        return self._answer(system_message, question)
+    
+    async def stream(self, session_id: str, system_message: str, question: str):
+        answer = self._answer(system_message, question)
+        step = max(len(answer) // self.chunks, 1)
+        for i in range(0, len(answer), step):
+            await asyncio.sleep(self.latency / self.chunks)
+            yield answer[i:i + step]
+
+LLM_BACKENDS = {
+    "emergent": lambda: EmergentLLMBackend(),
+    "stub": lambda: StubLLMBackend(LLM_STUB_LATENCY),
+}
+
+class LLMClient:
+    """عميل مشترك للنموذج: حد للطلبات المتزامنة، مهلة لكل استدعاء، وقاطع دائرة عند تعطل المزود"""
+    
+    def __init__(self, backend, max_in_flight: int, timeout: float, queue_timeout: float,
+                 failure_threshold: int, reset_after: float):
+        self.backend = backend
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+    
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_after:
+            return "half_open"
+        return "open"
+    
+    def _check_circuit(self, claim_probe: bool = False):
+        state = self.state
+        if state == "open" or (state == "half_open" and self._probing):
+            raise HTTPException(status_code=503, detail="المساعد الذكي غير متاح مؤقتاً، حاول بعد قليل")
+        if state == "half_open" and claim_probe:
+            # طلب واحد فقط لاختبار تعافي المزود
+            self._probing = True
+    
+    def _record(self, success: bool):
+        self._probing = False
+        if success:
+            self._failures = 0
+            self._opened_at = None
+            return
+        self._failures += 1
+        if self._opened_at is not None or self._failures >= self.failure_threshold:
+            if self._opened_at is None:
+                logger.warning(f"LLM circuit opened after {self._failures} failures")
+            self._opened_at = time.monotonic()
+    
+    async def _acquire(self):
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="المساعد الذكي مشغول، حاول مرة أخرى")
+    
+    async def _enter(self):
+        """رفض سريع إذا كانت الدائرة مفتوحة، ثم حجز مكان؛ طلب الاختبار يُحجز فقط بعد الحصول على المكان
+        حتى لا تبقى الدائرة عالقة إذا انتهت مهلة الانتظار أو أُلغي الطلب في الطابور"""
+        self._check_circuit()
+        await self._acquire()
+        try:
+            self._check_circuit(claim_probe=True)
+        except HTTPException:
+            self._slots.release()
+            raise
+    
+    async def complete(self, session_id: str, system_message: str, question: str) -> str:
+        await self._enter()
+        try:
+            response = await asyncio.wait_for(
+                self.backend.complete(session_id, system_message, question), timeout=self.timeout
+            )
+        except asyncio.TimeoutError:
+            self._record(False)
+            raise HTTPException(status_code=504, detail="انتهت مهلة المساعد الذكي")
+        except (HTTPException, asyncio.CancelledError):
+            # أخطاء الإعداد (مثل غياب المفتاح) أو إلغاء الطلب ليست تعطلاً في المزود
+            self._probing = False
+            raise
+        except Exception:
+            self._record(False)
+            raise
+        finally:
+            self._slots.release()
+        self._record(True)
+        return response
+    
+    async def stream(self, session_id: str, system_message: str, question: str):
+        """أجزاء الرد مع مهلة إجمالية للبث كله"""
+        await self._enter()
+        deadline = time.monotonic() + self.timeout
+        stream = self.backend.stream(session_id, system_message, question)
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                try:
+                    chunk = await asyncio.wait_for(stream.__anext__(), timeout=remaining)
+                except StopAsyncIteration:
+                    break
+                yield chunk
+        except asyncio.TimeoutError:
+            self._record(False)
+            raise HTTPException(status_code=504, detail="انتهت مهلة المساعد الذكي")
+        except (HTTPException, asyncio.CancelledError, GeneratorExit):
+            # انقطاع اتصال العميل أو أخطاء الإعداد لا تُحسب فشلاً للمزود
+            self._probing = False
+            raise
+        except Exception:
+            self._record(False)
+            raise
+        else:
+            self._record(True)
+        finally:
+            self._slots.release()
+            await stream.aclose()
+
+legal_llm = LLMClient(
+    LLM_BACKENDS[LLM_BACKEND](),
+    max_in_flight=LLM_MAX_IN_FLIGHT,
+    timeout=LLM_TIMEOUT,
+    queue_timeout=LLM_QUEUE_TIMEOUT,
+    failure_threshold=LLM_CIRCUIT_FAILURES,
+    reset_after=LLM_CIRCUIT_RESET
+)
+
+async def save_legal_exchange(session_id: str, current_user: User, question: str, response: str, sources: List[dict]):
+    """حفظ سؤال المستخدم ورد المساعد في سجل الجلسة وتحديث ملخص الجلسة"""
+    # رسالة المستخدم
+    user_msg = LegalChatMessage(
+        session_id=session_id,
+        user_id=current_user.id,
+        user_name=current_user.full_name,
+        role="user",
+        content=question
+    )
+    user_msg_dict = user_msg.model_dump()
+    user_msg_dict['created_at'] = user_msg_dict['created_at'].isoformat()
+    
+    # رد المساعد
+    assistant_msg = LegalChatMessage(
+        session_id=session_id,
+        user_id="ai",
+        user_name="المساعد القانوني",
+        role="assistant",
+        content=response,
+        sources=sources
+    )
+    assistant_msg_dict = assistant_msg.model_dump()
+    assistant_msg_dict['created_at'] = assistant_msg_dict['created_at'].isoformat()
+    
+    await db.legal_chat_messages.insert_many([user_msg_dict, assistant_msg_dict])
+    
+    # ملخص الجلسة: العنوان من أول سؤال، وعدد أسئلة المستخدم وآخر نشاط
+    await db.legal_chat_sessions.update_one(
+        {"_id": session_id},
+        {
+            "$setOnInsert": {
+                "user_id": current_user.id,
+                "first_message": question,
+                "title": question[:80],
+                "created_at": user_msg_dict['created_at']
+            },
+            "$inc": {"message_count": 1},
+            "$set": {"last_activity": assistant_msg_dict['created_at']}
+        },
+        upsert=True
+    )
+    return assistant_msg.id
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def build_legal_context(question: str) -> tuple:
+    """سياق المساعد من المواد الأكثر صلة ضمن ميزانية الرموز، ومصادره (مستند واحد لكل نظام)"""
+    if legal_index.ready:
+        passages = await select_legal_passages(question, LEGAL_AI_CONTEXT_TOKENS, LEGAL_AI_TOP_PASSAGES)
+    else:
+        # الفهرس لم يُبنَ بعد: أول جزء من المستندات المطابقة كما في السابق
+        docs = await db.legal_documents.find(
+            {"$or": [
+                {"title": {"$regex": re.escape(question), "$options": "i"}},
+                {"keywords": {"$elemMatch": {"$regex": re.escape(question), "$options": "i"}}}
+            ]},
+            {"_id": 0, "id": 1, "title": 1, "category": 1, "content": 1, "source": 1, "year": 1, "number": 1}
+        ).limit(3).to_list(3)
+        passages = [
+            {"doc": doc, "heading": None, "text": doc.get("content", "")[:LEGAL_PASSAGE_MAX_CHARS], "score": 0}
+            for doc in docs
+        ]
+    
+    context = ""
+    sources = {}
+    if passages:
+        context = "\n\nالمعلومات المتوفرة في المكتبة القانونية:\n"
+        for passage in passages:
+            doc = passage["doc"]
+            heading = f" - {passage['heading']}" if passage["heading"] else ""
+            context += f"\n--- {doc.get('title', '')}{heading} ---\n{passage['text']}\n"
+            source = sources.setdefault(doc["id"], {
+                "id": doc["id"],
+                "title": doc.get('title'),
+                "category": doc.get('category'),
+                "source": doc.get('source'),
+                "year": doc.get('year'),
+                "number": doc.get('number'),
+                "articles": []
+            })
+            if passage["heading"]:
+                source["articles"].append(passage["heading"])
+    return context, list(sources.values())
+
+@api_router.post("/legal-library/ai/chat")
+async def legal_ai_chat(request: LegalChatRequest, current_user: User = Depends(get_current_user)):
+    """المحادثة مع المساعد القانوني الذكي"""
+    # إنشاء session_id جديد إذا لم يكن موجوداً
+    session_id = request.session_id or str(uuid.uuid4())
+    
+    # البحث في المكتبة القانونية عن أكثر المواد صلة بالسؤال
+    context, sources = await build_legal_context(request.message)
+    
+    # بناء رسالة النظام
+    system_message = LEGAL_AI_SYSTEM_PROMPT + context
+    
+    try:
+        # الأسئلة المتكررة بنفس السياق تُجاب من الذاكرة المؤقتة بدون استدعاء النموذج
+        cache_key = legal_ai_cache_key(request.message, context, LEGAL_AI_MODEL, legal_llm.backend.name)
+        response = await get_cached_legal_answer(cache_key)
+        cached = response is not None
         
-        # حفظ رد المساعد
-        assistant_msg = LegalChatMessage(
-            session_id=session_id,
-            user_id="ai",
-            user_name="المساعد القانوني",
-            role="assistant",
-            content=response,
-            sources=sources
-        )
-        assistant_msg_dict = assistant_msg.model_dump()
-        assistant_msg_dict['created_at'] = assistant_msg_dict['created_at'].isoformat()
-        await db.legal_chat_messages.insert_one(assistant_msg_dict)
+        if not cached:
+            # إرسال الرسالة عبر العميل المشترك (حد التزامن والمهلة وقاطع الدائرة)
+            response = await legal_llm.complete(session_id, system_message, request.message)
+            await store_legal_answer(cache_key, request.message, response, sources)
+        
+        await save_legal_exchange(session_id, current_user, request.message, response, sources)
         
         return {
             "session_id": session_id,
             "response": response,
-            "sources": sources
+            "sources": sources,
+            "cached": cached
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in legal AI chat: {str(e)}")
         raise HTTPException(status_code=500, detail=f"حدث خطأ في المساعد الذكي: {str(e)}")
 
+@api_router.post("/legal-library/ai/chat/stream")
+async def legal_ai_chat_stream(request: LegalChatRequest, current_user: User = Depends(get_current_user)):
+    """المحادثة مع المساعد القانوني كبث (SSE): المصادر أولاً ثم أجزاء الرد ثم done"""
+    session_id = request.session_id or str(uuid.uuid4())
+    context, sources = await build_legal_context(request.message)
+    system_message = LEGAL_AI_SYSTEM_PROMPT + context
+    cache_key = legal_ai_cache_key(request.message, context, LEGAL_AI_MODEL, legal_llm.backend.name)
+    
+    async def events():
+        yield sse_event("sources", {"session_id": session_id, "sources": sources})
+        try:
+            response = await get_cached_legal_answer(cache_key)
+            cached = response is not None
+            if cached:
+                yield sse_event("delta", {"text": response})
+            else:
+                parts = []
+                async for text in legal_llm.stream(session_id, system_message, request.message):
+                    parts.append(text)
+                    yield sse_event("delta", {"text": text})
+                response = "".join(parts)
+                await store_legal_answer(cache_key, request.message, response, sources)
+            
+            # الرد يُحفظ فقط بعد اكتماله
+            message_id = await save_legal_exchange(session_id, current_user, request.message, response, sources)
+            yield sse_event("done", {"session_id": session_id, "message_id": message_id, "cached": cached})
+        except Exception as e:
+            logger.error(f"Error in legal AI chat stream: {str(e)}")
+            yield sse_event("error", {"detail": f"حدث خطأ في المساعد الذكي: {getattr(e, 'detail', str(e))}"})
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @api_router.get("/legal-library/ai/history/{session_id}")
 async def get_chat_history(session_id: str, current_user: User = Depends(get_current_user)):
     """الحصول على سجل المحادثة"""
@@ -3458,24 +5339,67 @@ async def get_chat_history(session_id: str, current_user: User = Depends(get_cur
 @api_router.get("/legal-library/ai/sessions")
 async def get_user_sessions(current_user: User = Depends(get_current_user)):
     """الحصول على جلسات المحادثة للمستخدم"""
+    sessions = await db.legal_chat_sessions.find(
+        {"user_id": current_user.id}
+    ).sort("last_activity", -1).limit(20).to_list(20)
+    return sessions
+
+@api_router.post("/admin/migrations/legal-chat-sessions")
+async def migrate_legal_chat_sessions(current_user: User = Depends(get_current_user)):
+    """إنشاء ملخصات الجلسات للمحادثات السابقة من سجل الرسائل، وتصحيح الملخصات الموجودة (آمن للتكرار)"""
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="للمدير فقط")
+    
     pipeline = [
-        {"$match": {"user_id": current_user.id, "role": "user"}},
+        {"$match": {"role": "user"}},
+        {"$sort": {"created_at": 1}},
         {"$group": {
             "_id": "$session_id",
+            "user_id": {"$first": "$user_id"},
             "first_message": {"$first": "$content"},
             "created_at": {"$first": "$created_at"},
+            "last_activity": {"$last": "$created_at"},
             "message_count": {"$sum": 1}
-        }},
-        {"$sort": {"created_at": -1}},
-        {"$limit": 20}
+        }}
     ]
-    sessions = await db.legal_chat_messages.aggregate(pipeline).to_list(20)
-    return sessions
+    operations = []
+    async for session in db.legal_chat_messages.aggregate(pipeline, allowDiskUse=True):
+        # الملخص قد يكون أُنشئ بعد النشر من أول رسالة جديدة فقط (عدد 1 وعنوان خاطئ)،
+        # لذا يُصلح الموجود من السجل الكامل بدلاً من تجاهله
+        is_older = {"$or": [
+            {"$eq": [{"$type": "$created_at"}, "missing"]},
+            {"$lt": [session["created_at"], "$created_at"]}
+        ]}
+        operations.append(UpdateOne(
+            {"_id": session["_id"]},
+            [{"$set": {
+                "user_id": {"$ifNull": ["$user_id", session["user_id"]]},
+                "first_message": {"$cond": [is_older, session["first_message"], "$first_message"]},
+                "title": {"$cond": [is_older, (session["first_message"] or "")[:80], "$title"]},
+                "created_at": {"$min": ["$created_at", session["created_at"]]},
+                "last_activity": {"$max": ["$last_activity", session["last_activity"]]},
+                "message_count": {"$max": ["$message_count", session["message_count"]]}
+            }}],
+            upsert=True
+        ))
+    created = 0
+    repaired = 0
+    for i in range(0, len(operations), 1000):
+        result = await db.legal_chat_sessions.bulk_write(operations[i:i + 1000], ordered=False)
+        created += result.upserted_count
+        repaired += result.modified_count
+    
+    return {
+        "message": f"تم إنشاء {created} ملخص جلسة وتصحيح {repaired}",
+        "created_sessions": created,
+        "repaired_sessions": repaired
+    }
 
 @api_router.delete("/legal-library/ai/sessions/{session_id}")
 async def delete_chat_session(session_id: str, current_user: User = Depends(get_current_user)):
     """حذف جلسة محادثة"""
     await db.legal_chat_messages.delete_many({"session_id": session_id})
+    await db.legal_chat_sessions.delete_one({"_id": session_id})
     return {"message": "تم حذف الجلسة بنجاح"}
 
 # ==================== طلبات العملاء ====================
@@ -3507,7 +5431,7 @@ async def create_client_request(request_input: ClientRequestCreate, current_user
         description=request_input.description,
         phone_number=request_input.phone_number,
         service_type=request_input.service_type,
-        attachments=request_input.attachments,
+        attachments=await store_inline_attachments(request_input.attachments),
     )
     
     doc = request_obj.model_dump()
@@ -3647,6 +5571,7 @@ async def delete_client_request(request_id: str, current_user: User = Depends(ge
         raise HTTPException(status_code=404, detail="الطلب غير موجود")
     
     await db.client_requests.delete_one({"id": request_id})
+    await release_attachments(request.get('attachments', []) + request.get('files', []))
     
     await log_action("delete", "client_request", request_id, current_user.id, current_user.full_name,
                     f"حذف طلب العميل: {request.get('subject', 'بدون عنوان')}")
@@ -3884,7 +5809,7 @@ async def create_task(task_input: TaskCreate, current_user: User = Depends(get_c
         assigned_to=task_input.assigned_to,
         assigned_to_names=task_input.assigned_to_names,
         hidden_fields=task_input.hidden_fields,
-        attachments=task_input.attachments,
+        attachments=await store_inline_attachments(task_input.attachments),
         due_date=task_input.due_date,
         created_by=current_user.id,
         created_by_name=current_user.full_name,
@@ -3953,7 +5878,8 @@ async def create_task_from_request(
         assigned_to=task_input.assigned_to,
         assigned_to_names=task_input.assigned_to_names,
         hidden_fields=task_input.hidden_fields,
-        attachments=client_request.get('attachments', []),
+        # المرفقات تُنسخ كمراجع فقط مع زيادة عداد المراجع
+        attachments=await store_inline_attachments(client_request.get('attachments', []), accept_refs=True),
         due_date=task_input.due_date,
         created_by=current_user.id,
         created_by_name=current_user.full_name,
@@ -4201,7 +6127,7 @@ async def add_task_update(
         updated_by=current_user.id,
         updated_by_name=current_user.full_name,
         visible_to_client=update_input.visible_to_client,
-        attachments=update_input.attachments
+        attachments=await store_inline_attachments(update_input.attachments)
     )
     
     doc = update_obj.model_dump()
@@ -4266,9 +6192,18 @@ async def delete_task(task_id: str, current_user: User = Depends(get_current_use
     if not task:
         raise HTTPException(status_code=404, detail="المهمة غير موجودة")
     
+    updates = await db.task_updates.find(
+        {"task_id": task_id, "attachments.0": {"$exists": True}},
+        {"_id": 0, "attachments": 1}
+    ).to_list(None)
+    
     await db.tasks.delete_one({"id": task_id})
     await db.task_updates.delete_many({"task_id": task_id})
     
+    await release_attachments(task.get('attachments', []))
+    for update in updates:
+        await release_attachments(update['attachments'])
+    
     await log_action(
         "delete", "task", task_id,
         current_user.id, current_user.full_name,
@@ -4670,7 +6605,10 @@ async def compose_email(email_input: EmailCompose, current_user: User = Depends(
         subject=email_input.subject,
         body=email_input.body,
         body_html=email_input.body_html,
-        attachments=email_input.attachments,
+        attachments=await store_inline_attachments(
+            email_input.attachments,
+            allowed_refs=await readable_email_attachment_refs(email_input.source_email_id, current_user)
+        ),
         priority=email_input.priority,
         related_task_id=email_input.related_task_id,
         is_external=email_input.is_external,
@@ -4913,8 +6851,53 @@ async def get_starred(
         "pages": (total + limit - 1) // limit
     }
 
+async def get_thread_page(thread_id: str, before: Optional[str] = None, limit: int = 20) -> dict:
+    """صفحة من سلسلة الرسائل بدون النصوص والمرفقات (الأحدث أولاً ثم تُعرض تصاعدياً)"""
+    limit = max(1, min(limit, 100))
+    match = {"thread_id": thread_id, "status": EmailStatus.SENT}
+    if before:
+        match["sent_at"] = {"$lt": before}
+    
+    items = await db.emails.aggregate([
+        {"$match": match},
+        {"$sort": {"sent_at": -1}},
+        {"$limit": limit + 1},
+        {"$project": {
+            "_id": 0,
+            "id": 1,
+            "sender_id": 1,
+            "sender_name": 1,
+            "sender_email": 1,
+            "recipients": 1,
+            "subject": 1,
+            "priority": 1,
+            "is_external": 1,
+            "is_reply": 1,
+            "is_forwarded": 1,
+            "sent_at": 1,
+            # مقتطف قصير بدلاً من النص الكامل، والنص يُجلب عند الطلب عبر /emails/{id}
+            "snippet": {"$substrCP": [{"$ifNull": ["$body", ""]}, 0, 200]},
+            "attachment_count": {"$size": {"$ifNull": ["$attachments", []]}}
+        }}
+    ]).to_list(limit + 1)
+    
+    has_more = len(items) > limit
+    items = items[:limit]
+    items.reverse()
+    
+    return {
+        "items": items,
+        "has_more": has_more,
+        "next_before": items[0]["sent_at"] if has_more and items else None
+    }
+
 @api_router.get("/emails/{email_id}")
-async def get_email(email_id: str, current_user: User = Depends(get_current_user)):
+async def get_email(
+    email_id: str,
+    include_thread: bool = True,
+    thread_limit: int = 20,
+    current_user: User = Depends(get_current_user)
+):
     """جلب تفاصيل بريد"""
     if current_user.role == UserRole.CLIENT:
         raise HTTPException(status_code=403, detail="البريد متاح للموظفين فقط")
@@ -4923,36 +6906,56 @@ async def get_email(email_id: str, current_user: User = Depends(get_current_user
     if not email:
         raise HTTPException(status_code=404, detail="البريد غير موجود")
     
-    # التحقق من الصلاحية
+    # التحديد كمقروء يتحقق من الصلاحية في نفس الطلب
+    is_recipient = await db.email_recipients.find_one_and_update(
+        {"email_id": email_id, "user_id": current_user.id},
+        {"$set": {"is_read": True, "read_at": datetime.now(timezone.utc).isoformat()}},
+        projection={"_id": 1}
+    )
     is_sender = email.get('sender_id') == current_user.id
-    is_recipient = await db.email_recipients.find_one({
-        "email_id": email_id,
-        "user_id": current_user.id
-    })
     
     if not is_sender and not is_recipient:
         raise HTTPException(status_code=403, detail="غير مصرح")
     
-    # تحديد كمقروء
-    if is_recipient:
-        await db.email_recipients.update_one(
-            {"email_id": email_id, "user_id": current_user.id},
-            {"$set": {"is_read": True, "read_at": datetime.now(timezone.utc).isoformat()}}
-        )
-    
-    # جلب سلسلة الرد إذا وجدت
-    thread_emails = []
-    if email.get('thread_id'):
-        thread_emails = await db.emails.find({
-            "thread_id": email.get('thread_id'),
-            "status": EmailStatus.SENT
-        }, {"_id": 0}).sort("sent_at", 1).to_list(50)
+    # جلب سلسلة الرد إذا وجدت (بيانات مختصرة ومقسمة لصفحات)
+    thread = {"items": [], "has_more": False, "next_before": None}
+    if include_thread and email.get('thread_id'):
+        thread = await get_thread_page(email['thread_id'], limit=thread_limit)
     
     return {
         "email": email,
-        "thread": thread_emails
+        "thread": thread["items"],
+        "thread_has_more": thread["has_more"],
+        "thread_next_before": thread["next_before"]
     }
 
+@api_router.get("/emails/{email_id}/thread")
+async def get_email_thread(
+    email_id: str,
+    before: Optional[str] = None,
+    limit: int = 20,
+    current_user: User = Depends(get_current_user)
+):
+    """صفحات أقدم من سلسلة الرسائل باستخدام before = sent_at لأقدم رسالة معروضة"""
+    if current_user.role == UserRole.CLIENT:
+        raise HTTPException(status_code=403, detail="البريد متاح للموظفين فقط")
+    
+    email = await db.emails.find_one({"id": email_id}, {"_id": 0, "sender_id": 1, "thread_id": 1})
+    if not email:
+        raise HTTPException(status_code=404, detail="البريد غير موجود")
+    
+    if email.get('sender_id') != current_user.id:
+        is_recipient = await db.email_recipients.find_one(
+            {"email_id": email_id, "user_id": current_user.id}, {"_id": 1}
+        )
+        if not is_recipient:
+            raise HTTPException(status_code=403, detail="غير مصرح")
+    
+    if not email.get('thread_id'):
+        return {"items": [], "has_more": False, "next_before": None}
+    
+    return await get_thread_page(email['thread_id'], before, limit)
+
 @api_router.put("/emails/{email_id}")
 async def update_email(
     email_id: str,
@@ -5032,6 +7035,251 @@ async def restore_email(email_id: str, current_user: User = Depends(get_current_
     
     return {"message": "تم استعادة البريد"}
 
+# ==================== تنزيل الملفات (Range / ETag) ====================
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """مقارنة If-None-Match (قائمة وسوم، *، أو وسوم ضعيفة W/) بالوسم الحالي حسب المقارنة الضعيفة في RFC 9110"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+def parse_range_header(range_header: Optional[str], size: int):
+    """تحليل ترويسة Range لنطاق واحد؛ يعيد (start, end) أو None للملف كاملاً، ويرفع ValueError إن تعذر تلبيته
+    
+    حسب RFC 9110 يُتجاهل النطاق غير الصالح صياغياً (مثل bytes=9-3) ويُرسل الملف كاملاً،
+    أما النطاق الصالح الذي لا يقع داخل الملف (أو bytes=-0) فيعيد 416
+    """
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start_str, _, end_str = range_header[6:].strip().partition("-")
+    if not start_str:
+        # نطاق لاحقة: آخر N بايت
+        if not end_str.isdigit():
+            return None
+        suffix = int(end_str)
+        if suffix == 0:
+            raise ValueError(range_header)
+        if size == 0:
+            return None
+        return max(size - suffix, 0), size - 1
+    if not start_str.isdigit() or (end_str and not end_str.isdigit()):
+        return None
+    start = int(start_str)
+    end = int(end_str) if end_str else size - 1
+    if end_str and end < start:
+        return None
+    if start >= size:
+        raise ValueError(range_header)
+    return start, min(end, size - 1)
+
+async def blob_response(
+    request: Request,
+    blob_id: str,
+    size: int,
+    content_type: str,
+    filename: Optional[str] = None,
+    etag: Optional[str] = None,
+    disposition: str = "attachment",
+    cache_control: str = "private, max-age=31536000, immutable"
+):
+    """استجابة تدفق لملف من المخزن مع دعم Range وETag و304"""
+    headers = {"Accept-Ranges": "bytes"}
+    if etag:
+        etag = f'"{etag}"'
+        headers["ETag"] = etag
+        # افتراضياً المحتوى معنون ببصمته فلا يتغير أبداً
+        headers["Cache-Control"] = cache_control
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
+    if filename:
+        headers["Content-Disposition"] = f"{disposition}; filename*=UTF-8''{quote(filename)}"
+    
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if if_range and if_range.strip() != etag:
+        range_header = None
+    try:
+        byte_range = parse_range_header(range_header, size)
+    except ValueError:
+        headers["Content-Range"] = f"bytes */{size}"
+        return Response(status_code=416, headers=headers)
+    
+    start, end = byte_range if byte_range else (0, size - 1)
+    length = max(end - start + 1, 0)
+    stream = blob_store.stream(blob_id, start, length)
+    
+    # التأكد من وجود الملف قبل بدء إرسال الاستجابة
+    try:
+        first_chunk = await stream.__anext__() if length else b""
+    except StopAsyncIteration:
+        first_chunk = b""
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="الملف غير موجود")
+    
+    async def body():
+        yield first_chunk
+        async for chunk in stream:
+            yield chunk
+    
+    headers["Content-Length"] = str(length)
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return StreamingResponse(
+        body(),
+        status_code=206 if byte_range else 200,
+        media_type=content_type,
+        headers=headers
+    )
+
+@api_router.get("/files/{file_id}")
+async def download_file(
+    file_id: str,
+    request: Request,
+    name: Optional[str] = None,
+    inline: bool = False,
+    current_user: User = Depends(get_current_user)
+):
+    """تنزيل ملف بمعرف المحتوى (SHA-256) مع دعم التنزيل الجزئي والاستئناف"""
+    if not re.fullmatch(r"[0-9a-f]{64}", file_id):
+        raise HTTPException(status_code=404, detail="الملف غير موجود")
+    
+    blob = await db.attachment_blobs.find_one({"_id": file_id})
+    if not blob:
+        raise HTTPException(status_code=404, detail="الملف غير موجود")
+    
+    # العميل يصل فقط إلى ملفات طلباته ومهامه
+    if current_user.role == UserRole.CLIENT:
+        owned = await db.client_requests.find_one(
+            {"client_id": current_user.id, "$or": [{"attachments.sha256": file_id}, {"files.sha256": file_id}]},
+            {"_id": 1}
+        ) or await db.tasks.find_one(
+            {"client_id": current_user.id, "attachments.sha256": file_id},
+            {"_id": 1}
+        )
+        if not owned:
+            raise HTTPException(status_code=403, detail="غير مصرح")
+    
+    return await blob_response(
+        request,
+        blob["blob_id"],
+        blob["size"],
+        blob.get("content_type") or "application/octet-stream",
+        filename=name,
+        etag=file_id,
+        disposition="inline" if inline else "attachment"
+    )
+
+async def readable_email_attachment_refs(email_id: Optional[str], current_user: User) -> set:
+    """بصمات مرفقات بريد مصدر (للتحويل أو إعادة الإرسال) بعد التحقق من أن المستخدم مرسله أو أحد مستلميه"""
+    if not email_id:
+        return set()
+    email = await db.emails.find_one({"id": email_id}, {"_id": 0, "sender_id": 1, "attachments.sha256": 1})
+    if not email:
+        raise HTTPException(status_code=404, detail="البريد المصدر غير موجود")
+    if email.get('sender_id') != current_user.id:
+        is_recipient = await db.email_recipients.find_one(
+            {"email_id": email_id, "user_id": current_user.id}, {"_id": 1}
+        )
+        if not is_recipient:
+            raise HTTPException(status_code=403, detail="غير مصرح")
+    return {att["sha256"] for att in email.get('attachments', []) if att.get("sha256")}
+
+@api_router.get("/emails/{email_id}/attachments/{attachment_id}")
+async def download_email_attachment(email_id: str, attachment_id: str, request: Request, current_user: User = Depends(get_current_user)):
+    """تنزيل مرفق بريد كتدفق من مخزن الملفات"""
+    if current_user.role == UserRole.CLIENT:
+        raise HTTPException(status_code=403, detail="البريد متاح للموظفين فقط")
+    
+    email = await db.emails.find_one(
+        {"id": email_id},
+        {"_id": 0, "sender_id": 1, "attachments": {"$elemMatch": {"id": attachment_id}}}
+    )
+    if not email or not email.get('attachments'):
+        raise HTTPException(status_code=404, detail="المرفق غير موجود")
+    
+    if email.get('sender_id') != current_user.id:
+        is_recipient = await db.email_recipients.find_one(
+            {"email_id": email_id, "user_id": current_user.id}, {"_id": 1}
+        )
+        if not is_recipient:
+            raise HTTPException(status_code=403, detail="غير مصرح")
+    
+    attachment = email['attachments'][0]
+    if not attachment.get('blob_id'):
+        raise HTTPException(status_code=404, detail="المرفق غير موجود")
+    
+    return await blob_response(
+        request,
+        attachment['blob_id'],
+        attachment.get('size', 0),
+        attachment.get('type') or "application/octet-stream",
+        filename=attachment.get('name') or 'attachment',
+        etag=attachment.get('sha256')
+    )
+
+@api_router.post("/admin/migrations/email-attachments")
+async def migrate_email_attachments(batch_size: int = 100, current_user: User = Depends(get_current_user)):
+    """نقل المرفقات المضمنة (base64) في البريد إلى مخزن الملفات"""
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="للمدير فقط")
+    
+    migrated_emails = 0
+    migrated_attachments = 0
+    while True:
+        batch = await db.emails.find(
+            {"attachments.data": {"$exists": True}},
+            {"_id": 0, "id": 1, "attachments": 1}
+        ).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+        
+        for email in batch:
+            attachments = await store_inline_attachments(
+                email.get('attachments', []), retain_existing=False, accept_refs=True
+            )
+            await db.emails.update_one({"id": email['id']}, {"$set": {"attachments": attachments}})
+            migrated_emails += 1
+            migrated_attachments += sum(1 for att in email.get('attachments', []) if att.get('data'))
+    
+    return {
+        "message": f"تم نقل {migrated_attachments} مرفق من {migrated_emails} رسالة",
+        "migrated_emails": migrated_emails,
+        "migrated_attachments": migrated_attachments
+    }
+
+@api_router.post("/admin/migrations/email-duplicates")
+async def dedupe_external_emails(current_user: User = Depends(get_current_user)):
+    """حذف النسخ المكررة من الرسائل الخارجية ثم إنشاء الفهرس الفريد على external_message_id
+    
+    تُبقى أقدم نسخة لكل رسالة، وتُحذف البقية مع مستلميها ومراجع مرفقاتها
+    """
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="للمدير فقط")
+    
+    duplicates = db.emails.aggregate([
+        {"$match": {"external_message_id": {"$type": "string"}}},
+        {"$sort": {"created_at": 1, "_id": 1}},
+        {"$group": {"_id": "$external_message_id", "ids": {"$push": "$id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True)
+    
+    removed = 0
+    async for group in duplicates:
+        extra_ids = group["ids"][1:]
+        async for email in db.emails.find({"id": {"$in": extra_ids}}, {"_id": 0, "attachments": 1}):
+            await release_attachments(email.get("attachments"))
+        await db.email_recipients.delete_many({"email_id": {"$in": extra_ids}})
+        result = await db.emails.delete_many({"id": {"$in": extra_ids}})
+        removed += result.deleted_count
+    
+    await db.emails.create_index("external_message_id", **EXTERNAL_MESSAGE_ID_INDEX_OPTIONS)
+    logger.info(f"Removed {removed} duplicate external emails; unique index on external_message_id created")
+    return {"message": f"تم حذف {removed} رسالة مكررة", "removed": removed}
+
 @api_router.get("/emails/stats/unread")
 async def get_email_stats(current_user: User = Depends(get_current_user)):
     """إحصائيات البريد"""
@@ -6382,6 +8630,32 @@ async def update_player_profile(user_id: str, user_name: str, score: int, passed
         }
         await db.game_profiles.insert_one(new_profile)
 
+# ==================== المهام الخلفية والأقفال الموزعة ====================
+
+# معرف فريد لهذه العملية لتمييز مالك القفل بين عدة عمال uvicorn أو خوادم
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+# المهام الخلفية التي تعمل طوال عمر التطبيق
+background_tasks: List[asyncio.Task] = []
+
+async def acquire_lock(name: str, ttl_seconds: int) -> bool:
+    """حجز قفل موزع في MongoDB أو تجديده إذا كان مملوكاً لهذه العملية"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.locks.find_one_and_update(
+            {"_id": name, "$or": [{"expires_at": {"$lt": now}}, {"owner": WORKER_ID}]},
+            {"$set": {"owner": WORKER_ID, "expires_at": now + timedelta(seconds=ttl_seconds)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # القفل موجود ومملوك لعملية أخرى لم تنتهِ صلاحيتها
+        return False
+
+async def release_lock(name: str):
+    """تحرير قفل موزع إذا كان مملوكاً لهذه العملية"""
+    await db.locks.delete_one({"_id": name, "owner": WORKER_ID})
+
 # ==================== وظائف البريد الخارجي (IMAP/SMTP) ====================
 
 def decode_email_header(header):
@@ -6432,7 +8706,7 @@ def get_email_body(msg):
     return body
 
 def get_email_attachments(msg):
-    """استخراج المرفقات"""
+    """استخراج المرفقات كمحتوى خام (يُحفظ لاحقاً في مخزن الملفات)"""
     attachments = []
     if msg.is_multipart():
         for part in msg.walk():
@@ -6446,180 +8720,477 @@ def get_email_attachments(msg):
                         attachments.append({
                             "name": filename,
                             "type": part.get_content_type(),
-                            "size": len(payload),
-                            "data": base64.b64encode(payload).decode('utf-8')
+                            "content": payload
                         })
     return attachments
 
-def sync_fetch_external_emails():
-    """جلب الرسائل من IMAP بشكل متزامن"""
+def fallback_message_id(msg) -> str:
+    """معرّف ثابت لرسالة بدون Message-ID حتى لا تُستورد في كل دورة كرسالة جديدة"""
+    fingerprint = "\n".join(str(msg.get(header, '')) for header in ('Date', 'From', 'To', 'Subject'))
+    return f"<{hashlib.sha256(fingerprint.encode('utf-8', errors='replace')).hexdigest()}@no-message-id>"
+
+def sync_fetch_external_emails(uid_validity: Optional[int] = None, last_uid: int = 0):
+    """جلب الرسائل الجديدة فقط من IMAP (UID أكبر من آخر UID تمت مزامنته) بشكل متزامن
+    
+    يعيد (الرسائل، UIDVALIDITY، آخر UID)؛ عند أول تشغيل أو تغير UIDVALIDITY تُجلب آخر
+    EMAIL_SYNC_BATCH_SIZE رسالة فقط. يرفع الاستثناء عند فشل الاتصال
+    """
     if not EMAIL_ADDRESS or not EMAIL_PASSWORD:
-        return []
+        return [], uid_validity, last_uid
     
     emails_data = []
     try:
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
+        mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT, timeout=60)
         mail.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
         mail.select('INBOX')
         
-        # جلب آخر 50 رسالة
-        status, messages = mail.search(None, 'ALL')
-        if status == 'OK':
-            email_ids = messages[0].split()
-            # آخر 50 رسالة
-            recent_ids = email_ids[-50:] if len(email_ids) > 50 else email_ids
-            
-            for email_id in reversed(recent_ids):
-                try:
-                    status, msg_data = mail.fetch(email_id, '(RFC822)')
-                    if status == 'OK':
-                        raw_email = msg_data[0][1]
-                        msg = email_lib.message_from_bytes(raw_email)
-                        
-                        # استخراج البيانات
-                        subject = decode_email_header(msg.get('Subject', ''))
-                        from_header = decode_email_header(msg.get('From', ''))
-                        to_header = decode_email_header(msg.get('To', ''))
-                        date_header = msg.get('Date', '')
-                        message_id = msg.get('Message-ID', str(uuid.uuid4()))
-                        
-                        # تحويل التاريخ
-                        try:
-                            from email.utils import parsedate_to_datetime
-                            sent_date = parsedate_to_datetime(date_header)
-                        except:
-                            sent_date = datetime.now(timezone.utc)
-                        
-                        # استخراج اسم وبريد المرسل
-                        sender_name = from_header
-                        sender_email = from_header
-                        if '<' in from_header:
-                            parts = from_header.split('<')
-                            sender_name = parts[0].strip().strip('"')
-                            sender_email = parts[1].strip('>')
-                        
-                        body = get_email_body(msg)
-                        attachments = get_email_attachments(msg)
-                        
-                        emails_data.append({
-                            "message_id": message_id,
-                            "subject": subject or "(بدون موضوع)",
-                            "sender_name": sender_name,
-                            "sender_email": sender_email,
-                            "to": to_header,
-                            "body": body,
-                            "attachments": attachments,
-                            "sent_at": sent_date.isoformat(),
-                            "imap_id": email_id.decode() if isinstance(email_id, bytes) else str(email_id)
-                        })
-                except Exception as e:
-                    logging.error(f"Error processing email {email_id}: {e}")
-                    continue
+        _, validity_data = mail.response('UIDVALIDITY')
+        mailbox_validity = int(validity_data[0]) if validity_data and validity_data[0] else None
+        if mailbox_validity != uid_validity:
+            # صندوق جديد أو أُعيد ترقيمه: الأرقام القديمة لا معنى لها
+            last_uid = 0
+        
+        if last_uid:
+            status, messages = mail.uid('SEARCH', None, 'UID', f'{last_uid + 1}:*')
+        else:
+            status, messages = mail.uid('SEARCH', None, 'ALL')
+        if status != 'OK':
+            raise Exception(f"IMAP UID SEARCH failed: {status}")
+        
+        # "n:*" تعيد آخر رسالة حتى لو كان UID أصغر من n، لذا نصفي النتيجة
+        uids = sorted(uid for uid in map(int, messages[0].split()) if uid > last_uid)
+        if not last_uid:
+            uids = uids[-EMAIL_SYNC_BATCH_SIZE:]
+        else:
+            # الأقدم أولاً حتى يتقدم المؤشر بالترتيب إذا زادت الرسائل عن الدفعة
+            uids = uids[:EMAIL_SYNC_BATCH_SIZE]
+        
+        for uid in uids:
+            try:
+                status, msg_data = mail.uid('FETCH', str(uid), '(RFC822)')
+                if status == 'OK' and msg_data and isinstance(msg_data[0], tuple):
+                    raw_email = msg_data[0][1]
+                    msg = email_lib.message_from_bytes(raw_email)
+                    
+                    # استخراج البيانات
+                    subject = decode_email_header(msg.get('Subject', ''))
+                    from_header = decode_email_header(msg.get('From', ''))
+                    to_header = decode_email_header(msg.get('To', ''))
+                    date_header = msg.get('Date', '')
+                    message_id = (msg.get('Message-ID') or '').strip() or fallback_message_id(msg)
+                    
+                    # تحويل التاريخ
+                    try:
+                        from email.utils import parsedate_to_datetime
+                        sent_date = parsedate_to_datetime(date_header)
+                    except:
+                        sent_date = datetime.now(timezone.utc)
+                    
+                    # استخراج اسم وبريد المرسل
+                    sender_name = from_header
+                    sender_email = from_header
+                    if '<' in from_header:
+                        parts = from_header.split('<')
+                        sender_name = parts[0].strip().strip('"')
+                        sender_email = parts[1].strip('>')
+                    
+                    body = get_email_body(msg)
+                    attachments = get_email_attachments(msg)
+                    
+                    emails_data.append({
+                        "message_id": message_id,
+                        "subject": subject or "(بدون موضوع)",
+                        "sender_name": sender_name,
+                        "sender_email": sender_email,
+                        "to": to_header,
+                        "body": body,
+                        "attachments": attachments,
+                        "sent_at": sent_date.isoformat(),
+                        "imap_id": str(uid)
+                    })
+            except Exception as e:
+                logging.error(f"Error processing email UID {uid}: {e}")
+                continue
         
         mail.logout()
     except Exception as e:
         logging.error(f"IMAP connection error: {e}")
+        raise
+    
+    return emails_data, mailbox_validity, max(uids, default=last_uid)
+
+def build_external_message(to_email: str, subject: str, body: str, attachments: list = None):
+    """تجهيز رسالة MIME للإرسال الخارجي (المرفقات بمحتوى خام content أو base64 data)"""
+    msg = MIMEMultipart('alternative')
+    # تنسيق From header بشكل صحيح لتجنب رفض Gmail
+    from email.header import Header
+    from email.utils import formataddr
+    msg['From'] = formataddr((str(Header('HK Law Firm', 'utf-8')), EMAIL_ADDRESS))
+    msg['To'] = to_email
+    msg['Subject'] = subject
+    msg['Reply-To'] = EMAIL_ADDRESS
+    msg['Message-ID'] = f"<{uuid.uuid4()}@hklaw.sa>"
+    msg['Date'] = datetime.now(timezone.utc).strftime("%a, %d %b %Y %H:%M:%S +0000")
+    msg['X-Mailer'] = "Legal Suite - HK Law Firm"
+    msg['MIME-Version'] = "1.0"
+    
+    # إضافة النص العادي
+    msg.attach(MIMEText(body, 'plain', 'utf-8'))
+    
+    # إضافة نسخة HTML للرسالة (تحسين التوصيل)
+    html_body = f"""
+    <html dir="rtl">
+    <head><meta charset="utf-8"></head>
+    <body style="font-family: Arial, sans-serif; direction: rtl;">
+        <div style="max-width: 600px; margin: 0 auto; padding: 20px;">
+            <div style="white-space: pre-wrap;">{body}</div>
+            <hr style="margin-top: 30px; border: none; border-top: 1px solid #ddd;">
+            <p style="color: #666; font-size: 12px;">
+                مكتب المحامي هشام يوسف الخياط<br>
+                البريد: info@hklaw.sa
+            </p>
+        </div>
+    </body>
+    </html>
+    """
+    msg.attach(MIMEText(html_body, 'html', 'utf-8'))
+    
+    # إضافة المرفقات
+    for att in attachments or []:
+        content = att.get('content')
+        if content is None and att.get('data'):
+            content = base64.b64decode(att['data'])
+        if content is not None:
+            part = MIMEBase('application', 'octet-stream')
+            part.set_payload(content)
+            encoders.encode_base64(part)
+            part.add_header('Content-Disposition', f'attachment; filename="{att.get("name", "attachment")}"')
+            msg.attach(part)
+    
+    return msg
+
+class SMTPConnectionPool:
+    """مجمع اتصالات SMTP مصادق عليها يعاد استخدامها بين الرسائل"""
+    
+    def __init__(self, size: int, idle_timeout: int):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        # يُحفظ وضع الاتصال بعد أول فشل لـ SSL بدلاً من إعادة المحاولة في كل رسالة
+        self._use_starttls = SMTP_PORT == 587
+        self._port = SMTP_PORT
+    
+    def connect(self, timeout: int = 30, remember: bool = True):
+        """فتح اتصال جديد مصادق عليه
+        
+        عند فشل SSL يُجرب STARTTLS على 587، ولا يُحفظ هذا الوضع إلا إذا نجح فعلاً (remember=False
+        لاختبار الاتصال حتى لا يغير وضع الإرسال الفعلي)
+        """
+        if self._use_starttls:
+            return self._login(self._connect_starttls(self._port, timeout))
+        try:
+            server = smtplib.SMTP_SSL(SMTP_SERVER, self._port, timeout=timeout)
+        except Exception as ssl_error:
+            logging.warning(f"SSL failed, trying TLS on port 587: {ssl_error}")
+            server = self._login(self._connect_starttls(587, timeout))
+            if remember:
+                self._use_starttls = True
+                self._port = 587
+            return server
+        return self._login(server)
+    
+    @staticmethod
+    def _connect_starttls(port: int, timeout: int):
+        server = smtplib.SMTP(SMTP_SERVER, port, timeout=timeout)
+        try:
+            server.starttls()
+        except Exception:
+            server.close()
+            raise
+        return server
+    
+    def _login(self, server):
+        try:
+            server.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
+        except Exception:
+            self._close(server)
+            raise
+        return server
+    
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
     
-    return emails_data
+    def acquire(self):
+        """الحصول على اتصال جاهز (من المجمع إن أمكن)"""
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    server, last_used = self._idle.get_nowait()
+                except queue.Empty:
+                    return self.connect()
+                if time.monotonic() - last_used > self.idle_timeout:
+                    self._close(server)
+                    continue
+                try:
+                    if server.noop()[0] == 250:
+                        return server
+                except Exception:
+                    pass
+                self._close(server)
+        except Exception:
+            self._slots.release()
+            raise
+    
+    def release(self, server, broken: bool = False):
+        """إعادة الاتصال إلى المجمع أو إغلاقه إذا تعطل"""
+        if broken:
+            self._close(server)
+        else:
+            self._idle.put((server, time.monotonic()))
+        self._slots.release()
+    
+    def close_all(self):
+        while True:
+            try:
+                server, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._close(server)
 
-def sync_send_external_email(to_email: str, subject: str, body: str, attachments: list = None):
-    """إرسال بريد خارجي عبر SMTP بشكل متزامن"""
+smtp_pool = SMTPConnectionPool(SMTP_POOL_SIZE, SMTP_IDLE_TIMEOUT)
+
+def sync_send_external_batch(messages: list) -> list:
+    """إرسال دفعة رسائل [(to_email, msg)] عبر اتصال واحد، وإرجاع خطأ أو None لكل رسالة"""
     if not EMAIL_ADDRESS or not EMAIL_PASSWORD:
         raise Exception("بيانات SMTP غير مكتملة")
     
+    results = []
+    server = smtp_pool.acquire()
+    broken = False
     try:
-        msg = MIMEMultipart('alternative')
-        # تنسيق From header بشكل صحيح لتجنب رفض Gmail
-        from email.header import Header
-        from email.utils import formataddr
-        msg['From'] = formataddr((str(Header('HK Law Firm', 'utf-8')), EMAIL_ADDRESS))
-        msg['To'] = to_email
-        msg['Subject'] = subject
-        msg['Reply-To'] = EMAIL_ADDRESS
-        msg['Message-ID'] = f"<{uuid.uuid4()}@hklaw.sa>"
-        msg['Date'] = datetime.now(timezone.utc).strftime("%a, %d %b %Y %H:%M:%S +0000")
-        msg['X-Mailer'] = "Legal Suite - HK Law Firm"
-        msg['MIME-Version'] = "1.0"
-        
-        # إضافة النص العادي
-        msg.attach(MIMEText(body, 'plain', 'utf-8'))
-        
-        # إضافة نسخة HTML للرسالة (تحسين التوصيل)
-        html_body = f"""
-        <html dir="rtl">
-        <head><meta charset="utf-8"></head>
-        <body style="font-family: Arial, sans-serif; direction: rtl;">
-            <div style="max-width: 600px; margin: 0 auto; padding: 20px;">
-                <div style="white-space: pre-wrap;">{body}</div>
-                <hr style="margin-top: 30px; border: none; border-top: 1px solid #ddd;">
-                <p style="color: #666; font-size: 12px;">
-                    مكتب المحامي هشام يوسف الخياط<br>
-                    البريد: info@hklaw.sa
-                </p>
-            </div>
-        </body>
-        </html>
-        """
-        msg.attach(MIMEText(html_body, 'html', 'utf-8'))
-        
-        # إضافة المرفقات
-        if attachments:
-            for att in attachments:
-                if att.get('data'):
-                    part = MIMEBase('application', 'octet-stream')
-                    part.set_payload(base64.b64decode(att['data']))
-                    encoders.encode_base64(part)
-                    part.add_header('Content-Disposition', f'attachment; filename="{att.get("name", "attachment")}"')
-                    msg.attach(part)
-        
-        # الاتصال وإرسال - محاولة TLS أولاً ثم SSL
-        if SMTP_PORT == 587:
-            # منفذ 587 يستخدم STARTTLS
-            server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=30)
-            server.starttls()
-        else:
-            # محاولة SSL أولاً، ثم TLS إذا فشل
+        for to_email, msg in messages:
+            if broken:
+                results.append("لم تتم المحاولة: انقطع الاتصال بخادم SMTP")
+                continue
             try:
-                server = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, timeout=30)
-            except Exception as ssl_error:
-                logging.warning(f"SSL failed, trying TLS on port 587: {ssl_error}")
-                server = smtplib.SMTP(SMTP_SERVER, 587, timeout=30)
-                server.starttls()
-        
-        server.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        server.sendmail(EMAIL_ADDRESS, to_email, msg.as_string())
-        server.quit()
+                server.sendmail(EMAIL_ADDRESS, to_email, msg.as_string())
+                results.append(None)
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                # خطأ خاص بهذه الرسالة، الاتصال ما زال صالحاً
+                results.append(str(e))
+            except Exception as e:
+                logging.error(f"SMTP send error: {e}")
+                broken = True
+                results.append(str(e))
+    finally:
+        smtp_pool.release(server, broken)
+    
+    return results
+
+# ==================== قائمة انتظار البريد الصادر ====================
+
+# تنبيه العامل فور إضافة رسالة بدلاً من انتظار دورة الاستطلاع التالية
+outbound_email_event = asyncio.Event()
+
+async def enqueue_external_email(to_email: str, subject: str, body: str, attachments: list = None, email_id: Optional[str] = None) -> str:
+    """إضافة بريد خارجي إلى قائمة الإرسال الدائمة (المرفقات مراجع في مخزن الملفات)"""
+    now = datetime.now(timezone.utc)
+    job = {
+        "id": str(uuid.uuid4()),
+        "email_id": email_id,
+        "to_email": to_email,
+        "subject": subject,
+        "body": body,
+        "attachments": attachments or [],
+        "status": "pending",
+        "attempts": 0,
+        "last_error": None,
+        "next_attempt_at": now,
+        "locked_by": None,
+        "locked_until": None,
+        "created_at": now.isoformat(),
+        "sent_at": None
+    }
+    await db.outbound_emails.insert_one(job)
+    outbound_email_event.set()
+    return job["id"]
+
+async def claim_outbound_emails(limit: int) -> list:
+    """حجز دفعة من الرسائل المستحقة بشكل ذري حتى لا يرسلها عاملان"""
+    jobs = []
+    for _ in range(limit):
+        now = datetime.now(timezone.utc)
+        job = await db.outbound_emails.find_one_and_update(
+            {"$or": [
+                {"status": "pending", "next_attempt_at": {"$lte": now}},
+                # رسائل حجزها عامل توقف قبل إنهائها
+                {"status": "sending", "locked_until": {"$lt": now}}
+            ]},
+            {"$set": {
+                "status": "sending",
+                "locked_by": WORKER_ID,
+                "locked_until": now + timedelta(seconds=OUTBOUND_EMAIL_LOCK_SECONDS)
+            }},
+            sort=[("next_attempt_at", 1)],
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if not job:
+            break
+        jobs.append(job)
+    return jobs
+
+async def complete_outbound_email(job: dict, error: Optional[str]):
+    """تسجيل نتيجة الإرسال مع إعادة الجدولة بتراجع أسي عند الفشل"""
+    now = datetime.now(timezone.utc)
+    if error is None:
+        await db.outbound_emails.update_one(
+            {"id": job["id"]},
+            {"$set": {"status": "sent", "sent_at": now.isoformat(), "last_error": None, "locked_until": None},
+             "$inc": {"attempts": 1}}
+        )
+        if job.get("email_id"):
+            await db.emails.update_one(
+                {"id": job["email_id"]},
+                {"$set": {"delivery_status": "sent", "delivered_at": now.isoformat()}}
+            )
+        return
+    
+    attempts = job.get("attempts", 0) + 1
+    failed = attempts >= OUTBOUND_EMAIL_MAX_ATTEMPTS
+    delay = min(OUTBOUND_EMAIL_RETRY_BASE * (2 ** (attempts - 1)), OUTBOUND_EMAIL_MAX_BACKOFF)
+    await db.outbound_emails.update_one(
+        {"id": job["id"]},
+        {"$set": {
+            "status": "failed" if failed else "pending",
+            "attempts": attempts,
+            "last_error": error,
+            "next_attempt_at": now + timedelta(seconds=delay),
+            "locked_until": None
+        }}
+    )
+    if failed and job.get("email_id"):
+        await db.emails.update_one(
+            {"id": job["email_id"]},
+            {"$set": {"delivery_status": "failed", "delivery_error": error}}
+        )
+
+async def renew_outbound_locks(job_ids: list):
+    """تمديد حجز الدفعة دورياً أثناء الإرسال، فالدفعة الكاملة قد تستغرق أطول من مدة الحجز"""
+    while True:
+        await asyncio.sleep(OUTBOUND_EMAIL_LOCK_SECONDS / 3)
+        try:
+            await db.outbound_emails.update_many(
+                {"id": {"$in": job_ids}, "status": "sending", "locked_by": WORKER_ID},
+                {"$set": {"locked_until": datetime.now(timezone.utc) + timedelta(seconds=OUTBOUND_EMAIL_LOCK_SECONDS)}}
+            )
+        except Exception as e:
+            logger.error(f"Failed to renew outbound email locks: {e}")
+
+async def process_outbound_emails() -> int:
+    """إرسال دفعة مستحقة عبر جلسة SMTP واحدة وإرجاع عدد الرسائل المعالجة"""
+    jobs = await claim_outbound_emails(OUTBOUND_EMAIL_BATCH_SIZE)
+    if not jobs:
+        return 0
+    
+    heartbeat = asyncio.create_task(renew_outbound_locks([job["id"] for job in jobs]))
+    try:
+        await send_outbound_batch(jobs)
+    finally:
+        heartbeat.cancel()
+        await asyncio.gather(heartbeat, return_exceptions=True)
+    return len(jobs)
+
+async def send_outbound_batch(jobs: list):
+    """تجهيز رسائل الدفعة المحجوزة وإرسالها ثم تسجيل نتيجة كل رسالة"""
+    messages = []
+    prepared_jobs = []
+    for job in jobs:
+        try:
+            attachments = [
+                {"name": att.get("name", "attachment"), "content": await read_blob(att["blob_id"])}
+                for att in job.get("attachments", []) if att.get("blob_id")
+            ]
+            messages.append((job["to_email"], build_external_message(job["to_email"], job["subject"], job["body"], attachments)))
+            prepared_jobs.append(job)
+        except Exception as e:
+            await complete_outbound_email(job, f"تعذر تجهيز الرسالة: {e}")
+    
+    if messages:
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(None, sync_send_external_batch, messages)
+        except Exception as e:
+            results = [str(e)] * len(messages)
+        for job, error in zip(prepared_jobs, results):
+            await complete_outbound_email(job, error)
+
+async def outbound_email_worker():
+    """عامل خلفي يفرغ قائمة البريد الصادر"""
+    while True:
+        try:
+            processed = await process_outbound_emails()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Outbound email worker error: {e}")
+            processed = 0
         
-        return True
-    except Exception as e:
-        logging.error(f"SMTP send error: {e}")
-        raise e
+        # الاستمرار مباشرة إذا كانت هناك دفعة ممتلئة، وإلا الانتظار حتى التنبيه أو المهلة
+        if processed < OUTBOUND_EMAIL_BATCH_SIZE:
+            outbound_email_event.clear()
+            try:
+                await asyncio.wait_for(outbound_email_event.wait(), timeout=OUTBOUND_EMAIL_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
 
 class ExternalEmailInput(BaseModel):
     to_email: str
     subject: str
     body: str
     attachments: Optional[List[dict]] = []
-
-@api_router.get("/emails/external/sync")
-async def sync_external_emails(current_user: User = Depends(get_current_user)):
-    """مزامنة الرسائل من البريد الخارجي"""
-    if current_user.role == UserRole.CLIENT:
-        raise HTTPException(status_code=403, detail="غير مصرح")
-    
-    # جلب الرسائل من IMAP في thread منفصل
-    loop = asyncio.get_event_loop()
-    external_emails = await loop.run_in_executor(None, sync_fetch_external_emails)
-    
-    synced_count = 0
+    # بريد يمكن إعادة استخدام مرفقاته كمراجع (sha256) بدون رفع محتواها مرة أخرى
+    source_email_id: Optional[str] = None
+
+async def import_external_emails(external_emails: list) -> int:
+    """حفظ الرسائل الخارجية الجديدة دفعة واحدة وإرجاع عدد ما تمت إضافته"""
+    if not external_emails:
+        return 0
+    
+    # تجاهل الرسائل المستوردة سابقاً قبل رفع مرفقاتها إلى المخزن
+    message_ids = [ext_email["message_id"] for ext_email in external_emails]
+    known = await db.emails.find(
+        {"external_message_id": {"$in": message_ids}},
+        {"_id": 0, "external_message_id": 1}
+    ).to_list(len(message_ids))
+    known_ids = {doc["external_message_id"] for doc in known}
+    external_emails = [e for e in external_emails if e["message_id"] not in known_ids]
+    if not external_emails:
+        return 0
+    
+    attachment_refs = []
     for ext_email in external_emails:
-        # تحقق من عدم وجود الرسالة مسبقاً
-        existing = await db.emails.find_one({"external_message_id": ext_email["message_id"]})
-        if existing:
-            continue
-        
-        # إنشاء البريد في النظام
+        attachment_refs.append([
+            await store_attachment(att["content"], att["name"], att["type"])
+            for att in ext_email["attachments"]
+        ])
+    
+    # التكرار يمنعه الفهرس الفريد على external_message_id، و$setOnInsert لا يغير الموجود
+    now_str = datetime.now(timezone.utc).isoformat()
+    operations = []
+    email_ids = []
+    for ext_email, attachments in zip(external_emails, attachment_refs):
         email_id = str(uuid.uuid4())
+        email_ids.append(email_id)
         email_doc = {
             "id": email_id,
             "sender_id": None,
@@ -6629,106 +9200,260 @@ async def sync_external_emails(current_user: User = Depends(get_current_user)):
             "subject": ext_email["subject"],
             "body": ext_email["body"],
             "body_html": None,
-            "attachments": ext_email["attachments"],
+            "attachments": attachments,
             "priority": "normal",
             "related_task_id": None,
             "is_external": True,
             "external_email": ext_email["sender_email"],
-            "external_message_id": ext_email["message_id"],
             "thread_id": str(uuid.uuid4()),
             "reply_to_id": None,
             "is_reply": False,
             "is_forwarded": False,
             "status": "received",
             "sent_at": ext_email["sent_at"],
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "created_at": now_str
         }
-        
-        await db.emails.insert_one(email_doc)
-        
-        # إنشاء سجل للمستلمين (جميع المدراء والمحامين)
-        staff = await db.users.find({"role": {"$in": ["admin", "lawyer"]}}, {"_id": 0, "id": 1, "email": 1}).to_list(100)
-        for user in staff:
-            recipient_record = {
-                "id": str(uuid.uuid4()),
-                "email_id": email_id,
-                "user_id": user["id"],
-                "user_email": user["email"],
-                "recipient_type": "to",
-                "is_read": False,
-                "is_starred": False,
-                "is_deleted": False,
-                "folder": "inbox"
+        operations.append(UpdateOne(
+            {"external_message_id": ext_email["message_id"]},
+            {"$setOnInsert": email_doc},
+            upsert=True
+        ))
+    
+    try:
+        result = await db.emails.bulk_write(operations, ordered=False)
+        upserted_indexes = list(result.upserted_ids.keys())
+    except BulkWriteError as e:
+        # سباق نادر مع عملية أخرى: نتجاهل أخطاء التكرار فقط
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+        upserted_indexes = [item["index"] for item in e.details.get("upserted", [])]
+    
+    # حذف مرفقات الرسائل التي سبقتنا إليها عملية أخرى
+    upserted_set = set(upserted_indexes)
+    for index, attachments in enumerate(attachment_refs):
+        if index not in upserted_set:
+            await release_attachments(attachments)
+    
+    if not upserted_indexes:
+        return 0
+    
+    # إنشاء سجلات المستلمين (جميع المدراء والمحامين) لكل الرسائل الجديدة دفعة واحدة
+    staff = await db.users.find({"role": {"$in": ["admin", "lawyer"]}}, {"_id": 0, "id": 1, "email": 1}).to_list(100)
+    recipient_records = [
+        {
+            "id": str(uuid.uuid4()),
+            "email_id": email_ids[index],
+            "user_id": user["id"],
+            "user_email": user["email"],
+            "recipient_type": "to",
+            "is_read": False,
+            "is_starred": False,
+            "is_deleted": False,
+            "folder": "inbox"
+        }
+        for index in upserted_indexes
+        for user in staff
+    ]
+    if recipient_records:
+        await db.email_recipients.insert_many(recipient_records, ordered=False)
+    
+    return len(upserted_indexes)
+
+async def run_external_email_sync() -> int:
+    """تنفيذ دورة مزامنة واحدة وتسجيل حالتها في sync_status"""
+    started_at = datetime.now(timezone.utc).isoformat()
+    await db.sync_status.update_one(
+        {"_id": EXTERNAL_EMAIL_SYNC_LOCK},
+        {"$set": {"running": True, "last_started_at": started_at, "worker_id": WORKER_ID}},
+        upsert=True
+    )
+    
+    try:
+        # جلب الرسائل من IMAP في thread منفصل
+        loop = asyncio.get_running_loop()
+        cursor = await db.sync_status.find_one(
+            {"_id": EXTERNAL_EMAIL_SYNC_LOCK}, {"imap_uid_validity": 1, "imap_last_uid": 1}
+        ) or {}
+        external_emails, uid_validity, last_uid = await loop.run_in_executor(
+            None, sync_fetch_external_emails, cursor.get("imap_uid_validity"), cursor.get("imap_last_uid", 0)
+        )
+        synced_count = await import_external_emails(external_emails)
+    except Exception as e:
+        await db.sync_status.update_one(
+            {"_id": EXTERNAL_EMAIL_SYNC_LOCK},
+            {
+                "$set": {
+                    "running": False,
+                    "last_finished_at": datetime.now(timezone.utc).isoformat(),
+                    "last_error": str(e)
+                },
+                "$inc": {"consecutive_failures": 1}
             }
-            await db.email_recipients.insert_one(recipient_record)
+        )
+        raise
+    
+    finished_at = datetime.now(timezone.utc).isoformat()
+    await db.sync_status.update_one(
+        {"_id": EXTERNAL_EMAIL_SYNC_LOCK},
+        {
+            "$set": {
+                "running": False,
+                "last_finished_at": finished_at,
+                "last_success_at": finished_at,
+                "last_error": None,
+                "last_fetched_count": len(external_emails),
+                "last_synced_count": synced_count,
+                "consecutive_failures": 0,
+                # المؤشر يتقدم فقط بعد حفظ الرسائل بنجاح
+                "imap_uid_validity": uid_validity,
+                "imap_last_uid": last_uid
+            },
+            "$inc": {"total_synced": synced_count}
+        }
+    )
+    return synced_count
+
+async def external_email_sync_worker():
+    """عامل خلفي يزامن البريد الخارجي دورياً مع قفل موزع وتراجع أسي عند الأخطاء"""
+    # مدة القفل أطول من دورة المزامنة حتى لا يستولي عليه عامل آخر أثناء عمل المالك
+    lock_ttl = max(EMAIL_SYNC_INTERVAL * 3, 300)
+    delay = EMAIL_SYNC_INTERVAL
+    failures = 0
+    
+    while True:
+        try:
+            if await acquire_lock(EXTERNAL_EMAIL_SYNC_LOCK, lock_ttl):
+                synced_count = await run_external_email_sync()
+                if synced_count:
+                    logger.info(f"External email sync: {synced_count} new messages")
+            failures = 0
+            delay = EMAIL_SYNC_INTERVAL
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            failures += 1
+            delay = min(EMAIL_SYNC_INTERVAL * (2 ** failures), EMAIL_SYNC_MAX_BACKOFF)
+            logger.error(f"External email sync failed ({failures}), retrying in {delay}s: {e}")
+        
+        try:
+            await db.sync_status.update_one(
+                {"_id": EXTERNAL_EMAIL_SYNC_LOCK},
+                {"$set": {
+                    "next_run_at": (datetime.now(timezone.utc) + timedelta(seconds=delay)).isoformat()
+                }},
+                upsert=True
+            )
+        except Exception as e:
+            logger.error(f"Failed to update sync status: {e}")
         
-        synced_count += 1
+        await asyncio.sleep(delay)
+
+@api_router.get("/emails/external/sync")
+async def sync_external_emails(current_user: User = Depends(get_current_user)):
+    """حالة مزامنة البريد الخارجي (تتم المزامنة عبر العامل الخلفي)"""
+    if current_user.role == UserRole.CLIENT:
+        raise HTTPException(status_code=403, detail="غير مصرح")
     
-    return {"message": f"تم مزامنة {synced_count} رسالة جديدة", "synced_count": synced_count}
+    sync_status = await db.sync_status.find_one({"_id": EXTERNAL_EMAIL_SYNC_LOCK}, {"_id": 0}) or {}
+    synced_count = sync_status.get("last_synced_count", 0)
+    
+    return {
+        "message": f"تم مزامنة {synced_count} رسالة جديدة في آخر دورة",
+        "synced_count": synced_count,
+        "enabled": EMAIL_SYNC_ENABLED,
+        "interval_seconds": EMAIL_SYNC_INTERVAL,
+        "running": sync_status.get("running", False),
+        "last_started_at": sync_status.get("last_started_at"),
+        "last_success_at": sync_status.get("last_success_at"),
+        "last_error": sync_status.get("last_error"),
+        "consecutive_failures": sync_status.get("consecutive_failures", 0),
+        "next_run_at": sync_status.get("next_run_at")
+    }
 
 @api_router.post("/emails/external/send")
 async def send_external_email(email_input: ExternalEmailInput, current_user: User = Depends(get_current_user)):
-    """إرسال بريد خارجي"""
+    """إرسال بريد خارجي (يُضاف إلى قائمة الإرسال ويُرسل في الخلفية)"""
     if current_user.role == UserRole.CLIENT:
         raise HTTPException(status_code=403, detail="غير مصرح")
     
-    try:
-        # إرسال البريد في thread منفصل
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(
-            None, 
-            sync_send_external_email, 
-            email_input.to_email, 
-            email_input.subject, 
-            email_input.body,
-            email_input.attachments
-        )
-        
-        # حفظ في قاعدة البيانات
-        email_id = str(uuid.uuid4())
-        email_doc = {
-            "id": email_id,
-            "sender_id": current_user.id,
-            "sender_name": current_user.full_name,
-            "sender_email": EMAIL_ADDRESS,
-            "recipients": [{"name": email_input.to_email, "email": email_input.to_email, "type": "to"}],
-            "subject": email_input.subject,
-            "body": email_input.body,
-            "body_html": None,
-            "attachments": email_input.attachments or [],
-            "priority": "normal",
-            "related_task_id": None,
-            "is_external": True,
-            "external_email": email_input.to_email,
-            "thread_id": str(uuid.uuid4()),
-            "reply_to_id": None,
-            "is_reply": False,
-            "is_forwarded": False,
-            "status": "sent",
-            "sent_at": datetime.now(timezone.utc).isoformat(),
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        
-        await db.emails.insert_one(email_doc)
-        
-        # سجل للمرسل
-        sender_record = {
-            "id": str(uuid.uuid4()),
-            "email_id": email_id,
-            "user_id": current_user.id,
-            "user_email": current_user.email,
-            "recipient_type": "sender",
-            "is_read": True,
-            "is_starred": False,
-            "is_deleted": False,
-            "folder": "sent"
-        }
-        await db.email_recipients.insert_one(sender_record)
-        
-        return {"message": "تم إرسال البريد بنجاح", "email_id": email_id}
+    if not EMAIL_ADDRESS or not EMAIL_PASSWORD:
+        raise HTTPException(status_code=500, detail="فشل إرسال البريد: بيانات SMTP غير مكتملة")
     
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"فشل إرسال البريد: {str(e)}")
+    # حفظ في قاعدة البيانات
+    email_id = str(uuid.uuid4())
+    attachments = await store_inline_attachments(
+        email_input.attachments,
+        allowed_refs=await readable_email_attachment_refs(email_input.source_email_id, current_user)
+    )
+    email_doc = {
+        "id": email_id,
+        "sender_id": current_user.id,
+        "sender_name": current_user.full_name,
+        "sender_email": EMAIL_ADDRESS,
+        "recipients": [{"name": email_input.to_email, "email": email_input.to_email, "type": "to"}],
+        "subject": email_input.subject,
+        "body": email_input.body,
+        "body_html": None,
+        "attachments": attachments,
+        "priority": "normal",
+        "related_task_id": None,
+        "is_external": True,
+        "external_email": email_input.to_email,
+        "thread_id": str(uuid.uuid4()),
+        "reply_to_id": None,
+        "is_reply": False,
+        "is_forwarded": False,
+        "status": "sent",
+        "delivery_status": "queued",
+        "sent_at": datetime.now(timezone.utc).isoformat(),
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+    
+    await db.emails.insert_one(email_doc)
+    
+    # سجل للمرسل
+    sender_record = {
+        "id": str(uuid.uuid4()),
+        "email_id": email_id,
+        "user_id": current_user.id,
+        "user_email": current_user.email,
+        "recipient_type": "sender",
+        "is_read": True,
+        "is_starred": False,
+        "is_deleted": False,
+        "folder": "sent"
+    }
+    await db.email_recipients.insert_one(sender_record)
+    
+    queue_id = await enqueue_external_email(
+        email_input.to_email,
+        email_input.subject,
+        email_input.body,
+        attachments,
+        email_id=email_id
+    )
+    
+    return {"message": "تمت إضافة البريد إلى قائمة الإرسال", "email_id": email_id, "queue_id": queue_id}
+
+@api_router.get("/emails/external/outbox")
+async def get_outbound_queue(status_filter: Optional[str] = None, limit: int = 50, current_user: User = Depends(get_current_user)):
+    """حالة قائمة البريد الصادر"""
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="للمدير فقط")
+    
+    query = {"status": status_filter} if status_filter else {}
+    jobs = await db.outbound_emails.find(
+        query, {"_id": 0, "body": 0, "attachments": 0}
+    ).sort("created_at", -1).limit(limit).to_list(limit)
+    
+    counts = await db.outbound_emails.aggregate([
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+    ]).to_list(10)
+    
+    return {
+        "jobs": [convert_datetime_fields(job) for job in jobs],
+        "counts": {item["_id"]: item["count"] for item in counts}
+    }
 
 @api_router.get("/emails/external/test")
 async def test_email_connection(current_user: User = Depends(get_current_user)):
@@ -6749,16 +9474,7 @@ async def test_email_connection(current_user: User = Depends(get_current_user)):
     
     # اختبار SMTP
     try:
-        if SMTP_PORT == 587:
-            server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=15)
-            server.starttls()
-        else:
-            try:
-                server = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, timeout=15)
-            except:
-                server = smtplib.SMTP(SMTP_SERVER, 587, timeout=15)
-                server.starttls()
-        server.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
+        server = smtp_pool.connect(timeout=15, remember=False)
         server.quit()
         results["smtp"] = True
     except Exception as e:
@@ -6814,6 +9530,69 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+EXTERNAL_MESSAGE_ID_INDEX_OPTIONS = {"unique": True, "partialFilterExpression": {"external_message_id": {"$type": "string"}}}
+
+# (المجموعة، المفاتيح، الخيارات) - كل فهرس يُنشأ بشكل مستقل حتى لا يمنع فشل أحدها البقية
+INDEXES = [
+    # يمنع استيراد نفس الرسالة الخارجية مرتين
+    ("emails", "external_message_id", EXTERNAL_MESSAGE_ID_INDEX_OPTIONS),
+    ("outbound_emails", [("status", 1), ("next_attempt_at", 1)], {}),
+    ("outbound_emails", "id", {"unique": True}),
+    ("emails", [("thread_id", 1), ("sent_at", -1)], {}),
+    ("email_recipients", [("email_id", 1), ("user_id", 1)], {}),
+    ("pdf_cache", [("kind", 1), ("entity_id", 1)], {}),
+    ("legal_ai_cache", "expires_at", {"expireAfterSeconds": 0}),
+    ("legal_ai_cache", "doc_ids", {}),
+    ("legal_ai_cache", "created_at", {}),
+    ("legal_chat_sessions", [("user_id", 1), ("last_activity", -1)], {}),
+    # التصفح حسب التصنيف (مع أو بدون التخصص) مرتباً بالأحدث بدون ترتيب في الذاكرة
+    ("legal_documents", [("category", 1), ("subcategory", 1), ("created_at", -1), ("id", -1)], {}),
+    ("legal_documents", [("category", 1), ("created_at", -1), ("id", -1)], {}),
+    ("legal_documents", [("created_at", -1), ("id", -1)], {}),
+    ("legal_documents", "id", {}),
+    ("legal_chat_messages", [("session_id", 1), ("created_at", 1)], {}),
+]
+
+@app.on_event("startup")
+async def create_indexes():
+    for collection_name, keys, options in INDEXES:
+        try:
+            await db[collection_name].create_index(keys, **options)
+        except DuplicateKeyError as e:
+            # بيانات قديمة مكررة تمنع الفهرس الفريد، فلا يوجد ما يمنع التكرار حتى تُنظف
+            logger.error(
+                f"Unique index on {collection_name} {keys} NOT created because of existing duplicates; "
+                f"deduplication is not enforced ({e})"
+            )
+            if collection_name == "emails":
+                logger.error("Run POST /api/admin/migrations/email-duplicates to remove duplicate external emails")
+        except Exception as e:
+            logger.error(f"Failed to create index on {collection_name} {keys}: {e}")
+
+@app.on_event("startup")
+async def start_background_workers():
+    background_tasks.append(asyncio.create_task(warm_pdf_executor()))
+    background_tasks.append(asyncio.create_task(prepare_user_manual()))
+    background_tasks.append(asyncio.create_task(legal_index_worker()))
+    if EMAIL_SYNC_ENABLED and EMAIL_ADDRESS and EMAIL_PASSWORD:
+        background_tasks.append(asyncio.create_task(external_email_sync_worker()))
+        logger.info(f"External email sync worker started (interval {EMAIL_SYNC_INTERVAL}s)")
+    if EMAIL_ADDRESS and EMAIL_PASSWORD:
+        background_tasks.append(asyncio.create_task(outbound_email_worker()))
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    smtp_pool.close_all()
+    shutdown_pdf_executor()
+    try:
+        await release_lock(EXTERNAL_EMAIL_SYNC_LOCK)
+    except Exception as e:
+        logger.error(f"Failed to release sync lock: {e}")
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
@@ -0,0 +1,14 @@
+import pytest
+
+from server import tokenize_arabic
+
+
+@pytest.mark.parametrize("first, second", [
+    ("مسؤولية", "مسئولية"),
+    ("المسؤول", "المسئول"),
+    ("شؤون", "شئون"),
+    ("أحكام", "احكام"),
+    ("المحكمة", "المحكمه"),
+])
+def test_spelling_variants_share_terms(first, second):
+    assert tokenize_arabic(first) == tokenize_arabic(second)
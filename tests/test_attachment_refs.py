@@ -0,0 +1,29 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+def test_refs_outside_allowed_source_are_rejected():
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(server.store_inline_attachments([{"sha256": "b" * 64}], allowed_refs={"a" * 64}))
+    assert exc.value.status_code == 400
+
+
+def test_refs_from_allowed_source_are_resolved(monkeypatch):
+    resolved = []
+
+    async def fake_resolve(att, retain=True):
+        resolved.append((att["sha256"], retain))
+        return {"id": "1", "blob_id": "blob", "sha256": att["sha256"], "name": "a.pdf",
+                "type": "application/pdf", "size": 3}
+
+    monkeypatch.setattr(server, "resolve_attachment_ref", fake_resolve)
+    # blob_id والحجم القادمان من العميل لا يُستخدمان
+    stored = asyncio.run(server.store_inline_attachments(
+        [{"sha256": "a" * 64, "blob_id": "other", "size": 1}], allowed_refs={"a" * 64}
+    ))
+    assert resolved == [("a" * 64, True)]
+    assert stored[0]["blob_id"] == "blob" and stored[0]["size"] == 3
@@ -0,0 +1,86 @@
+import server
+
+
+class FakeIMAP:
+    """صندوق IMAP بسيط يدعم UIDVALIDITY وUID SEARCH/FETCH"""
+
+    def __init__(self, messages, uid_validity=7):
+        self.messages = messages
+        self.uid_validity = uid_validity
+        self.fetched = []
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    def login(self, user, password):
+        return "OK", []
+
+    def select(self, mailbox):
+        return "OK", [str(len(self.messages)).encode()]
+
+    def response(self, code):
+        return code, [str(self.uid_validity).encode()]
+
+    def uid(self, command, *args):
+        if command == "SEARCH":
+            uids = sorted(self.messages)
+            if args[1] == "UID":
+                low = int(args[2].split(":")[0])
+                # مثل الخوادم الحقيقية: n:* تشمل آخر رسالة دائماً
+                uids = [uid for uid in uids if uid >= low] or uids[-1:]
+            return "OK", [" ".join(map(str, uids)).encode()]
+        uid = int(args[0])
+        self.fetched.append(uid)
+        return "OK", [(b"RFC822", self.messages[uid])]
+
+    def logout(self):
+        return "BYE", []
+
+
+def raw_message(subject, message_id=None):
+    headers = f"From: Sender <a@example.com>\r\nTo: b@example.com\r\nSubject: {subject}\r\n"
+    headers += "Date: Mon, 1 Jan 2024 10:00:00 +0000\r\n"
+    if message_id:
+        headers += f"Message-ID: {message_id}\r\n"
+    return (headers + "\r\nbody\r\n").encode()
+
+
+def setup(monkeypatch, mailbox):
+    monkeypatch.setattr(server, "EMAIL_ADDRESS", "x@example.com")
+    monkeypatch.setattr(server, "EMAIL_PASSWORD", "secret")
+    monkeypatch.setattr(server.imaplib, "IMAP4_SSL", mailbox)
+
+
+def test_fetches_only_new_uids(monkeypatch):
+    mailbox = FakeIMAP({uid: raw_message(f"m{uid}", f"<{uid}@x>") for uid in (3, 5, 8)})
+    setup(monkeypatch, mailbox)
+
+    emails, validity, last_uid = server.sync_fetch_external_emails()
+    assert [e["message_id"] for e in emails] == ["<3@x>", "<5@x>", "<8@x>"]
+    assert (validity, last_uid) == (7, 8)
+
+    mailbox.fetched.clear()
+    emails, validity, last_uid = server.sync_fetch_external_emails(validity, last_uid)
+    assert emails == [] and mailbox.fetched == [] and last_uid == 8
+
+    mailbox.messages[9] = raw_message("m9", "<9@x>")
+    emails, _, last_uid = server.sync_fetch_external_emails(validity, 8)
+    assert [e["message_id"] for e in emails] == ["<9@x>"] and last_uid == 9
+
+
+def test_uid_validity_change_resets_cursor(monkeypatch):
+    mailbox = FakeIMAP({1: raw_message("a", "<a@x>")}, uid_validity=99)
+    setup(monkeypatch, mailbox)
+
+    emails, validity, last_uid = server.sync_fetch_external_emails(7, 50)
+    assert [e["message_id"] for e in emails] == ["<a@x>"]
+    assert (validity, last_uid) == (99, 1)
+
+
+def test_missing_message_id_is_deterministic(monkeypatch):
+    mailbox = FakeIMAP({1: raw_message("no id")})
+    setup(monkeypatch, mailbox)
+
+    first = server.sync_fetch_external_emails()[0][0]["message_id"]
+    second = server.sync_fetch_external_emails()[0][0]["message_id"]
+    assert first == second
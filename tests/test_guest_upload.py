@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import server
+
+BOUNDARY = "testboundary"
+
+
+def multipart_body(fields, files):
+    body = b""
+    for name, value in fields.items():
+        body += (f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"{name}\"\r\n\r\n"
+                 f"{value}\r\n").encode()
+    for name, (filename, content) in files.items():
+        body += (f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"{name}\"; "
+                 f"filename=\"{filename}\"\r\nContent-Type: application/pdf\r\n\r\n").encode()
+        body += content + b"\r\n"
+    return body + f"--{BOUNDARY}--\r\n".encode()
+
+
+def chunked_request(body, chunk_size=7):
+    """طلب بدون Content-Length تصل بياناته على دفعات"""
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+    sent = []
+
+    async def receive():
+        chunk = chunks.pop(0) if chunks else b""
+        sent.append(len(chunk))
+        return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "headers": [(b"content-type", f"multipart/form-data; boundary={BOUNDARY}".encode()),
+                    (b"transfer-encoding", b"chunked")],
+    }
+    return Request(scope, receive), sent
+
+
+def test_reader_streams_fields_and_files():
+    body = multipart_body({"client_name": "أحمد"}, {"file_0": ("عقد.pdf", b"%PDF-1.4 " * 20)})
+    request, _ = chunked_request(body)
+
+    async def scenario():
+        reader = server.StreamingMultipartReader(request, 10_000, 10)
+        parts = []
+        async for name, filename, content_type in reader.parts():
+            if filename is None:
+                parts.append((name, await reader.read_field(100)))
+            else:
+                parts.append((name, filename, content_type, b"".join([c async for c in reader.data()])))
+        return parts
+
+    assert asyncio.run(scenario()) == [
+        ("client_name", "أحمد"),
+        ("file_0", "عقد.pdf", "application/pdf", b"%PDF-1.4 " * 20),
+    ]
+
+
+def test_reader_stops_chunked_body_at_limit():
+    body = multipart_body({}, {"file_0": ("big.pdf", b"x" * 5000)})
+    request, sent = chunked_request(body, chunk_size=100)
+
+    async def scenario():
+        reader = server.StreamingMultipartReader(request, 1000, 10)
+        async for _ in reader.parts():
+            async for _ in reader.data():
+                pass
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(scenario())
+    assert exc.value.status_code == 413
+    # توقف القراءة عند الحد بدلاً من استقبال الطلب كاملاً
+    assert sum(sent) <= 1100
+
+
+def test_reader_rejects_non_multipart():
+    scope = {"type": "http", "method": "POST", "headers": [(b"content-type", b"application/json")]}
+    with pytest.raises(HTTPException) as exc:
+        server.StreamingMultipartReader(Request(scope), 1000, 10)
+    assert exc.value.status_code == 415
@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from server import LLMClient
+
+
+class FlakyBackend:
+    def __init__(self):
+        self.fail = True
+        self.hold = None
+        self.entered = asyncio.Event()
+
+    async def complete(self, session_id, system_message, question):
+        self.entered.set()
+        if self.hold is not None:
+            await self.hold.wait()
+        if self.fail:
+            raise RuntimeError("provider down")
+        return "ok"
+
+    async def stream(self, session_id, system_message, question):
+        yield await self.complete(session_id, system_message, question)
+
+
+def make_client(backend):
+    return LLMClient(backend, max_in_flight=1, timeout=5, queue_timeout=0.05,
+                     failure_threshold=1, reset_after=0.05)
+
+
+def test_half_open_probe_released_when_queue_times_out():
+    async def scenario():
+        backend = FlakyBackend()
+        client = make_client(backend)
+
+        # مكان مشغول بطلب بدأ قبل فتح الدائرة
+        backend.hold = asyncio.Event()
+        backend.fail = False
+        slow = asyncio.create_task(client.complete("s", "", "q"))
+        await backend.entered.wait()
+
+        client._record(False)
+        await asyncio.sleep(0.06)
+        assert client.state == "half_open"
+
+        # طلب الاختبار لا يجد مكاناً: 503 دون أن يبقى الاختبار محجوزاً
+        with pytest.raises(HTTPException) as exc:
+            await client.complete("s", "", "q")
+        assert exc.value.status_code == 503
+        assert client._probing is False
+
+        backend.hold.set()
+        await slow
+        backend.hold = None
+        assert await client.complete("s", "", "q") == "ok"
+        assert client.state == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_half_open_probe_released_when_cancelled_in_queue():
+    async def scenario():
+        backend = FlakyBackend()
+        client = make_client(backend)
+        client.queue_timeout = 5
+
+        await client._slots.acquire()
+        client._record(False)
+        await asyncio.sleep(0.06)
+
+        queued = asyncio.create_task(client.complete("s", "", "q"))
+        await asyncio.sleep(0.01)
+        queued.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+        assert client._probing is False
+
+        client._slots.release()
+        backend.fail = False
+        assert await client.complete("s", "", "q") == "ok"
+
+    asyncio.run(scenario())
+
+
+def test_circuit_opens_and_fails_fast():
+    async def scenario():
+        client = make_client(FlakyBackend())
+        with pytest.raises(RuntimeError):
+            await client.complete("s", "", "q")
+        assert client.state == "open"
+        with pytest.raises(HTTPException) as exc:
+            await client.complete("s", "", "q")
+        assert exc.value.status_code == 503
+
+    asyncio.run(scenario())
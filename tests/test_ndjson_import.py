@@ -0,0 +1,32 @@
+import asyncio
+
+import server
+
+
+def collect(chunks, max_line_size=1024):
+    async def source():
+        for chunk in chunks:
+            yield chunk
+
+    async def scenario():
+        return [item async for item in server.iter_ndjson_lines(source(), max_line_size)]
+
+    return asyncio.run(scenario())
+
+
+def test_lines_split_across_chunks():
+    assert collect([b'{"a"', b': 1}\n{"b": 2', b'}\n', b'\n{"c": 3}']) == [
+        (1, b'{"a": 1}'), (2, b'{"b": 2}'), (3, b""), (4, b'{"c": 3}'),
+    ]
+
+
+def test_long_line_spread_over_many_chunks():
+    line = b"x" * 100_000
+    chunks = [line[i:i + 10] for i in range(0, len(line), 10)] + [b"\n"]
+    assert collect(chunks, max_line_size=200_000) == [(1, line)]
+
+
+def test_oversized_line_is_reported_and_following_lines_kept():
+    assert collect([b"y" * 600, b"y" * 600, b"\n", b'{"ok": 1}\n', b"z" * 2000]) == [
+        (1, None), (2, b'{"ok": 1}'), (3, None),
+    ]
@@ -0,0 +1,42 @@
+import pytest
+from starlette.requests import Request
+
+from server import etag_matches, parse_range_header
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("bytes=0-4", (0, 4)),
+    ("bytes=5-", (5, 9)),
+    ("bytes=5-100", (5, 9)),
+    ("bytes=-3", (7, 9)),
+    ("bytes=-100", (0, 9)),
+    # نطاقات غير صالحة تُتجاهل ويُرسل الملف كاملاً
+    ("bytes=9-3", None),
+    ("bytes=a-3", None),
+    ("bytes=--3", None),
+    ("bytes=0-1,3-4", None),
+    ("items=0-1", None),
+])
+def test_parse_range_header(header, expected):
+    assert parse_range_header(header, 10) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=-0", "bytes=10-", "bytes=20-30"])
+def test_unsatisfiable_range_raises(header):
+    with pytest.raises(ValueError):
+        parse_range_header(header, 10)
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, False),
+    ('"abc"', True),
+    ('"old", "abc"', True),
+    ('W/"abc"', True),
+    ('"old"', False),
+    ("*", True),
+])
+def test_etag_matches(header, expected):
+    headers = [(b"if-none-match", header.encode())] if header else []
+    request = Request({"type": "http", "headers": headers})
+    assert etag_matches(request, '"abc"') is expected
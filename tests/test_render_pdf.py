@@ -0,0 +1,40 @@
+import asyncio
+import threading
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+def test_timed_out_render_keeps_slot_until_job_finishes(monkeypatch):
+    release = threading.Event()
+
+    def slow_job(kind, data):
+        release.wait(5)
+        return b"%PDF"
+
+    monkeypatch.setattr(server, "PDF_WORKERS", 0)
+    monkeypatch.setattr(server, "PDF_RENDER_TIMEOUT", 0.05)
+    monkeypatch.setattr(server, "render_pdf_job", slow_job)
+
+    async def scenario():
+        monkeypatch.setattr(server, "pdf_render_slots", asyncio.Semaphore(1))
+        with pytest.raises(HTTPException) as exc:
+            await server.render_pdf("invoice", {})
+        assert exc.value.status_code == 504
+
+        # المهمة ما زالت تعمل في الخلفية فلا يُقبل طلب جديد
+        with pytest.raises(HTTPException) as exc:
+            await server.render_pdf("invoice", {})
+        assert exc.value.status_code == 503
+
+        release.set()
+        for _ in range(100):
+            if not server.pdf_render_slots.locked():
+                break
+            await asyncio.sleep(0.01)
+        assert not server.pdf_render_slots.locked()
+        assert await server.render_pdf("invoice", {}) == b"%PDF"
+
+    asyncio.run(scenario())
@@ -0,0 +1,52 @@
+import socket
+
+import pytest
+
+import server
+
+
+class FakeSMTP:
+    def __init__(self, host, port, timeout=None):
+        self.port = port
+
+    def starttls(self):
+        pass
+
+    def login(self, user, password):
+        pass
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def failing_ssl(*args, **kwargs):
+    raise socket.timeout("timed out")
+
+
+def make_pool(monkeypatch, ssl, starttls):
+    monkeypatch.setattr(server, "SMTP_PORT", 465)
+    monkeypatch.setattr(server.smtplib, "SMTP_SSL", ssl)
+    monkeypatch.setattr(server.smtplib, "SMTP", starttls)
+    return server.SMTPConnectionPool(1, 60)
+
+
+def test_fallback_not_cached_when_starttls_also_fails(monkeypatch):
+    pool = make_pool(monkeypatch, failing_ssl, failing_ssl)
+    with pytest.raises(OSError):
+        pool.connect()
+    assert (pool._use_starttls, pool._port) == (False, 465)
+
+
+def test_fallback_cached_after_starttls_succeeds(monkeypatch):
+    pool = make_pool(monkeypatch, failing_ssl, FakeSMTP)
+    assert pool.connect().port == 587
+    assert (pool._use_starttls, pool._port) == (True, 587)
+
+
+def test_connection_test_does_not_change_pool_mode(monkeypatch):
+    pool = make_pool(monkeypatch, failing_ssl, FakeSMTP)
+    assert pool.connect(remember=False).port == 587
+    assert (pool._use_starttls, pool._port) == (False, 465)